@@ -1,23 +1,78 @@
-from langchain_experimental.agents import create_pandas_dataframe_agent
-from langchain.chat_models import ChatOpenAI
 import pandas as pd
 import os
 
+import config
+from instrumentation import count, get_logger, timed
+from lazy import singleton
+from frame_store import Frame
+from query_plan import PlanError, build_plan_prompt, parse_plan, plan_columns, validate_plan, execute_plan, format_result
+
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-llm = ChatOpenAI(
-    temperature=0,
-    model="gpt-4o-mini",
-    openai_api_key=openai_api_key
-)
+log = get_logger("analyzer")
+
+@singleton
+def get_llm():
+    from langchain.chat_models import ChatOpenAI
+    return ChatOpenAI(
+        temperature=0,
+        model="gpt-4o-mini",
+        openai_api_key=openai_api_key
+    )
+
+# 実行計画のプロンプトに渡す列の型・値の例を取る行数
+PLAN_SAMPLE_ROWS = 1000
+
+@timed("analyze_plan_llm")
+def plan_query(df: pd.DataFrame, query: str) -> dict:
+    """LLM に1回だけ問い合わせて実行計画（query_plan.PLAN_PROMPT の JSON）を作る（df は列の型・値の例に使う）"""
+    from query import get_openai_client
+    response = get_openai_client().chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": build_plan_prompt(df, query)}],
+        temperature=0,
+        response_format={"type": "json_object"},
+    )
+    return validate_plan(parse_plan(response.choices[0].message.content), df)
+
+def analyze_with_plan(frame: Frame, query: str) -> str:
+    plan = plan_query(frame.head(PLAN_SAMPLE_ROWS), query)
+    log.info("🧮 実行計画", extra={"plan": plan})
+    with timed("analyze_plan_execute"):
+        # 計画で使う列だけ DataFrame にする
+        df = frame.to_pandas(plan_columns(plan, frame.columns))
+        return format_result(plan, execute_plan(plan, df))
 
-def analyze_dataframe(df: pd.DataFrame, query: str) -> str:
+@timed("analyze_agent")
+def analyze_with_agent(df: pd.DataFrame, query: str) -> str:
     """
     LangChainのPandas Agentを使って自然言語でDataFrameを分析
     :param df: pandas DataFrame
     :param query: 自然言語の質問
     :return: 答え（文字列）
     """
-    agent = create_pandas_dataframe_agent(llm, df, verbose=True, allow_dangerous_code=True)
+    from langchain_experimental.agents import create_pandas_dataframe_agent
+    agent = create_pandas_dataframe_agent(get_llm(), df, verbose=True, allow_dangerous_code=True)
     result = agent.run(query)
     return result
+
+@timed("analyze")
+def analyze_dataframe(df, query: str) -> str:
+    """
+    まず実行計画（LLM 1回 + pandas）で答え、計画が作れない・実行できない質問だけ Pandas Agent に回す
+    :param df: frame_store.Frame（load_frame の結果）または pandas DataFrame
+    :param query: 自然言語の質問
+    :return: 答え（文字列）
+    """
+    frame = df if isinstance(df, Frame) else Frame(df=df)
+    if config.ANALYZE_QUERY_PLAN:
+        try:
+            answer = analyze_with_plan(frame, query)
+            count("analyze", "plan")
+            return answer
+        except PlanError as e:
+            log.info("🤖 実行計画で答えられないため Pandas Agent を使います", extra={"reason": str(e)})
+        except (KeyError, TypeError, ValueError) as e:
+            log.warning("🤖 実行計画の実行に失敗したため Pandas Agent を使います", extra={"error": repr(e)})
+    count("analyze", "agent")
+    return analyze_with_agent(frame.to_pandas(), query)
@@ -0,0 +1,138 @@
+# answer_cache.py
+# 質問の埋め込みが十分近い過去の質問の回答を返すセマンティックキャッシュ
+# 回答の元になったファイル（source）ごとにバージョンを持ち、再インデックスされたら無効にする
+# バージョンはこのプロセスで invalidate_source した回数と、external_versions（ファイル一覧の登録・削除の回数。
+# get_collection.py delete など別のプロセスでの変更も分かる）の組
+import re
+import threading
+import time
+import unicodedata
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+def _numbers(text: str):
+    """日付・金額・局番など質問中の数字列（これが違う質問は埋め込みが近くても別の質問とみなす）"""
+    return tuple(re.findall(r"\d+", unicodedata.normalize("NFKC", text)))
+
+class AnswerCache:
+    def __init__(self, threshold: float = 0.97, ttl_sec: float = 3600, max_entries: int = 5000,
+                 external_versions: Optional[Callable[[], dict]] = None):
+        """
+        :param threshold: ヒットとみなすコサイン類似度の下限
+        :param ttl_sec: 回答を使い回す期間（秒）
+        :param max_entries: 保持する回答数（超えたら古いものから捨てる）
+        :param external_versions: {source: バージョン} を返す関数（SourceCatalog.versions）
+        """
+        self.threshold = threshold
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self._entries = []
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._source_versions = {}
+        self._external_versions = external_versions
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, query: str, query_embedding) -> Optional[dict]:
+        """使い回せる回答があれば {"answer", "label", "sources", "similarity", "age_sec"} を返す"""
+        vector = self._normalize(query_embedding)
+        numbers = _numbers(query)
+        now = time.time()
+        external = self._read_external()
+        with self._lock:
+            self._expire(now)
+            if self._entries:
+                similarities = self._vectors @ vector
+                for i in np.argsort(-similarities):
+                    if similarities[i] < self.threshold:
+                        break
+                    entry = self._entries[i]
+                    if entry["numbers"] != numbers or not self._is_current(entry["sources"], external):
+                        continue
+                    self.hits += 1
+                    return {
+                        "answer": entry["answer"],
+                        "label": entry["label"],
+                        "sources": dict(entry["sources"]),
+                        "similarity": float(similarities[i]),
+                        "age_sec": now - entry["created_at"],
+                    }
+            self.misses += 1
+        return None
+
+    def versions(self) -> dict:
+        """
+        source ごとの現在のバージョン。検索の前に取っておき store に渡す
+        （回答を作っている間に再インデックスされた source の古い回答を、新しいバージョンで保存しないため）
+        """
+        external = self._read_external()
+        with self._lock:
+            return {
+                source: (self._source_versions.get(source, 0), external.get(source, 0))
+                for source in set(self._source_versions) | set(external)
+            }
+
+    def store(self, query: str, query_embedding, answer: str, label: str, sources: Iterable[str], versions: Optional[dict] = None):
+        """:param versions: 検索の前に versions() で取ったバージョン（省略すると保存時点のバージョン）"""
+        vector = self._normalize(query_embedding)
+        versions = self.versions() if versions is None else versions
+        external = self._read_external()
+        with self._lock:
+            sources = {source: versions.get(source, (0, 0)) for source in sources}
+            if not self._is_current(sources, external):
+                # 回答を作っている間に元のファイルが再インデックスされた
+                return
+            entry = {
+                "query": query,
+                "numbers": _numbers(query),
+                "answer": answer,
+                "label": label,
+                "sources": sources,
+                "created_at": time.time(),
+            }
+            self._entries.append(entry)
+            self._vectors = np.vstack([self._vectors.reshape(-1, len(vector)), vector[None, :]])
+            if len(self._entries) > self.max_entries:
+                self._drop(range(len(self._entries) - self.max_entries))
+
+    def invalidate_source(self, source: str):
+        """source が再インデックスされたときに呼ぶ。この source を使った回答はすべて使わなくなる"""
+        with self._lock:
+            self._source_versions[source] = self._source_versions.get(source, 0) + 1
+            self._drop([i for i, entry in enumerate(self._entries) if source in entry["sources"]])
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _read_external(self) -> dict:
+        return self._external_versions() if self._external_versions is not None else {}
+
+    def _is_current(self, sources: dict, external: dict) -> bool:
+        return all(
+            (self._source_versions.get(source, 0), external.get(source, 0)) == version
+            for source, version in sources.items()
+        )
+
+    def _expire(self, now):
+        self._drop([i for i, entry in enumerate(self._entries) if now - entry["created_at"] > self.ttl_sec])
+
+    def _drop(self, indices):
+        indices = set(indices)
+        if not indices:
+            return
+        keep = [i for i in range(len(self._entries)) if i not in indices]
+        self._entries = [self._entries[i] for i in keep]
+        self._vectors = self._vectors[keep]
+
+    @staticmethod
+    def _normalize(query_embedding) -> np.ndarray:
+        vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        return vector / (np.linalg.norm(vector) or 1.0)
@@ -1,17 +1,25 @@
-from flask import Flask, request, render_template_string
-from flask_socketio import SocketIO, emit
+from flask import Flask, Response, request, render_template_string, jsonify
+from flask_socketio import SocketIO, emit, join_room
 import os
+import uuid
+import itertools
+import tempfile
 import pandas as pd
 
-from processor import clean_dataframe_and_save
-from embedder import add_chunks_to_chroma_streaming
-from orchestrator import classify_query
-from query import query_documents, generate_answer
-from analyzer import analyze_dataframe
+from processor import clean_frames_and_save, count_csv_rows, detect_csv_encoding, iter_csv_frames, iter_csv_file_chunks
+from embedder import add_chunks_to_chroma_streaming, chunk_collection_name, get_embedding_cache, get_source_catalog, warm_up
+from source_catalog import file_content_hash
+from pipeline import answer_question, answer_cache
+from frame_store import build_frame
+from jobs import JobQueue
+from instrumentation import get_logger, maybe_profile, render_metrics
+import config
+
+log = get_logger("app")
 
 app = Flask(__name__)
 socketio = SocketIO(app)
-UPLOAD_FOLDER = "csvs"
+UPLOAD_FOLDER = config.CSV_DIR
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 TEMPLATE = '''
@@ -21,6 +29,11 @@ TEMPLATE = '''
 
     socket.on('progress', function(msg) {
         document.getElementById('progress').innerText = '進行状況: ' + msg.data.toFixed(2) + '%';
+        if (msg.status === 'done') {
+            document.getElementById('upload_result').innerText = msg.message;
+        } else if (msg.status === 'failed') {
+            document.getElementById('upload_result').innerText = msg.error;
+        }
     });
 
     // ファイルアップロード用の関数
@@ -28,6 +41,7 @@ TEMPLATE = '''
         const formData = new FormData();
         const fileInput = document.getElementById('csv_file');
         formData.append('csv_file', fileInput.files[0]);
+        formData.append('sid', socket.id);
 
         fetch('/upload', {
             method: 'POST',
@@ -35,16 +49,42 @@ TEMPLATE = '''
         })
         .then(response => response.text())
         .then(result => {
-            document.getElementById('upload_result').innerText = result;
+            let job = null;
+            try { job = JSON.parse(result); } catch (e) {}
+            if (job && job.job_id) {
+                document.getElementById('upload_result').innerText = job.message + '（ジョブID: ' + job.job_id + '）';
+            } else {
+                document.getElementById('upload_result').innerText = result;
+            }
         })
         .catch(error => {
             document.getElementById('upload_result').innerText = 'エラーが発生しました: ' + error;
         });
     }
 
-    // 質問送信用の関数
+    // 回答はトークン単位で届く（ストリーミング）
+    socket.on('answer_token', function(msg) {
+        document.getElementById('answer').innerText += msg.token;
+    });
+
+    socket.on('answer_done', function(msg) {
+        document.getElementById('answer').innerText = msg.answer;
+        if (msg.timings_ms) {
+            document.getElementById('answer_metrics').innerText =
+                '最初のトークン: ' + (msg.timings_ms.first_token || msg.timings_ms.total).toFixed(0) + 'ms / 合計: ' + msg.timings_ms.total.toFixed(0) + 'ms';
+        }
+    });
+
+    // 質問送信用の関数（SocketIO に接続できていればストリーミング、できなければ HTTP）
     function askQuestion() {
         const query = document.getElementById('query').value;
+
+        if (socket.connected) {
+            document.getElementById('answer').innerText = '';
+            document.getElementById('answer_metrics').innerText = '';
+            socket.emit('ask', {query: query});
+            return;
+        }
         
         fetch('/ask', {
             method: 'POST',
@@ -74,12 +114,109 @@ TEMPLATE = '''
 <button onclick="askQuestion()">Ask</button>
 
 <div id="answer"></div>
+<div id="answer_metrics" style="margin-top: 10px; color: gray;"></div>
 '''
 
 @app.route('/')
 def index():
 	return render_template_string(TEMPLATE)
 
+def wants_profile(value):
+    """リクエストで cProfile の計測を指定されたか（config.PROFILE_ON_REQUEST のときだけ受け付ける）"""
+    return config.PROFILE_ON_REQUEST and str(value).lower() in ("1", "true", "yes")
+
+def run_upload_job(job, raw_path, filename, profile=False):
+    """アップロードされたCSVのクリーニングとインデックス登録（ジョブのワーカーで実行）"""
+    with maybe_profile("upload", force=profile):
+        return _run_upload_job(job, raw_path, filename)
+
+def _run_upload_job(job, raw_path, filename):
+    try:
+        # 前回と同じ内容のファイルが今のコレクション構成で登録済みなら、整形・登録をやり直さない
+        file_path = os.path.join(UPLOAD_FOLDER, filename)
+        content_hash = file_content_hash(raw_path)
+        entry = get_source_catalog().get(filename)
+        if (
+            entry is not None
+            and entry["content_hash"] == content_hash
+            and entry["collection"] == chunk_collection_name(filename)
+            and os.path.exists(file_path)
+        ):
+            job.message = "✅ 同じ内容のCSVが登録済みのため、登録をスキップしました"
+            return {"added": 0, "moved": 0, "unchanged": entry["chunks"], "removed": 0}
+
+        # エンコーディングを判定
+        encoding = detect_csv_encoding(raw_path)
+        if encoding is None:
+            raise ValueError("⚠️ エンコーディングエラーが発生しました。ファイルのエンコーディングを確認してください。")
+
+        frames = iter_csv_frames(raw_path, encoding=encoding)
+        first = next(frames, None)
+
+        # DataFrameが空でないことを確認
+        if first is None or first.empty:
+            raise ValueError("⚠️ CSVファイルにデータが含まれていません")
+
+        # 列が存在することを確認
+        if len(first.columns) == 0:
+            raise ValueError("⚠️ CSVファイルに列が存在しません")
+
+        log.info("🧹 CSVを整形", extra={"file_path": file_path, "encoding": encoding})
+        jobs.update(job, message="🧹 CSVを整形中")
+        clean_frames_and_save(itertools.chain([first], frames), file_path)
+        # analyze で毎回 CSV をパースしないよう型付きのフレームにも変換しておく
+        # 失敗しても analyze は CSV を読めば動くので、インデックス登録は続ける
+        try:
+            build_frame(file_path)
+        except Exception:
+            log.exception("⚠️ 型付きフレームの作成に失敗しました", extra={"csv_path": file_path})
+
+        # 埋め込みは読み込みと並行して逐次行う（進捗は読み込み済みバイト数）
+        jobs.start_progress(job, message="🔄 インデックス登録中")
+        chunks = iter_csv_file_chunks(
+            raw_path,
+            encoding=encoding,
+            progress=lambda ratio: jobs.update(job, progress=ratio),
+        )
+        stats = add_chunks_to_chroma_streaming(
+            chunks,
+            source_id=filename,
+            socketio=None,
+            on_batch=lambda processed: jobs.update(job, processed=processed),
+            rows=count_csv_rows(file_path),
+            content_hash=content_hash,
+        )
+        # このファイルを元にした過去の回答は使わない
+        answer_cache.invalidate_source(filename)
+
+        job.message = "✅ CSVアップロード & インデックス完了"
+        return stats
+
+    except pd.errors.EmptyDataError:
+        raise ValueError("⚠️ CSVファイルが空です")
+    except pd.errors.ParserError:
+        raise ValueError("⚠️ CSVファイルの形式が正しくありません")
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+def emit_job_progress(job):
+    """進捗はジョブIDのルームにだけ送る（他のクライアントには送らない）"""
+    socketio.emit('progress', {
+        'data': job.progress * 100,
+        'job_id': job.id,
+        'status': job.status,
+        'processed': job.processed,
+        'message': job.message,
+        'error': job.error,
+    }, to=job.id)
+
+jobs = JobQueue(max_workers=config.INGEST_WORKERS, on_update=emit_job_progress)
+
+@socketio.on('join_job')
+def join_job(data):
+    join_room(data['job_id'])
+
 @app.route('/upload', methods=['POST'])
 def upload():
     file = request.files.get('csv_file')
@@ -89,74 +226,89 @@ def upload():
     if file.filename == "":
         return "⚠️ ファイル名が空です"
 
+    raw_path = None
     try:
-        print("filename:", file.filename)
-        try:
-            # まずファイルの内容を確認
-            content = file.read()
-            if not content.strip():
-                return "⚠️ ファイルが空です"
-            
-            # ファイルポインタを先頭に戻す
-            file.seek(0)
-            
-            # エンコーディングを試行
-            try:
-                df = pd.read_csv(file, header=None, encoding="utf-8")
-            except UnicodeDecodeError:
-                file.seek(0)
-                try:
-                    df = pd.read_csv(file, header=None, encoding="shift_jis")
-                except UnicodeDecodeError:
-                    return "⚠️ エンコーディングエラーが発生しました。ファイルのエンコーディングを確認してください。"
-            
-            # DataFrameが空でないことを確認
-            if df.empty:
-                return "⚠️ CSVファイルにデータが含まれていません"
-            
-            # 列が存在することを確認
-            if len(df.columns) == 0:
-                return "⚠️ CSVファイルに列が存在しません"
-
-            file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-            print("file_path:", file_path)
-            clean_dataframe_and_save(df, file_path)
-
-            add_chunks_to_chroma_streaming(df, source_id=file.filename, socketio=socketio)
-
-            return "✅ CSVアップロード & インデックス完了"
-            
-        except pd.errors.EmptyDataError:
-            return "⚠️ CSVファイルが空です"
-        except pd.errors.ParserError:
-            return "⚠️ CSVファイルの形式が正しくありません"
-            
+        log.info("📥 アップロード受付", extra={"upload_name": file.filename})
+        # アップロード内容はメモリに載せずにディスクへ書き出す
+        fd, raw_path = tempfile.mkstemp(dir=UPLOAD_FOLDER, suffix=".upload")
+        os.close(fd)
+        file.save(raw_path)
+
+        # まずファイルの内容を確認（先頭だけ読む）
+        with open(raw_path, "rb") as f:
+            head = f.read(64 * 1024)
+        if not head.strip() and os.path.getsize(raw_path) <= len(head):
+            os.remove(raw_path)
+            return "⚠️ ファイルが空です"
+
+        # アップロードしたクライアントをジョブのルームに入れてから登録する
+        job_id = uuid.uuid4().hex
+        sid = request.form.get('sid')
+        if sid:
+            join_room(job_id, sid=sid, namespace='/')
+        profile = wants_profile(request.form.get('profile') or request.args.get('profile'))
+        job = jobs.submit(file.filename, run_upload_job, raw_path, file.filename, profile, key=file.filename, job_id=job_id)
+
+        return jsonify({"job_id": job.id, "message": "⏳ アップロードを受け付けました。インデックス登録を開始します"})
+
     except Exception as e:
+        log.exception("❌ アップロードの受付に失敗しました")
+        if raw_path and os.path.exists(raw_path):
+            os.remove(raw_path)
         return f"⚠️ エラーが発生しました: {str(e)}"
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job.to_dict())
+
 @app.route('/ask', methods=['POST'])
 def ask():
 	query = request.form.get('query', '')
 	if not query:
 		return render_template_string(TEMPLATE, answer="⚠️ 質問が空です")
 
-	classification = classify_query(query)
-	print("分類結果:", classification)
+	result = answer_question(query, profile=wants_profile(request.form.get('profile') or request.args.get('profile')))
+	return result["answer"]
+
+def stream_answer(query, sid, profile=False):
+	try:
+		result = answer_question(query, on_token=lambda token: socketio.emit('answer_token', {'token': token}, to=sid), profile=profile)
+		socketio.emit('answer_done', {'answer': result["answer"], 'timings_ms': result["timings_ms"]}, to=sid)
+	except Exception as e:
+		log.exception("❌ 回答の生成に失敗しました")
+		socketio.emit('answer_done', {'answer': f"⚠️ エラーが発生しました: {str(e)}"}, to=sid)
+
+# SocketIO 経由の質問: 回答を生成しながら質問したクライアントにだけトークンを送る
+@socketio.on('ask')
+def ask_stream(data):
+	query = (data or {}).get('query', '')
+	if not query:
+		emit('answer_done', {'answer': "⚠️ 質問が空です"})
+		return
+	socketio.start_background_task(stream_answer, query, request.sid, wants_profile((data or {}).get('profile')))
+
+@app.route('/embedding_cache', methods=['GET'])
+def embedding_cache_stats():
+	return jsonify(get_embedding_cache().stats())
+
+@app.route('/answer_cache', methods=['GET'])
+def answer_cache_stats():
+	return jsonify(answer_cache.stats())
 
-	if classification == "search":
-		docs = query_documents(query)
-		answer = generate_answer(query, docs)
-	elif classification == "analyze":
-		from utils import select_best_csv_file_for_question
-		file_name = select_best_csv_file_for_question(query)
-		csv_path = os.path.join("csvs", file_name)
-		print("csv_path:", csv_path)
-		df = pd.read_csv(csv_path)
-		answer = analyze_dataframe(df, query)
-	else:
-		answer = "⚠️ 質問の分類に失敗しました"
+@app.route('/sources', methods=['GET'])
+def list_sources():
+	return jsonify(get_source_catalog().entries())
 
-	return answer
+# Prometheus 形式の計測値（処理段階ごとの所要時間のヒストグラム・キャッシュのヒット数など）
+@app.route('/metrics', methods=['GET'])
+def metrics():
+	return Response(render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
 
 if __name__ == '__main__':
+	if config.WARMUP_ON_START:
+		# サーバーはすぐに受け付けを始め、モデル・ChromaDB はバックグラウンドで読み込む
+		socketio.start_background_task(warm_up)
 	socketio.run(app, debug=True)
@@ -0,0 +1,110 @@
+# batch_query.py
+# JSONL の質問をまとめて検索・回答し、結果を質問ごとの所要時間つきで JSONL に書き出す（夜間の回帰テスト用）
+#   python batch_query.py questions.jsonl -o answers.jsonl
+#   python batch_query.py questions.jsonl -o hits.jsonl --no-answer   # 検索だけ
+#   python batch_query.py questions.jsonl -o answers.jsonl --pipeline # /ask と同じ処理（分類・analyze を含む）
+# 入力は1行1件の {"query": "..."}（"question" でも可。"id" などそれ以外のキーは出力にそのまま残す）
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from embedder import get_embedding_function, iter_batches
+from query import query_documents_batch, generate_answers_batch
+
+def read_records(path):
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "query" not in record and "question" not in record:
+                raise ValueError(f"{path}:{line_number}: \"query\" がありません")
+            yield record
+
+def query_of(record):
+    return record.get("query", record.get("question"))
+
+def summarize_hits(hits):
+    return [
+        {"id": hit["id"], "source": hit["metadata"].get("source"), "distance": hit["distance"], "score": hit.get("score")}
+        for hit in hits
+    ]
+
+def run_batch(records, top_k, answer, max_workers):
+    """検索は1回のバッチで行い、検索にかかった時間は件数で割って各質問に配分する"""
+    queries = [query_of(record) for record in records]
+
+    start = time.perf_counter()
+    embeddings = get_embedding_function()(queries)
+    embed_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    hits_list = query_documents_batch(queries, top_k=top_k, query_embeddings=embeddings)
+    retrieve_ms = (time.perf_counter() - start) * 1000
+
+    answers = generate_answers_batch(queries, hits_list, max_workers) if answer else ({} for _ in queries)
+    for record, hits, result in zip(records, hits_list, answers):
+        latency = {"embed_ms": embed_ms / len(records), "retrieve_ms": retrieve_ms / len(records)}
+        if "answer_ms" in result:
+            latency["answer_ms"] = result.pop("answer_ms")
+        latency["total_ms"] = sum(latency.values())
+        yield {**record, **result, "hits": summarize_hits(hits), "latency_ms": latency}
+
+def run_pipeline(records, max_workers):
+    """answer_question を質問ごとに並行して呼ぶ（埋め込みは先にまとめて計算してキャッシュに載せておく）"""
+    from pipeline import answer_question
+
+    get_embedding_function()([query_of(record) for record in records])
+
+    def answer(record):
+        try:
+            result = answer_question(query_of(record))
+        except Exception as e:
+            return {**record, "error": str(e)}
+        return {
+            **record,
+            "answer": result["answer"],
+            "label": result["classification"]["label"],
+            "cached": result["cached"],
+            "hits": summarize_hits(result["hits"]),
+            "latency_ms": result["timings_ms"],
+        }
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch") as executor:
+        yield from executor.map(answer, records)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="質問の JSONL")
+    parser.add_argument("-o", "--output", default="-", help="結果の JSONL（省略時は標準出力）")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=256, help="1回の埋め込み・検索にまとめる質問数")
+    parser.add_argument("--concurrency", type=int, default=config.BATCH_ANSWER_CONCURRENCY, help="回答生成の同時実行数")
+    parser.add_argument("--no-answer", action="store_true", help="検索だけ行う")
+    parser.add_argument("--pipeline", action="store_true", help="/ask と同じ処理（分類・analyze を含む）で回答する")
+    args = parser.parse_args()
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    start = time.perf_counter()
+    count = 0
+    try:
+        for batch in iter_batches(read_records(args.input), args.batch_size):
+            if args.pipeline:
+                results = run_pipeline(batch, args.concurrency)
+            else:
+                results = run_batch(batch, args.top_k, not args.no_answer, args.concurrency)
+            for result in results:
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                count += 1
+            out.flush()
+            print(f"📝 {count} 件完了", file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ {count} 件を {elapsed:.1f} 秒で処理（{count / elapsed if elapsed else 0:.1f} 件/秒）", file=sys.stderr)
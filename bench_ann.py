@@ -0,0 +1,166 @@
+# bench_ann.py
+# 近似最近傍インデックスの設定ごとに recall@k・検索レイテンシ・インデックスサイズを比べる
+#   python bench_ann.py --from-chroma --limit 200000              # 登録済みのチャンクのベクトルで比較
+#   python bench_ann.py --synthetic 100000 --dim 768              # 合成ベクトルで比較（モデル・ChromaDB 不要）
+#   python bench_ann.py --chroma 16:100:10 16:100:100 32:200:200 --faiss HNSW32 HNSW32,SQ8 IVF1024,PQ96 --k 10
+# 一部のベクトルを質問として取り除き、残りに対する厳密な上位 k 件（numpy の総当たり）を正解として recall@k を測る
+# ChromaDB の設定は "M:ef_construction:ef_search"、FAISS の設定は index_factory の文字列で指定する
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import config
+
+def load_from_chroma(limit, page_size=5000):
+    from embedder import get_search_collections, iter_collection_pages
+    vectors = []
+    for collection in get_search_collections():
+        for page in iter_collection_pages(collection, ["embeddings"], page_size):
+            vectors.extend(page["embeddings"][:limit - len(vectors)])
+            if len(vectors) >= limit:
+                return np.asarray(vectors, dtype=np.float32)
+    return np.asarray(vectors, dtype=np.float32)
+
+def make_synthetic(n, dim, n_clusters=200, seed=0):
+    """クラスタを持つベクトル（一様乱数よりは実際の埋め込みに近い分布）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, n_clusters, n)] + 0.3 * rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def exact_top_k(base, queries, k, space, block=256):
+    if space == "cosine":
+        base = base / np.linalg.norm(base, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    base_norms = (base ** 2).sum(axis=1)
+    result = []
+    for start in range(0, len(queries), block):
+        q = queries[start:start + block]
+        scores = -(q @ base.T) if space != "l2" else base_norms[None, :] - 2 * (q @ base.T)
+        top = np.argpartition(scores, k, axis=1)[:, :k]
+        order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)
+        result.append(np.take_along_axis(top, order, axis=1))
+    return np.concatenate(result)
+
+def recall_at_k(truth, found):
+    return float(np.mean([len(set(t) & set(f)) / len(t) for t, f in zip(truth, found)]))
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def timed_queries(search, queries):
+    """1件ずつ検索したときのレイテンシ（ミリ秒）と結果"""
+    latencies, found = [], []
+    for q in queries:
+        start = time.perf_counter()
+        found.append(search(q))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, found
+
+def bench_chroma(setting, base, queries, k, space, workdir):
+    from chromadb import PersistentClient
+    from embedder import hnsw_metadata
+
+    m, ef_construction, ef_search = (int(x) for x in setting.split(":"))
+    path = os.path.join(workdir, f"chroma_{m}_{ef_construction}_{ef_search}")
+    client = PersistentClient(path=path)
+    collection = client.create_collection(name="bench", metadata=hnsw_metadata(space, m, ef_construction, ef_search))
+
+    start = time.perf_counter()
+    for i in range(0, len(base), 5000):
+        batch = base[i:i + 5000]
+        collection.add(ids=[str(j) for j in range(i, i + len(batch))], embeddings=batch.tolist())
+    build_sec = time.perf_counter() - start
+
+    def search(q):
+        result = collection.query(query_embeddings=[q.tolist()], n_results=k, include=[])
+        return [int(i) for i in result["ids"][0]]
+
+    latencies, found = timed_queries(search, queries)
+    return {"config": f"chroma M={m} ef_construction={ef_construction} ef_search={ef_search}", "build_sec": build_sec, "index_bytes": directory_size(path), "latencies": latencies, "found": found}
+
+def bench_faiss(factory, base, queries, k, space, workdir, ef_search, nprobe, mmap):
+    from vector_store import FaissVectorStore
+
+    path = os.path.join(workdir, "faiss_" + factory.replace(",", "_"))
+    store = FaissVectorStore(path, factory=factory, space=space, ef_search=ef_search, nprobe=nprobe)
+    start = time.perf_counter()
+    store.build([str(i) for i in range(len(base))], base, [None] * len(base))
+    build_sec = time.perf_counter() - start
+    if mmap:
+        store = FaissVectorStore(path, factory=factory, space=space, ef_search=ef_search, nprobe=nprobe, mmap=True)
+
+    def search(q):
+        return [int(chunk_id) for chunk_id, _ in store.search(q[None, :], k)[0]]
+
+    latencies, found = timed_queries(search, queries)
+    label = f"faiss {factory} ef_search={ef_search} nprobe={nprobe}" + (" mmap" if mmap else "")
+    return {"config": label, "build_sec": build_sec, "index_bytes": store.stats()["index_bytes"], "latencies": latencies, "found": found}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--from-chroma", action="store_true", help="登録済みのチャンクのベクトルを使う")
+    source.add_argument("--npy", help="ベクトルの .npy ファイル")
+    source.add_argument("--synthetic", type=int, default=50000, help="合成ベクトルの件数")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--limit", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--space", default=config.CHROMA_HNSW_SPACE, choices=["l2", "ip", "cosine"])
+    parser.add_argument("--chroma", nargs="*", default=["16:100:10", "16:100:100", "32:200:200"], help="M:ef_construction:ef_search")
+    parser.add_argument("--faiss", nargs="*", default=["HNSW32", "HNSW32,SQ8", "IVF1024,PQ96"], help="FAISS の index_factory")
+    parser.add_argument("--ef-search", type=int, default=config.VECTOR_INDEX_EF_SEARCH)
+    parser.add_argument("--nprobe", type=int, default=config.VECTOR_INDEX_NPROBE)
+    parser.add_argument("--mmap", action="store_true", help="FAISS のインデックスをメモリマップで開いて検索する")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    args = parser.parse_args()
+
+    if args.from_chroma:
+        vectors = load_from_chroma(args.limit)
+    elif args.npy:
+        vectors = np.load(args.npy, mmap_mode="r")[:args.limit].astype(np.float32)
+    else:
+        vectors = make_synthetic(args.synthetic, args.dim)
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(vectors))
+    queries, base = vectors[order[:args.queries]], vectors[order[args.queries:]]
+    print(f"📦 ベクトル {len(base)} 件（{base.shape[1]} 次元, {base.nbytes / 1e6:.0f} MB）/ 質問 {len(queries)} 件 / space={args.space}")
+
+    start = time.perf_counter()
+    truth = exact_top_k(base, queries, args.k, args.space)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"🎯 総当たり: {exact_ms:.2f} ms/件（正解の作成）")
+
+    workdir = tempfile.mkdtemp(prefix="rekipedia_ann_")
+    runs = []
+    try:
+        for setting in args.chroma:
+            runs.append(bench_chroma(setting, base, queries, args.k, args.space, workdir))
+        for factory in args.faiss:
+            runs.append(bench_faiss(factory, base, queries, args.k, args.space, workdir, args.ef_search, args.nprobe, args.mmap))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = []
+    print(f"\n{'設定':<52} {'recall@' + str(args.k):>10} {'p50 ms':>8} {'p95 ms':>8} {'サイズ MB':>10} {'構築 s':>8}")
+    for run in runs:
+        row = {
+            "config": run["config"],
+            f"recall@{args.k}": recall_at_k(truth, run["found"]),
+            "p50_ms": float(np.percentile(run["latencies"], 50)),
+            "p95_ms": float(np.percentile(run["latencies"], 95)),
+            "index_mb": run["index_bytes"] / 1e6,
+            "build_sec": run["build_sec"],
+        }
+        report.append(row)
+        print(f"{row['config']:<52} {row[f'recall@{args.k}']:>10.3f} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['index_mb']:>10.1f} {row['build_sec']:>8.1f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"vectors": len(base), "dim": int(base.shape[1]), "k": args.k, "space": args.space, "runs": report}, f, ensure_ascii=False, indent=2)
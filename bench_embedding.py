@@ -0,0 +1,65 @@
+# bench_embedding.py
+# 取り込み時の埋め込み + ChromaDB 書き込みのスループット比較
+#   baseline: 128件固定バッチで encode → collection.add を直列に実行（従来のループ）
+#   engine  : EmbeddingEngine（プロセスプール・バッチサイズ自動調整）+ CollectionWriter で書き込みを重ねる
+import argparse
+import time
+
+import torch
+from chromadb import EphemeralClient
+from sentence_transformers import SentenceTransformer
+
+import config
+from bench_serialize import make_table
+from embedding_engine import EmbeddingEngine, CollectionWriter
+from processor import serialize_table_rows
+
+def make_chunks(n_rows):
+    header, data = make_table(n_rows)
+    return [text for texts in serialize_table_rows(data, header) for text in texts]
+
+def run_baseline(model, collection, chunks, batch_size=128):
+    for i in range(0, len(chunks), batch_size):
+        batch = chunks[i:i + batch_size]
+        embeddings = model.encode(batch, convert_to_numpy=True, show_progress_bar=False).tolist()
+        collection.add(documents=batch, ids=[f"b_{j}" for j in range(i, i + len(batch))], embeddings=embeddings)
+
+def run_engine(engine, collection, chunks):
+    writer = CollectionWriter(collection, max_pending=config.INGEST_WRITE_QUEUE_SIZE)
+    try:
+        window = engine.window_size
+        for i in range(0, len(chunks), window):
+            batch = chunks[i:i + window]
+            embeddings = engine.encode(batch).tolist()
+            writer.submit("add", documents=batch, ids=[f"e_{j}" for j in range(i, i + len(batch))], embeddings=embeddings)
+    finally:
+        writer.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.rows)
+    model = SentenceTransformer(config.EMBEDDING_MODEL_NAME, device="cuda" if torch.cuda.is_available() else "cpu")
+    client = EphemeralClient()
+    print(f"📦 {len(chunks)} チャンク")
+
+    collection = client.create_collection("bench_baseline")
+    start = time.perf_counter()
+    run_baseline(model, collection, chunks)
+    base_sec = time.perf_counter() - start
+    print(f"baseline            : {len(chunks) / base_sec:,.1f} chunks/s")
+
+    for processes in args.processes:
+        engine = EmbeddingEngine(model, processes=processes, tokens_per_batch=config.EMBEDDING_TOKENS_PER_BATCH)
+        collection = client.create_collection(f"bench_engine_{processes}")
+        if processes > 1:
+            engine._get_pool()  # プール起動時間は計測に含めない
+        start = time.perf_counter()
+        run_engine(engine, collection, chunks)
+        sec = time.perf_counter() - start
+        engine.close()
+        padding = engine.padding_stats()
+        print(f"engine ({processes} proc)     : {len(chunks) / sec:,.1f} chunks/s ({base_sec / sec:.2f}x), パディング率 {padding['padding_waste']:.1%}")
@@ -0,0 +1,319 @@
+# bench_retrieval.py
+# 取り込み・検索の速度と検索品質をまとめて測るベンチマーク（OpenAI は呼ばないのでオフラインで動く）
+#   python bench_retrieval.py                              # 表 5000 行 + 自由記述 1000 行、質問 200 件
+#   python bench_retrieval.py --rows 50000 --questions 1000 --k 1 5 10 --json result.json
+#   python bench_retrieval.py --pipeline --llm-latency-ms 300  # /ask の処理全体（LLM はスタブ）も測る
+#   REKIPEDIA_COLLECTION_LAYOUT=sharded python bench_retrieval.py   # ファイルごとのコレクションに分けた場合
+# 合成した日本語の CSV（表形式・自由記述）を一時ディレクトリの ChromaDB に取り込み、
+#   取り込み: 段階ごと（読み込み・ヘッダー検出・チャンク化・埋め込み・ChromaDB 書き込み・転置インデックス）の処理速度
+#   検索    : 埋め込みのみ / ハイブリッド / ハイブリッド + 絞り込み それぞれのレイテンシ（p50/p95/p99）と
+#             「質問 → 正解の行」のラベルに対する recall@k・MRR
+# を出力する。チャンク化・埋め込み・検索を変更したときの比較用
+import os
+import tempfile
+
+# 本番の ChromaDB・キャッシュを汚さないよう、リポジトリのモジュールを読み込む前に保存先を一時ディレクトリに向ける
+WORKDIR = os.environ.get("REKIPEDIA_BENCH_DIR") or tempfile.mkdtemp(prefix="rekipedia_bench_")
+for _name, _value in {
+    "REKIPEDIA_CHROMA_PATH": os.path.join(WORKDIR, "chroma_db"),
+    "REKIPEDIA_LEXICAL_INDEX_PATH": os.path.join(WORKDIR, "lexical_index.sqlite3"),
+    "REKIPEDIA_SOURCE_CATALOG_PATH": os.path.join(WORKDIR, "source_catalog.sqlite3"),
+    "REKIPEDIA_CSV_DIR": os.path.join(WORKDIR, "csvs"),
+    "REKIPEDIA_EMBEDDING_CACHE": "0",
+}.items():
+    os.environ.setdefault(_name, _value)
+
+import argparse
+import json
+import random
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+import config
+from embedder import (
+    get_chunk_collection, get_embedding_function, get_lexical_index, get_source_catalog, iter_batches, iter_chunk_records,
+    normalize_rows, update_source_summary, SOURCE_SUMMARY_CHARS,
+)
+from processor import detect_header_row, iter_csv_chunks, iter_csv_frames
+from query import query_documents, query_documents_batch
+
+COMPANY_NAMES = ["ジェイコム", "アオバ", "ミドリ", "サクラ", "ヒカリ", "ツバサ", "ホクト", "ミナト", "アサヒ", "コスモ"]
+AREAS = ["東京", "大阪", "名古屋", "札幌", "福岡", "仙台", "広島", "横浜"]
+BRANCHES = ["八王子・日野局", "中央局", "港北局", "西局", "東局", "南局", "北局", "本局"]
+STATUSES = ["単発", "継続", "新規"]
+STAFF = ["佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "山本", "中村"]
+NOTES = ["", "", "振込手数料差引", "一部入金", "前受金", "請求書再発行済み"]
+
+# ---------------------------------------------------------------- 合成データ
+
+def make_companies(rng, n):
+    names = [f"株式会社{c}{a} {b}" for c in COMPANY_NAMES for a in AREAS for b in BRANCHES]
+    rng.shuffle(names)
+    return names[:n]
+
+def make_rows(rng, n_rows, n_companies=200):
+    """(会社名, 日付) の組が重ならない入金明細"""
+    companies = make_companies(rng, n_companies)
+    days = [date(2024, 1, 1) + timedelta(days=i) for i in range(366)]
+    pairs = set()
+    while len(pairs) < min(n_rows, len(companies) * len(days)):
+        pairs.add((rng.randrange(len(companies)), rng.randrange(len(days))))
+    rows = []
+    for i, (c, d) in enumerate(sorted(pairs, key=lambda p: (p[1], p[0]))):
+        rows.append({
+            "No": str(i + 1),
+            "会社名": companies[c],
+            "入金日": days[d].strftime("%Y/%m/%d"),
+            "入金額": str(rng.randrange(1, 500) * 1000),
+            "区分": rng.choice(STATUSES),
+            "担当者": rng.choice(STAFF),
+            "備考": rng.choice(NOTES),
+        })
+    return rows
+
+def write_table_csv(path, rows):
+    """タイトル行などの前置きの後にヘッダー行が来る、アップロードされる CSV によくある形"""
+    columns = list(rows[0])
+    lines = [["入金一覧"] + [""] * (len(columns) - 1), ["出力日: 2025/01/10"] + [""] * (len(columns) - 1), columns]
+    lines += [[row[c] for c in columns] for row in rows]
+    pd.DataFrame(lines).to_csv(path, header=False, index=False)
+
+def write_text_csv(path, rows):
+    """1セルに1文の自由記述"""
+    sentences = [
+        f"{row['会社名']}は{row['入金日']}に{int(row['入金額']):,}円を入金した。担当は{row['担当者']}で、{row['区分']}の取引として処理した。"
+        for row in rows
+    ]
+    pd.DataFrame({"記録": sentences}).to_csv(path, header=False, index=False)
+
+def make_questions(rng, rows, source, n):
+    templates = [
+        "{company}の{date}の入金状況",
+        "{short}の{date_ja}の入金額は？",
+        "{date}に{short}から入金はありましたか",
+    ]
+    questions = []
+    for row in rng.sample(rows, min(n, len(rows))):
+        y, m, d = row["入金日"].split("/")
+        questions.append({
+            "query": rng.choice(templates).format(
+                company=row["会社名"],
+                short=row["会社名"].replace("株式会社", ""),
+                date=row["入金日"],
+                date_ja=f"{int(y)}年{int(m)}月{int(d)}日",
+            ),
+            "source": source,
+            "company": row["会社名"],
+            "date": row["入金日"],
+        })
+    return questions
+
+def label_relevant(questions, records):
+    """会社名と日付を両方含むチャンクを正解とする"""
+    by_source = {}
+    for chunk_id, text, metadata in records:
+        by_source.setdefault(metadata["source"], []).append((chunk_id, text))
+    for q in questions:
+        q["relevant"] = [chunk_id for chunk_id, text in by_source[q["source"]] if q["company"] in text and q["date"] in text]
+    return [q for q in questions if q["relevant"]]
+
+# ---------------------------------------------------------------- 取り込み
+
+class Stages:
+    def __init__(self):
+        self.seconds = {}
+
+    def run(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+        return result
+
+def ingest(path, source_id, stages):
+    """add_chunks_to_chroma_streaming と同じ処理を段階ごとに分けて時間を測る"""
+    frames = stages.run("parse", lambda: list(iter_csv_frames(path)))
+    stages.run("header", detect_header_row, frames[0])
+    chunks = stages.run("chunk", lambda: list(iter_csv_chunks(frames)))
+    records = list(iter_chunk_records(chunks, source_id))
+    ids, texts, metadatas = (list(x) for x in zip(*records))
+
+    embeddings = stages.run("embed", get_embedding_function(), texts)
+
+    def write():
+        collection = get_chunk_collection(source_id)
+        for start in range(0, len(ids), 5000):
+            end = start + 5000
+            collection.upsert(ids=ids[start:end], documents=texts[start:end], embeddings=embeddings[start:end], metadatas=metadatas[start:end])
+        update_source_summary(source_id, normalize_rows(embeddings).sum(axis=0), len(ids), texts[0][:SOURCE_SUMMARY_CHARS])
+        get_source_catalog().upsert(source_id, collection.name, len(ids))
+    stages.run("chroma_write", write)
+
+    def index():
+        lexical_index = get_lexical_index()
+        for batch in iter_batches(zip(ids, texts, [source_id] * len(ids)), 5000):
+            lexical_index.add(batch)
+        lexical_index.add_entities("company", [(chunk_id, m["company"]) for chunk_id, m in zip(ids, metadatas) if "company" in m])
+    stages.run("lexical_index", index)
+    return records
+
+# ---------------------------------------------------------------- 検索
+
+MODES = {
+    "vector": {"hybrid": False, "use_filters": False},
+    "hybrid": {"hybrid": True, "use_filters": False},
+    "hybrid+filter": {"hybrid": True, "use_filters": True},
+}
+
+def percentiles(latencies_ms):
+    return {f"p{p}": float(np.percentile(latencies_ms, p)) for p in (50, 95, 99)}
+
+def evaluate(questions, results, ks):
+    scores = {f"recall@{k}": [] for k in ks}
+    reciprocal_ranks = []
+    for q, hits in zip(questions, results):
+        ids = [hit["id"] for hit in hits]
+        relevant = set(q["relevant"])
+        for k in ks:
+            scores[f"recall@{k}"].append(len(relevant & set(ids[:k])) / min(len(relevant), k))
+        rank = next((i for i, chunk_id in enumerate(ids) if chunk_id in relevant), None)
+        reciprocal_ranks.append(0.0 if rank is None else 1.0 / (rank + 1))
+    summary = {name: float(np.mean(values)) for name, values in scores.items()}
+    summary["mrr"] = float(np.mean(reciprocal_ranks))
+    return summary
+
+def bench_queries(questions, ks, modes):
+    top_k = max(ks)
+    report = {}
+    for mode in modes:
+        options = MODES[mode]
+        query_documents(questions[0]["query"], top_k=top_k, **options)  # ウォームアップ
+        latencies, results = [], []
+        for q in questions:
+            start = time.perf_counter()
+            results.append(query_documents(q["query"], top_k=top_k, **options))
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        query_documents_batch([q["query"] for q in questions], top_k=top_k, **options)
+        batch_sec = time.perf_counter() - start
+
+        report[mode] = {
+            "latency_ms": percentiles(latencies),
+            "batch_qps": len(questions) / batch_sec,
+            **evaluate(questions, results, ks),
+        }
+    return report
+
+# ---------------------------------------------------------------- /ask 全体（LLM はスタブ）
+
+class StubOpenAI:
+    """chat.completions.create だけを持つ OpenAI クライアントの代わり。latency_ms 待ってから決まった回答を返す"""
+    def __init__(self, latency_ms=0, tokens=20):
+        self.latency_ms = latency_ms
+        self.tokens = tokens
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, temperature=None, stream=False):
+        answer = "（スタブ）該当する入金は検索結果のとおりです。"
+        if not stream:
+            time.sleep(self.latency_ms / 1000)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=answer))])
+        return self._stream(answer)
+
+    def _stream(self, answer):
+        step = max(len(answer) // self.tokens, 1)
+        for i in range(0, len(answer), step):
+            time.sleep(self.latency_ms / 1000 / self.tokens)
+            delta = SimpleNamespace(content=answer[i:i + step])
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+def bench_pipeline(questions, llm_latency_ms):
+    import orchestrator
+    import pipeline
+    import query
+
+    stub = StubOpenAI(latency_ms=llm_latency_ms)
+    query.get_openai_client = lambda: stub
+    orchestrator.classify_query_with_llm = lambda question: "search"
+    pipeline.analyze_dataframe = lambda df, question: f"{len(df)} 行のデータを分析しました"
+
+    latencies, first_tokens, labels = [], [], {}
+    for q in questions:
+        result = pipeline.answer_question(q["query"], on_token=lambda token: None)
+        latencies.append(result["timings_ms"]["total"])
+        if "first_token" in result["timings_ms"]:
+            first_tokens.append(result["timings_ms"]["first_token"])
+        label = result["classification"]["label"]
+        labels[label] = labels.get(label, 0) + 1
+    report = {"latency_ms": percentiles(latencies), "labels": labels}
+    if first_tokens:
+        report["first_token_ms"] = percentiles(first_tokens)
+    return report
+
+# ----------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000, help="表形式 CSV の行数")
+    parser.add_argument("--text-rows", type=int, default=1000, help="自由記述 CSV の行数（0 なら作らない）")
+    parser.add_argument("--questions", type=int, default=200, help="CSV ごとの質問数")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--pipeline", action="store_true", help="/ask の処理全体も測る（LLM はスタブ）")
+    parser.add_argument("--llm-latency-ms", type=float, default=0, help="スタブの LLM の応答時間")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    os.makedirs(config.CSV_DIR, exist_ok=True)
+    print(f"📁 作業ディレクトリ: {WORKDIR}")
+
+    datasets = [("table", "入金一覧.csv", args.rows, write_table_csv)]
+    if args.text_rows:
+        datasets.append(("text", "入金メモ.csv", args.text_rows, write_text_csv))
+
+    results = {"config": vars(args), "model": config.EMBEDDING_MODEL_NAME, "backend": config.EMBEDDING_BACKEND, "layout": config.COLLECTION_LAYOUT, "ingest": {}}
+    all_records, questions = [], []
+    for kind, file_name, n_rows, write_csv in datasets:
+        rows = make_rows(rng, n_rows)
+        path = os.path.join(config.CSV_DIR, file_name)
+        write_csv(path, rows)
+
+        stages = Stages()
+        records = ingest(path, file_name, stages)
+        all_records.extend(records)
+        questions.extend(make_questions(rng, rows, file_name, args.questions))
+
+        results["ingest"][kind] = {
+            "rows": n_rows,
+            "chunks": len(records),
+            "seconds": stages.seconds,
+            "chunks_per_sec": {name: len(records) / sec for name, sec in stages.seconds.items() if sec > 0},
+        }
+        print(f"\n📥 {kind}: {n_rows} 行 → {len(records)} チャンク")
+        for name, sec in stages.seconds.items():
+            print(f"  {name:<14}: {sec:8.2f} s ({len(records) / sec if sec else float('inf'):,.0f} chunks/s)")
+
+    questions = label_relevant(questions, all_records)
+    results["queries"] = len(questions)
+    results["retrieval"] = bench_queries(questions, args.k, args.modes)
+    print(f"\n🔍 質問 {len(questions)} 件")
+    for mode, report in results["retrieval"].items():
+        quality = " / ".join(f"{name} {value:.3f}" for name, value in report.items() if name.startswith(("recall", "mrr")))
+        latency = " / ".join(f"{name} {value:.1f}ms" for name, value in report["latency_ms"].items())
+        print(f"  {mode:<14}: {latency} / batch {report['batch_qps']:.1f} q/s | {quality}")
+
+    if args.pipeline:
+        results["pipeline"] = bench_pipeline(questions, args.llm_latency_ms)
+        latency = " / ".join(f"{name} {value:.1f}ms" for name, value in results["pipeline"]["latency_ms"].items())
+        print(f"\n💬 /ask（LLM スタブ {args.llm_latency_ms:.0f}ms）: {latency} {results['pipeline']['labels']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 {args.json} に保存しました")
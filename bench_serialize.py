@@ -0,0 +1,51 @@
+# bench_serialize.py
+# テーブル行のテキスト化（row_to_text + iterrows と serialize_table_rows）の速度比較
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from processor import row_to_text, serialize_table_rows
+
+def make_table(n_rows, n_cols=12, seed=0):
+    rng = np.random.default_rng(seed)
+    header = pd.Series([f"項目{i}" if i % 5 else None for i in range(n_cols)])
+    data = {}
+    for i in range(n_cols):
+        if i % 3 == 0:
+            col = [f"2024/{m}/{d}" for m, d in zip(rng.integers(1, 13, n_rows), rng.integers(1, 29, n_rows))]
+        elif i % 3 == 1:
+            col = rng.integers(0, 1_000_000, n_rows).astype(str).tolist()
+        else:
+            col = [f"株式会社テスト{k}" for k in rng.integers(0, 500, n_rows)]
+        data[i] = pd.Series(col, dtype=object).mask(rng.random(n_rows) < 0.1)
+    return header, pd.DataFrame(data)
+
+def iterrows_path(data, header):
+    chunks = []
+    for idx, row in data.iterrows():
+        text = row_to_text(row, header)
+        if text.strip():
+            chunks.append(text)
+    return chunks
+
+def serializer_path(data, header):
+    return [text for texts in serialize_table_rows(data, header) for text in texts]
+
+if __name__ == "__main__":
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    header, data = make_table(n_rows)
+    print(f"📦 {n_rows} 行 × {len(data.columns)} 列")
+
+    start = time.perf_counter()
+    expected = iterrows_path(data, header)
+    old_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = serializer_path(data, header)
+    new_sec = time.perf_counter() - start
+
+    assert actual == expected, "出力が一致しません"
+    print(f"iterrows + row_to_text : {old_sec:.2f}s ({n_rows / old_sec:,.0f} rows/s)")
+    print(f"serialize_table_rows   : {new_sec:.2f}s ({n_rows / new_sec:,.0f} rows/s)")
+    print(f"🚀 {old_sec / new_sec:.1f}x")
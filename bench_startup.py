@@ -0,0 +1,30 @@
+# bench_startup.py
+# 各モジュールを新しいプロセスで import するまでの時間（コールドスタート）を計測する
+#   python bench_startup.py            # app / CLI 用モジュールの import 時間
+#   python bench_startup.py --warm-up  # 加えて embedder.warm_up()（モデル・ChromaDB 読み込み）の時間
+import argparse
+import statistics
+import subprocess
+import sys
+
+MODULES = ["app", "query", "utils", "orchestrator", "analyzer", "embedder", "processor"]
+
+def time_in_subprocess(code: str) -> float:
+    script = f"import time\nstart = time.perf_counter()\n{code}\nprint(time.perf_counter() - start)"
+    out = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warm-up", action="store_true")
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        times = [time_in_subprocess(f"import {module}") for _ in range(args.repeat)]
+        print(f"import {module:<14}: {statistics.median(times) * 1000:8.1f} ms")
+
+    if args.warm_up:
+        times = [time_in_subprocess("import embedder\nembedder.warm_up()") for _ in range(args.repeat)]
+        print(f"embedder.warm_up()   : {statistics.median(times) * 1000:8.1f} ms")
@@ -0,0 +1,80 @@
+# check_backend_recall.py
+# 埋め込みバックエンドの速度と検索品質を fp32 (torch) と比較する回帰チェック
+#   python check_backend_recall.py csvs/入金一覧.csv --backends onnx onnx-int8 --k 5 --min-recall 0.9
+# CSV からチャンクを作ってサンプルし、各バックエンドで「コーパスもクエリも同じバックエンド」で検索した上位 k 件が
+# fp32 で検索した上位 k 件とどれだけ一致するか（recall@k）を測る。min-recall を下回ったら終了コード 1
+import argparse
+import random
+import sys
+import time
+from itertools import islice
+
+import numpy as np
+
+import config
+from embedding_backends import BACKENDS, load_embedding_model
+from embedding_engine import EmbeddingEngine
+from processor import iter_csv_file_chunks
+
+def sample_chunks(csv_paths, n_docs, seed=0):
+    chunks = []
+    for path in csv_paths:
+        chunks.extend(islice(iter_csv_file_chunks(path), n_docs * 10))
+    random.Random(seed).shuffle(chunks)
+    return chunks[:n_docs]
+
+def make_queries(docs, n_queries, seed=0):
+    """チャンクの一部分だけを切り出して「部分的な質問」に見立てる"""
+    rng = random.Random(seed)
+    queries = []
+    for doc in rng.sample(docs, min(n_queries, len(docs))):
+        start = rng.randrange(max(len(doc) - 40, 1))
+        queries.append(doc[start:start + 40])
+    return queries
+
+def top_k(query_vecs, doc_vecs, k):
+    q = query_vecs / np.linalg.norm(query_vecs, axis=1, keepdims=True)
+    d = doc_vecs / np.linalg.norm(doc_vecs, axis=1, keepdims=True)
+    scores = q @ d.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+def recall_at_k(reference, candidate):
+    hits = [len(set(r) & set(c)) / len(r) for r, c in zip(reference, candidate)]
+    return float(np.mean(hits))
+
+def embed(backend, docs, queries):
+    model = load_embedding_model(config.EMBEDDING_MODEL_NAME, backend=backend, device="cpu", export_root=config.EMBEDDING_EXPORT_DIR)
+    engine = EmbeddingEngine(model, tokens_per_batch=config.EMBEDDING_TOKENS_PER_BATCH)
+    engine.encode(docs[:8])  # ウォームアップ
+    start = time.perf_counter()
+    doc_vecs = engine.encode(docs)
+    sec = time.perf_counter() - start
+    return doc_vecs, engine.encode(queries), len(docs) / sec
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_paths", nargs="+")
+    parser.add_argument("--backends", nargs="+", default=["onnx", "onnx-int8"], choices=BACKENDS)
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--min-recall", type=float, default=0.9)
+    args = parser.parse_args()
+
+    docs = sample_chunks(args.csv_paths, args.docs)
+    queries = make_queries(docs, args.queries)
+    print(f"📦 チャンク {len(docs)} 件 / クエリ {len(queries)} 件")
+
+    ref_docs, ref_queries, ref_speed = embed("torch", docs, queries)
+    reference = top_k(ref_queries, ref_docs, args.k)
+    print(f"torch (fp32)  : {ref_speed:,.1f} chunks/s")
+
+    failed = False
+    for backend in args.backends:
+        doc_vecs, query_vecs, speed = embed(backend, docs, queries)
+        recall = recall_at_k(reference, top_k(query_vecs, doc_vecs, args.k))
+        status = "✅" if recall >= args.min_recall else "❌"
+        failed |= recall < args.min_recall
+        print(f"{backend:<13} : {speed:,.1f} chunks/s ({speed / ref_speed:.2f}x), recall@{args.k} = {recall:.3f} {status}")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,114 @@
+# config.py
+# 環境変数で上書きできる設定値
+import os
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+# 埋め込みモデル
+EMBEDDING_MODEL_NAME = os.getenv("REKIPEDIA_EMBEDDING_MODEL", "intfloat/multilingual-e5-base")
+# 推論バックエンド: torch / torch-int8 / onnx / onnx-int8（embedding_backends.py 参照）
+EMBEDDING_BACKEND = os.getenv("REKIPEDIA_EMBEDDING_BACKEND", "torch")
+# ONNX に書き出したモデルの保存先
+EMBEDDING_EXPORT_DIR = os.getenv("REKIPEDIA_EMBEDDING_EXPORT_DIR", "./models")
+
+# ChromaDB の保存先
+CHROMA_PATH = os.getenv("REKIPEDIA_CHROMA_PATH", "./chroma_db")
+
+# 埋め込みキャッシュ（SQLite + メモリ上の LRU）
+EMBEDDING_CACHE_ENABLED = _env_bool("REKIPEDIA_EMBEDDING_CACHE", True)
+EMBEDDING_CACHE_PATH = os.getenv("REKIPEDIA_EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite3")
+EMBEDDING_CACHE_MEMORY_SIZE = _env_int("REKIPEDIA_EMBEDDING_CACHE_MEMORY_SIZE", 20000)
+
+# 取り込みジョブを同時に実行するワーカー数
+INGEST_WORKERS = _env_int("REKIPEDIA_INGEST_WORKERS", 1)
+
+# 埋め込み計算: プロセス数（1 ならプールなし）、各プロセスのデバイス（カンマ区切り、指定時はプロセス数より優先）
+EMBEDDING_PROCESSES = _env_int("REKIPEDIA_EMBEDDING_PROCESSES", 1)
+EMBEDDING_DEVICES = [d.strip() for d in os.getenv("REKIPEDIA_EMBEDDING_DEVICES", "").split(",") if d.strip()]
+# 1バッチあたりのパディング込みトークン数の上限（トークン長でバケット分けしてバッチサイズを自動調整する）
+EMBEDDING_TOKENS_PER_BATCH = _env_int("REKIPEDIA_EMBEDDING_TOKENS_PER_BATCH", 16384)
+# 埋め込みと ChromaDB 書き込みを重ねる際のキューの長さ
+INGEST_WRITE_QUEUE_SIZE = _env_int("REKIPEDIA_INGEST_WRITE_QUEUE_SIZE", 4)
+# 埋め込み時の最大トークン数（0 ならモデルの既定値。超えた分は切り詰める）
+EMBEDDING_MAX_TOKENS = _env_int("REKIPEDIA_EMBEDDING_MAX_TOKENS", 0)
+
+# app.py 起動時にバックグラウンドでモデル・ChromaDB を読み込んでおくか
+WARMUP_ON_START = _env_bool("REKIPEDIA_WARMUP_ON_START", True)
+
+# 質問分類: キャッシュ件数、最近傍セントロイドで決める類似度差のしきい値（下回れば LLM に聞く）
+CLASSIFIER_CACHE_SIZE = _env_int("REKIPEDIA_CLASSIFIER_CACHE_SIZE", 2000)
+CLASSIFIER_CENTROID_MARGIN = float(os.getenv("REKIPEDIA_CLASSIFIER_CENTROID_MARGIN", "0.02"))
+
+# アップロードされたCSV（整形済み）の保存先
+CSV_DIR = os.getenv("REKIPEDIA_CSV_DIR", "csvs")
+# /ask で分類と検索を並行実行するスレッド数
+ASK_WORKERS = _env_int("REKIPEDIA_ASK_WORKERS", 8)
+
+# 回答キャッシュ: 同じ質問とみなす埋め込みのコサイン類似度、有効期間（秒）、保持件数
+ANSWER_CACHE_THRESHOLD = float(os.getenv("REKIPEDIA_ANSWER_CACHE_THRESHOLD", "0.97"))
+ANSWER_CACHE_TTL_SEC = _env_int("REKIPEDIA_ANSWER_CACHE_TTL_SEC", 3600)
+ANSWER_CACHE_MAX_ENTRIES = _env_int("REKIPEDIA_ANSWER_CACHE_MAX_ENTRIES", 5000)
+
+# analyze 用の型付きフレーム（Feather）の保存先と、メモリ上に置くフレームの合計バイト数の上限
+FRAME_STORE_DIR = os.getenv("REKIPEDIA_FRAME_STORE_DIR", os.path.join(CSV_DIR, ".frames"))
+FRAME_CACHE_MAX_BYTES = _env_int("REKIPEDIA_FRAME_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+
+# ハイブリッド検索: 転置インデックス（BM25）の保存先、埋め込み検索と併用するか、
+# それぞれから取る候補数（top_k の何倍か）、RRF の定数 k
+LEXICAL_INDEX_PATH = os.getenv("REKIPEDIA_LEXICAL_INDEX_PATH", "./lexical_index.sqlite3")
+HYBRID_SEARCH = _env_bool("REKIPEDIA_HYBRID_SEARCH", True)
+HYBRID_CANDIDATE_FACTOR = _env_int("REKIPEDIA_HYBRID_CANDIDATE_FACTOR", 4)
+RRF_K = _env_int("REKIPEDIA_RRF_K", 60)
+
+# 質問中の日付・会社名でチャンクのメタデータを絞り込んでから検索するか
+QUERY_FILTERS = _env_bool("REKIPEDIA_QUERY_FILTERS", True)
+
+# バッチで回答を生成するときに同時に投げる OpenAI へのリクエスト数
+BATCH_ANSWER_CONCURRENCY = _env_int("REKIPEDIA_BATCH_ANSWER_CONCURRENCY", 8)
+
+# analyze の質問をまず実行計画（LLM 1回 + pandas）で答えるか（答えられなければ Pandas Agent を使う）
+ANALYZE_QUERY_PLAN = _env_bool("REKIPEDIA_ANALYZE_QUERY_PLAN", True)
+
+# 回答生成に渡すコンテキスト（検索結果）のトークン数の上限（0 なら無制限）
+CONTEXT_TOKEN_BUDGET = _env_int("REKIPEDIA_CONTEXT_TOKEN_BUDGET", 1500)
+
+# ChromaDB の HNSW インデックスの設定（コレクションを作るときだけ反映される。変えるときは作り直す）
+#   space: l2 / ip / cosine, M: 各ノードのリンク数, ef_construction / ef_search: 構築時・検索時の探索幅
+CHROMA_HNSW_SPACE = os.getenv("REKIPEDIA_HNSW_SPACE", "l2")
+CHROMA_HNSW_M = _env_int("REKIPEDIA_HNSW_M", 16)
+CHROMA_HNSW_EF_CONSTRUCTION = _env_int("REKIPEDIA_HNSW_EF_CONSTRUCTION", 100)
+CHROMA_HNSW_EF_SEARCH = _env_int("REKIPEDIA_HNSW_EF_SEARCH", 100)
+
+# ベクトル検索のバックエンド: chroma / faiss（faiss は vector_store.py。本文・メタデータは ChromaDB から取る）
+VECTOR_BACKEND = os.getenv("REKIPEDIA_VECTOR_BACKEND", "chroma")
+VECTOR_INDEX_PATH = os.getenv("REKIPEDIA_VECTOR_INDEX_PATH", "./vector_index")
+VECTOR_INDEX_FACTORY = os.getenv("REKIPEDIA_VECTOR_INDEX_FACTORY", "HNSW32,SQ8")
+VECTOR_INDEX_EF_SEARCH = _env_int("REKIPEDIA_VECTOR_INDEX_EF_SEARCH", 64)
+VECTOR_INDEX_NPROBE = _env_int("REKIPEDIA_VECTOR_INDEX_NPROBE", 16)
+VECTOR_INDEX_MMAP = _env_bool("REKIPEDIA_VECTOR_INDEX_MMAP", False)
+
+# チャンクを入れるコレクションの構成: single（全ファイルで1つ）/ sharded（ファイルごとに1つ。検索は並行して各コレクションを引く）
+# ファイルの一覧（source_catalog.py）の保存先と、分割したコレクションを並行して検索するスレッド数
+COLLECTION_LAYOUT = os.getenv("REKIPEDIA_COLLECTION_LAYOUT", "single")
+SOURCE_CATALOG_PATH = os.getenv("REKIPEDIA_SOURCE_CATALOG_PATH", "./source_catalog.sqlite3")
+SHARD_SEARCH_WORKERS = _env_int("REKIPEDIA_SHARD_SEARCH_WORKERS", 8)
+
+# ログ: レベル、形式（text: "時刻 レベル 名前 メッセージ key=value" / json: 1行1オブジェクト）
+LOG_LEVEL = os.getenv("REKIPEDIA_LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("REKIPEDIA_LOG_FORMAT", "text")
+# 取り込みの進捗をログに出す間隔（秒）
+INGEST_PROGRESS_LOG_SEC = float(os.getenv("REKIPEDIA_INGEST_PROGRESS_LOG_SEC", "5"))
+
+# cProfile: リクエスト（/ask・アップロード）を確率 PROFILE_SAMPLE_RATE で計測する（0 なら計測しない）
+# PROFILE_ON_REQUEST なら /ask?profile=1 などリクエストで指定したものも計測する。結果は PROFILE_DIR に .prof で保存
+PROFILE_SAMPLE_RATE = float(os.getenv("REKIPEDIA_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_ON_REQUEST = _env_bool("REKIPEDIA_PROFILE_ON_REQUEST", False)
+PROFILE_DIR = os.getenv("REKIPEDIA_PROFILE_DIR", "./profiles")
@@ -0,0 +1,168 @@
+# context_builder.py
+# 検索結果（hits）から回答生成に渡すコンテキストを組み立てる
+#   - 同じチャンク（空白を除いて同じ文字列、表の行なら同じ列名と値）は1回だけ入れる
+#     表の行は日付や金額が1つ違うだけでも別の行なので、似ているだけでは除かない
+#   - 自由記述の重なり（split_stream_with_overlap の overlap 部分）は同じ source の隣り合うチャンクをつなげて除く
+#   - 表の行は source ごとに「列名の行 + 値の行」にまとめ、行ごとに "列名: " を繰り返さない
+#   - トークン数の上限（budget）を超えない範囲で、検索順位の高いものから入れる
+import math
+from typing import List, Optional
+
+from lazy import singleton
+from processor import split_row_fields
+
+# 隣り合うチャンクの重なりとして探す最大文字数（チャンク化の overlap より少し長く）
+MAX_OVERLAP = 200
+SECTION_SEPARATOR = "\n---\n"
+
+@singleton
+def get_encoding():
+    """tiktoken があれば gpt-4o 系のトークナイザーを使う（無ければ None で概算）"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 概算: 日本語は1文字1トークン程度、英数字は4文字で1トークン程度
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return len(text) - ascii_chars + math.ceil(ascii_chars / 4)
+
+def fingerprint(text: str) -> str:
+    """空白の違いだけのチャンクを同じとみなすためのキー"""
+    return " ".join(text.split())
+
+def overlap_length(left: str, right: str, max_overlap: int = MAX_OVERLAP) -> int:
+    """left の末尾と right の先頭が一致する最長の文字数"""
+    for n in range(min(len(left), len(right), max_overlap), 0, -1):
+        if left.endswith(right[:n]):
+            return n
+    return 0
+
+def as_table_row(text: str) -> Optional[list]:
+    """"列名: 値 / 列名: 値" 形式の行チャンクなら (列名, 値) のリスト、そうでなければ None"""
+    fields = split_row_fields(text)
+    if len(fields) >= 2 and len(fields) == len(text.split(" / ")):
+        return fields
+    return None
+
+class Section:
+    """コンテキストの1ブロック（source ごとの表、または自由記述の連続したチャンク）"""
+    def __init__(self, source):
+        self.source = source
+        self.columns = []
+        self.rows = []
+        self.texts = []
+        self.first_row_index = None
+        self.last_row_index = None
+
+    def add_row(self, fields):
+        for name, _ in fields:
+            if name not in self.columns:
+                self.columns.append(name)
+        self.rows.append(dict(fields))
+
+    def add_text(self, text, row_index):
+        """隣り合うチャンク（row_index が前後）なら重なりを除いてつなげる。つなげられなければ False"""
+        if not self.texts:
+            self.texts.append(text)
+        elif row_index is None or self.last_row_index is None:
+            return False
+        elif row_index == self.last_row_index + 1:
+            self.texts.append(text[overlap_length(self.texts[-1], text):])
+        elif row_index == self.first_row_index - 1:
+            self.texts.insert(0, text[:len(text) - overlap_length(text, self.texts[0])])
+        else:
+            return False
+        self.first_row_index = row_index if self.first_row_index is None else min(self.first_row_index, row_index)
+        self.last_row_index = row_index if self.last_row_index is None else max(self.last_row_index, row_index)
+        return True
+
+    def render(self, n_rows=None, n_chars=None) -> str:
+        title = f"【{self.source}】\n" if self.source else ""
+        if self.rows:
+            rows = self.rows if n_rows is None else self.rows[:n_rows]
+            lines = [" | ".join(self.columns)]
+            lines += [" | ".join(row.get(name, "") for name in self.columns) for row in rows]
+            return title + "\n".join(lines)
+        return title + "".join(self.texts)[:n_chars]
+
+def build_context(hits: List[dict], token_budget: Optional[int] = None) -> dict:
+    """
+    :param hits: query_documents の結果（順位順）
+    :param token_budget: コンテキストのトークン数の上限（None なら無制限）
+    :return: {"text", "tokens", "raw_tokens"（従来どおり全件をつなげた場合）, "saved_tokens", "hits_used", "hits_dropped"}
+    """
+    raw_tokens = count_tokens(SECTION_SEPARATOR.join(hit["document"] for hit in hits))
+
+    sections = []
+    table_sections = {}
+    text_sections = {}
+    seen = set()
+    hits_used = 0
+    hits_dropped = 0
+    for hit in hits:
+        document = hit["document"]
+        metadata = hit.get("metadata") or {}
+        source = metadata.get("source")
+        row_index = metadata.get("row_index")
+
+        fields = as_table_row(document)
+        key = ("row", frozenset((name.strip(), value.strip()) for name, value in fields)) if fields is not None else ("text", fingerprint(document))
+        if key in seen:
+            hits_dropped += 1
+            continue
+        seen.add(key)
+
+        if fields is not None:
+            section = table_sections.get(source)
+            if section is None:
+                section = table_sections[source] = Section(source)
+                sections.append(section)
+            section.add_row(fields)
+        else:
+            # 同じ source の隣り合うチャンクは重なりを除いてつなげる
+            candidates = text_sections.setdefault(source, [])
+            if not any(section.add_text(document, row_index) for section in candidates):
+                section = Section(source)
+                section.add_text(document, row_index)
+                candidates.append(section)
+                sections.append(section)
+        hits_used += 1
+
+    text, tokens = _fit_budget(sections, token_budget)
+    return {
+        "text": text,
+        "tokens": tokens,
+        "raw_tokens": raw_tokens,
+        "saved_tokens": raw_tokens - tokens,
+        "hits_used": hits_used,
+        "hits_dropped": hits_dropped,
+    }
+
+def _fit_budget(sections: List[Section], token_budget: Optional[int]):
+    """順位の高い section から上限まで入れる"""
+    parts = []
+    tokens = 0
+    for section in sections:
+        rendered = section.render()
+        cost = count_tokens(rendered) + (count_tokens(SECTION_SEPARATOR) if parts else 0)
+        if token_budget is None or tokens + cost <= token_budget:
+            parts.append(rendered)
+            tokens += cost
+            continue
+        # 入りきらない section は、表なら入る行数まで、自由記述なら入る文字数まで減らして終わる
+        sizes = range(len(section.rows) - 1, 0, -1) if section.rows else range(len(rendered) * (token_budget - tokens) // cost, 0, -50)
+        for size in sizes:
+            rendered = section.render(n_rows=size) if section.rows else section.render(n_chars=size)
+            cost = count_tokens(rendered) + (count_tokens(SECTION_SEPARATOR) if parts else 0)
+            if tokens + cost <= token_budget:
+                parts.append(rendered)
+                tokens += cost
+                break
+        break
+    return SECTION_SEPARATOR.join(parts), tokens
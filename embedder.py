@@ -1,70 +1,532 @@
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from chromadb import PersistentClient
-from chromadb.config import Settings
-from chromadb.utils.embedding_functions import EmbeddingFunction
-from typing import List, Generator
+from typing import List, Generator, Iterable, Union, Dict, Protocol
+from itertools import islice
 import os
-import torch
-from tqdm import tqdm
-from processor import process_csv_file
+import hashlib
+import threading
+import time
+import numpy as np
+from processor import process_csv_file, extract_row_fields
+from embedding_cache import EmbeddingCache, embed_with_cache
+from lexical_index import LexicalIndex
+from source_catalog import SourceCatalog
+from embedding_engine import EmbeddingEngine, CollectionWriter, close_writers
+from embedding_backends import load_embedding_model, cache_model_name
+from lazy import singleton
+from instrumentation import get_logger, timed, timed_iter
+import config
 
-# SentenceTransformer モデル
-model = SentenceTransformer("intfloat/multilingual-e5-base", device="cuda" if torch.cuda.is_available() else "cpu")
+log = get_logger("embedder")
+
+# SentenceTransformer モデル（初回利用時に読み込む）
+@singleton
+def get_model():
+	import torch
+	model = load_embedding_model(
+		config.EMBEDDING_MODEL_NAME,
+		backend=config.EMBEDDING_BACKEND,
+		device="cuda" if torch.cuda.is_available() else "cpu",
+		export_root=config.EMBEDDING_EXPORT_DIR,
+	)
+	if config.EMBEDDING_MAX_TOKENS:
+		# これより長いチャンクはトークン単位で切り詰める（長さ順のバッチ分けもこの長さで計算する）
+		model.max_seq_length = config.EMBEDDING_MAX_TOKENS
+	return model
+
+@singleton
+def get_embedding_engine() -> EmbeddingEngine:
+	return EmbeddingEngine(
+		get_model(),
+		processes=config.EMBEDDING_PROCESSES,
+		devices=config.EMBEDDING_DEVICES,
+		tokens_per_batch=config.EMBEDDING_TOKENS_PER_BATCH,
+	)
+
+# ChromaDB の EmbeddingFunction と同じ形（__call__(self, input)）
+# chromadb を import すると起動が遅くなるので、基底クラスは使わずここで型だけ定義する（get_client と同じく chromadb は使うときに読む）
+class EmbeddingFunction(Protocol):
+	def __call__(self, input: List[str]) -> List[List[float]]: ...
 
 # ChromaDB 用 EmbeddingFunction の定義
-class SentenceTransformerEmbeddingFunction(EmbeddingFunction):
+class SentenceTransformerEmbeddingFunction:
+	def __call__(self, input: List[str]) -> List[List[float]]:
+		# キャッシュに無かったテキストだけがここに来る（モデルでの埋め込みの時間）
+		with timed("embed_model"):
+			return get_embedding_engine().encode(input).tolist()
+
+# 埋め込みキャッシュを挟んだ EmbeddingFunction（アップロード・検索・ファイル選択すべてこれを通す）
+class CachedEmbeddingFunction:
+	def __init__(self, base: EmbeddingFunction, model_name: str, cache: EmbeddingCache):
+		self.base = base
+		self.model_name = model_name
+		self.cache = cache
+
 	def __call__(self, input: List[str]) -> List[List[float]]:
-		return model.encode(input, convert_to_numpy=True, show_progress_bar=False).tolist()
+		with timed("embed"):
+			return embed_with_cache(self.cache, self.model_name, list(input), self.base)
 
-embedding_function = SentenceTransformerEmbeddingFunction()
+@singleton
+def get_embedding_cache() -> EmbeddingCache:
+	return EmbeddingCache(
+		path=config.EMBEDDING_CACHE_PATH if config.EMBEDDING_CACHE_ENABLED else None,
+		memory_size=config.EMBEDDING_CACHE_MEMORY_SIZE,
+	)
+
+@singleton
+def get_embedding_function() -> CachedEmbeddingFunction:
+	# モデル自体はキャッシュに無いテキストを初めて埋め込むときに読み込まれる
+	return CachedEmbeddingFunction(
+		SentenceTransformerEmbeddingFunction(),
+		cache_model_name(config.EMBEDDING_MODEL_NAME, config.EMBEDDING_BACKEND, config.EMBEDDING_MAX_TOKENS),
+		get_embedding_cache(),
+	)
+
+# キーワード検索用の転置インデックス（チャンクの登録・削除と同時に更新する）
+@singleton
+def get_lexical_index() -> LexicalIndex:
+	return LexicalIndex(config.LEXICAL_INDEX_PATH)
 
 # ChromaDB 初期化
-client = PersistentClient(path="./chroma_db")
-collection = client.get_or_create_collection(
-	name="rekipedia",
-	embedding_function=embedding_function,
-)
+@singleton
+def get_client():
+	from chromadb import PersistentClient
+	return PersistentClient(path=config.CHROMA_PATH)
+
+# 全ファイル共通のコレクション（config.COLLECTION_LAYOUT が "single" のとき使う）
+COLLECTION_NAME = "rekipedia"
+
+@singleton
+def get_collection():
+	# HNSW の設定は作成時だけ反映される（既存のコレクションは作り直さない限りそのまま）
+	return get_client().get_or_create_collection(
+		name=COLLECTION_NAME,
+		embedding_function=get_embedding_function(),
+		metadata=hnsw_metadata(),
+	)
+
+def hnsw_metadata(space=None, m=None, ef_construction=None, ef_search=None) -> dict:
+	return {
+		"hnsw:space": space or config.CHROMA_HNSW_SPACE,
+		"hnsw:M": m or config.CHROMA_HNSW_M,
+		"hnsw:construction_ef": ef_construction or config.CHROMA_HNSW_EF_CONSTRUCTION,
+		"hnsw:search_ef": ef_search or config.CHROMA_HNSW_EF_SEARCH,
+	}
+
+# ベクトル検索を FAISS で行う場合のインデックス（config.VECTOR_BACKEND が "faiss" のときだけ使う）
+@singleton
+def get_vector_store():
+	from vector_store import FaissVectorStore
+	return FaissVectorStore(
+		config.VECTOR_INDEX_PATH,
+		factory=config.VECTOR_INDEX_FACTORY,
+		space=config.CHROMA_HNSW_SPACE,
+		ef_search=config.VECTOR_INDEX_EF_SEARCH,
+		nprobe=config.VECTOR_INDEX_NPROBE,
+		mmap=config.VECTOR_INDEX_MMAP,
+	)
+
+# ファイル（source）ごとの代表ベクトル（チャンク埋め込みの平均）を入れるコレクション
+# ファイル選択はチャンクではなくこちらを検索する（ファイル数ぶんしかないので小さい）
+@singleton
+def get_source_collection():
+	return get_client().get_or_create_collection(
+		name="rekipedia_sources",
+		embedding_function=get_embedding_function(),
+		metadata={"hnsw:space": "cosine"},
+	)
+
+# 登録済みファイルの一覧（行数・チャンク数・内容のハッシュ・チャンクを入れたコレクション）
+@singleton
+def get_source_catalog() -> SourceCatalog:
+	return SourceCatalog(config.SOURCE_CATALOG_PATH)
+
+# config.COLLECTION_LAYOUT が "sharded" のとき、ファイルごとに作るコレクション（名前 -> コレクション）
+_shards = {}
+_shards_lock = threading.Lock()
+
+def is_sharded() -> bool:
+	return config.COLLECTION_LAYOUT == "sharded"
+
+def shard_name(source_id: str) -> str:
+	"""ファイルごとのコレクション名（ファイル名には ChromaDB のコレクション名に使えない文字もあるのでハッシュにする）"""
+	return "rekipedia_src_" + hashlib.sha1(source_id.encode("utf-8")).hexdigest()[:20]
+
+def chunk_collection_name(source_id: str) -> str:
+	return shard_name(source_id) if is_sharded() else COLLECTION_NAME
+
+def get_chunk_collection(source_id: str):
+	"""source_id のチャンクを入れるコレクション（single なら全ファイル共通の get_collection()）"""
+	if not is_sharded():
+		return get_collection()
+	name = shard_name(source_id)
+	collection = _shards.get(name)
+	if collection is None:
+		with _shards_lock:
+			collection = _shards.get(name)
+			if collection is None:
+				collection = _shards[name] = get_client().get_or_create_collection(
+					name=name,
+					embedding_function=get_embedding_function(),
+					metadata=hnsw_metadata(),
+				)
+	return collection
+
+def get_search_collections(sources=None) -> list:
+	"""
+	検索対象のコレクションのリスト
+	sharded ならファイル一覧（sources を指定すればそのうち登録済みのもの）のコレクション、single なら get_collection() だけ
+	"""
+	if not is_sharded():
+		return [get_collection()]
+	names = get_source_catalog().sources()
+	if sources:
+		sources = set(sources)
+		names = [name for name in names if name in sources]
+	return [get_chunk_collection(source_id) for source_id in names]
+
+def chunk_source(chunk_id: str) -> str:
+	"""チャンク id（iter_chunk_records の "{source}_{fingerprint}_{n}"）から source を取り出す"""
+	return chunk_id.rsplit("_", 2)[0]
+
+def get_chunks(ids: List[str], where=None, include=("documents", "metadatas")) -> dict:
+	"""id を指定してチャンクを取る（sharded なら source ごとのコレクションから取ってまとめる）"""
+	groups = {}
+	for chunk_id in ids:
+		collection = get_chunk_collection(chunk_source(chunk_id))
+		groups.setdefault(collection.name, (collection, []))[1].append(chunk_id)
+	result = {"ids": [], **{key: [] for key in include}}
+	for collection, group_ids in groups.values():
+		page = collection.get(ids=group_ids, where=where, include=list(include))
+		result["ids"].extend(page["ids"])
+		for key in include:
+			result[key].extend(page[key])
+	return result
+
+def iter_collection_pages(collection, include, page_size=5000):
+	"""collection の登録済みチャンクを page_size 件ずつ（collection.get の結果の形で）返す"""
+	offset = 0
+	while True:
+		page = collection.get(include=include, limit=page_size, offset=offset)
+		if len(page["ids"]) == 0:
+			return
+		yield page
+		if len(page["ids"]) < page_size:
+			return
+		offset += page_size
+
+def delete_source(source_id: str):
+	"""
+	ファイルのチャンクをすべて削除する（ファイルごとのコレクションに入っていればコレクションごと消す）
+	チャンクの置き場所はファイル一覧の記録を優先する（single のときに登録したファイルを sharded で消す場合など）
+	"""
+	entry = get_source_catalog().get(source_id)
+	name = entry["collection"] if entry else chunk_collection_name(source_id)
+	if name == COLLECTION_NAME:
+		ids = list(get_indexed_chunks(source_id, collection=get_collection()))
+		for batch in iter_batches(ids, 5000):
+			get_collection().delete(ids=batch)
+	else:
+		with _shards_lock:
+			collection = _shards.pop(name, None)
+			if collection is None:
+				try:
+					collection = get_client().get_collection(name=name)
+				except Exception:  # コレクションが作られていない
+					collection = None
+			ids = list(get_indexed_chunks(source_id, collection=collection)) if collection is not None else []
+			if collection is not None:
+				try:
+					get_client().delete_collection(name)
+				except Exception as e:
+					log.warning("⚠️ コレクションを削除できませんでした", extra={"source": source_id, "collection": name, "error": repr(e)})
+	for batch in iter_batches(ids, 5000):
+		get_lexical_index().delete(batch)
+		if config.VECTOR_BACKEND == "faiss":
+			get_vector_store().delete(batch)
+	if config.VECTOR_BACKEND == "faiss" and get_vector_store().is_ready:
+		get_vector_store().save()
+	update_source_summary(source_id, None, 0, "")
+	get_source_catalog().delete(source_id)
+	log.info("🗑️ ファイルのチャンクを削除しました", extra={"source": source_id, "chunks": len(ids)})
+	return len(ids)
+
+def warm_up():
+	"""モデル・ChromaDB を先に読み込んでおく（起動直後の最初のリクエストを待たせないため）"""
+	get_search_collections()
+	get_source_collection()
+	get_embedding_engine().encode(["warm up"])
+	log.info("🔥 埋め込みモデル・ChromaDB の準備完了")
 
 def show_gpu_info():
+	import torch
 	if torch.cuda.is_available():
-		print(f"🚀 GPU 使用中: {torch.cuda.get_device_name(0)}")
+		log.info("🚀 GPU 使用中", extra={"device": torch.cuda.get_device_name(0)})
 	else:
-		print("⚠️ GPU が使用されていません（CPUモードで実行中）")
+		log.info("⚠️ GPU が使用されていません（CPUモードで実行中）", extra={"backend": config.EMBEDDING_BACKEND})
+
+def send_progress(progress, socketio, room=None):
+	if socketio is None:
+		return
+	socketio.emit('progress', {'data': progress}, to=room)
+
+def iter_batches(items: Iterable, batch_size: int) -> Generator[list, None, None]:
+	iterator = iter(items)
+	while True:
+		batch = list(islice(iterator, batch_size))
+		if not batch:
+			return
+		yield batch
+
+def chunk_fingerprint(text: str) -> str:
+	return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def iter_chunk_records(chunks: Iterable[str], source_id: str):
+	"""
+	チャンクごとに (id, text, metadata) を返す
+	id は内容のフィンガープリント + 同一内容の出現回数なので、行の並びが変わっても同じ行は同じ id になる
+	metadata には検索の絞り込み用に日付・金額・会社名（processor.extract_row_fields）も入れる
+	"""
+	occurrences = {}
+	for row_index, text in enumerate(chunks):
+		fingerprint = chunk_fingerprint(text)
+		n = occurrences.get(fingerprint, 0)
+		occurrences[fingerprint] = n + 1
+		chunk_id = f"{source_id}_{fingerprint}_{n}"
+		metadata = {"source": source_id, "row_index": row_index, "fingerprint": fingerprint}
+		metadata.update(extract_row_fields(text))
+		yield chunk_id, text, metadata
+
+def get_indexed_chunks(source_id: str, page_size=10000, collection=None) -> Dict[str, dict]:
+	"""source が source_id の登録済みチャンクの {id: metadata} を返す（collection を省略すれば get_chunk_collection から）"""
+	collection = collection if collection is not None else get_chunk_collection(source_id)
+	indexed = {}
+	offset = 0
+	while True:
+		page = collection.get(where={"source": source_id}, include=["metadatas"], limit=page_size, offset=offset)
+		for chunk_id, metadata in zip(page["ids"], page["metadatas"]):
+			indexed[chunk_id] = metadata or {}
+		if len(page["ids"]) < page_size:
+			return indexed
+		offset += page_size
+
+# ファイル索引に代表テキストとして残す先頭チャンクの文字数
+SOURCE_SUMMARY_CHARS = 1000
 
-def send_progress(progress, socketio):
-	socketio.emit('progress', {'data': progress})
+def normalize_rows(vectors) -> np.ndarray:
+	vectors = np.asarray(vectors, dtype=np.float32)
+	return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+def sum_indexed_embeddings(collection, ids: List[str], page_size=5000):
+	"""登録済みチャンクの（正規化した）埋め込みの和"""
+	total = None
+	for batch in iter_batches(ids, page_size):
+		page = collection.get(ids=batch, include=["embeddings"])
+		if len(page["embeddings"]) == 0:
+			continue
+		vector_sum = normalize_rows(page["embeddings"]).sum(axis=0)
+		total = vector_sum if total is None else total + vector_sum
+	return total
+
+def update_source_summary(source_id: str, vector_sum, count: int, summary: str):
+	"""
+	ファイルの代表ベクトル（チャンク埋め込みの平均）を source コレクションに登録する
+	チャンクが無くなったファイルは削除する
+	"""
+	if count == 0 or vector_sum is None:
+		get_source_collection().delete(ids=[source_id])
+		return
+	centroid = vector_sum / (np.linalg.norm(vector_sum) or 1.0)
+	get_source_collection().upsert(
+		ids=[source_id],
+		embeddings=[centroid.tolist()],
+		documents=[summary],
+		metadatas=[{"source": source_id, "chunks": count}],
+	)
+
+def rebuild_source_index(page_size=5000):
+	"""
+	登録済みの全チャンクから source コレクションとファイル一覧を作り直す
+	（source コレクション・ファイル一覧を導入する前に登録したファイルの移行用）
+	"""
+	sums, counts, summaries, collections = {}, {}, {}, {}
+	for collection in get_search_collections():
+		for page in iter_collection_pages(collection, ["embeddings", "metadatas", "documents"], page_size):
+			vectors = normalize_rows(page["embeddings"])
+			for vector, metadata, document in zip(vectors, page["metadatas"], page["documents"]):
+				source_id = (metadata or {}).get("source")
+				if source_id is None:
+					continue
+				sums[source_id] = sums[source_id] + vector if source_id in sums else vector.copy()
+				counts[source_id] = counts.get(source_id, 0) + 1
+				collections[source_id] = collection.name
+				row_index = metadata.get("row_index", 0)
+				if source_id not in summaries or row_index < summaries[source_id][0]:
+					summaries[source_id] = (row_index, document)
+
+	catalog = get_source_catalog()
+	for source_id in sums:
+		update_source_summary(source_id, sums[source_id], counts[source_id], summaries[source_id][1][:SOURCE_SUMMARY_CHARS])
+		entry = catalog.get(source_id) or {}
+		catalog.upsert(source_id, collections[source_id], counts[source_id], rows=entry.get("rows"), content_hash=entry.get("content_hash"))
+	log.info("🗂️ ファイル索引を再作成", extra={"files": len(sums)})
+	return counts
+
+def rebuild_lexical_index(page_size=5000):
+	"""登録済みの全チャンクから転置インデックスを作り直す（転置インデックスを導入する前に登録したチャンクの移行用）"""
+	lexical_index = get_lexical_index()
+	for collection in get_search_collections():
+		for page in iter_collection_pages(collection, ["metadatas", "documents"], page_size):
+			lexical_index.add(
+				(chunk_id, document, (metadata or {}).get("source"))
+				for chunk_id, document, metadata in zip(page["ids"], page["documents"], page["metadatas"])
+			)
+			lexical_index.add_entities("company", [
+				(chunk_id, metadata["company"]) for chunk_id, metadata in zip(page["ids"], page["metadatas"]) if metadata and "company" in metadata
+			])
+	log.info("🔤 転置インデックスを再作成", extra=lexical_index.stats())
+
+def migrate_to_shards(page_size=5000):
+	"""
+	全ファイル共通のコレクション（single）に登録済みのチャンクを、埋め込みを再計算せずにファイルごとのコレクションへ移す
+	config.COLLECTION_LAYOUT を "sharded" にしてから実行する
+	"""
+	if not is_sharded():
+		raise RuntimeError("config.COLLECTION_LAYOUT が sharded ではありません（REKIPEDIA_COLLECTION_LAYOUT=sharded）")
+	collection = get_collection()
+	moved = {}
+	for page in iter_collection_pages(collection, ["embeddings", "metadatas", "documents"], page_size):
+		groups = {}
+		for record in zip(page["ids"], page["embeddings"], page["metadatas"], page["documents"]):
+			groups.setdefault((record[2] or {}).get("source") or chunk_source(record[0]), []).append(record)
+		for source_id, records in groups.items():
+			ids, embeddings, metadatas, documents = map(list, zip(*records))
+			get_chunk_collection(source_id).upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+			moved[source_id] = moved.get(source_id, 0) + len(ids)
+
+	catalog = get_source_catalog()
+	for source_id, count in moved.items():
+		entry = catalog.get(source_id) or {}
+		catalog.upsert(source_id, shard_name(source_id), count, rows=entry.get("rows"), content_hash=entry.get("content_hash"))
+	get_client().delete_collection(collection.name)
+	log.info("🧩 ファイルごとのコレクションに移しました", extra={"chunks": sum(moved.values()), "files": len(moved)})
+	return moved
 
 # チャンクをバッチでベクトル化・ChromaDBへ登録
-def add_chunks_to_chroma_streaming(df: pd.DataFrame, source_id: str, socketio, batch_size=128):
+# chunks はチャンク文字列のイテラブル（ジェネレータ可）。DataFrame を渡した場合は process_csv_file で分割する
+# total が分からない場合（ストリーミング時）の進捗は呼び出し側で送る
+# 同じ source の登録済みチャンクと差分を取り、新規・変更分だけ埋め込んで upsert、消えた分は delete する
+# on_batch: バッチごとに処理済みチャンク数を受け取るコールバック（ジョブの進捗更新用）
+# batch_size を省略すると埋め込みエンジンのプロセス数に応じた件数ずつ処理する
+# ChromaDB・転置インデックスへの書き込みは CollectionWriter で次のバッチの埋め込みと並行して行う
+# 登録後、ファイルの代表ベクトル（ファイル選択用）とファイル一覧（rows: CSV の行数, content_hash: ファイルのハッシュ）も更新する
+# config.COLLECTION_LAYOUT が "sharded" ならファイルごとのコレクションに登録する
+def add_chunks_to_chroma_streaming(chunks: Union[pd.DataFrame, Iterable[str]], source_id: str, socketio, batch_size=None, total=None, on_batch=None, rows=None, content_hash=None):
 	show_gpu_info()
 
-	resume_file = f".resume_{source_id}.txt"
+	if isinstance(chunks, pd.DataFrame):
+		chunks = process_csv_file(chunks)
+	if total is None and hasattr(chunks, "__len__"):
+		total = len(chunks)
+	if total is not None:
+		log.info("📦 処理対象チャンク数", extra={"source": source_id, "total": total})
+
+	indexed = get_indexed_chunks(source_id)
+	if indexed:
+		log.info("🔁 登録済みのチャンクと差分を取って更新", extra={"source": source_id, "indexed": len(indexed)})
+
+	seen = set()
+	# 代表ベクトル用: 新規チャンクの埋め込みの和と、既存のまま残るチャンクの id
+	vector_sum = None
+	kept_ids = []
+	summary = ""
+	stats = {"added": 0, "moved": 0, "unchanged": 0, "removed": 0}
 	processed_count = 0
 
-	if os.path.exists(resume_file):
-		with open(resume_file, "r") as f:
-			processed_count = int(f.read().strip())
-		print(f"🔁 {processed_count}件目から再開")
+	collection = get_chunk_collection(source_id)
+	embedding_function = get_embedding_function()
+	embedding_engine = get_embedding_engine()
+	writer = CollectionWriter(collection, max_pending=config.INGEST_WRITE_QUEUE_SIZE, name="chroma")
+	lexical_index = get_lexical_index()
+	lexical_writer = CollectionWriter(lexical_index, max_pending=config.INGEST_WRITE_QUEUE_SIZE, name="lexical")
+	vector_store = get_vector_store() if config.VECTOR_BACKEND == "faiss" else None
+	started = last_log = time.perf_counter()
+	try:
+		batches = iter_batches(iter_chunk_records(chunks, source_id), batch_size or embedding_engine.window_size)
+		# 1バッチ分の CSV の読み込み・チャンク化にかかった時間も測る
+		for batch in timed_iter("ingest_chunk", batches):
+			new_records = [r for r in batch if r[0] not in indexed]
+			moved_records = [r for r in batch if r[0] in indexed and indexed[r[0]] != r[2]]
 
-	total_chunks = process_csv_file(df)
-	total = len(total_chunks)  # リストの長さを取得
-	print(f"📦 処理対象チャンク数: {total}")
+			if new_records:
+				ids, documents, metadatas = map(list, zip(*new_records))
+				batch_embeddings = embedding_function(documents)
+				new_sum = normalize_rows(batch_embeddings).sum(axis=0)
+				vector_sum = new_sum if vector_sum is None else vector_sum + new_sum
+				writer.submit("upsert", documents=documents, ids=ids, embeddings=batch_embeddings, metadatas=metadatas)
+				lexical_writer.submit("add", records=[(r[0], r[1], source_id) for r in new_records])
+				if vector_store is not None:
+					vector_store.add(ids, batch_embeddings, [source_id] * len(ids))
+				lexical_writer.submit("add_entities", kind="company", items=[(chunk_id, m["company"]) for chunk_id, m in zip(ids, metadatas) if "company" in m])
+			if moved_records:
+				# 内容が同じで位置（や抽出フィールド）だけ変わった行はメタデータだけ更新する（再埋め込みしない）
+				writer.submit("update", ids=[r[0] for r in moved_records], metadatas=[r[2] for r in moved_records])
 
-	with tqdm(total=total - processed_count, desc="🔄 登録中", ncols=80) as pbar:
-		for i in range(processed_count, total, batch_size):
-			batch = total_chunks[i:i + batch_size]  # 修正
-			batch_ids = [f"{source_id}_{j}" for j in range(i, i + len(batch))]
-			batch_embeddings = embedding_function(batch)
-			collection.add(documents=batch, ids=batch_ids, embeddings=batch_embeddings, metadatas=[{"source": source_id, "row_index": i} for i in range(len(batch))])
+			seen.update(r[0] for r in batch)
+			kept_ids.extend(r[0] for r in batch if r[0] in indexed)
+			if processed_count == 0:
+				summary = batch[0][1][:SOURCE_SUMMARY_CHARS]
+			stats["added"] += len(new_records)
+			stats["moved"] += len(moved_records)
+			stats["unchanged"] += len(batch) - len(new_records) - len(moved_records)
 
 			processed_count += len(batch)
-			progress = (processed_count / total) * 100
-			send_progress(progress, socketio)
+			if total:
+				progress = (processed_count / total) * 100
+				send_progress(progress, socketio)
+			if on_batch is not None:
+				on_batch(processed_count)
+			now = time.perf_counter()
+			if now - last_log >= config.INGEST_PROGRESS_LOG_SEC:
+				last_log = now
+				log.info("🔄 登録中", extra={"source": source_id, "processed": processed_count, "total": total, "chunks_per_sec": round(processed_count / (now - started), 1)})
+	except BaseException:
+		# 登録中の例外を優先する（書き込みスレッドは終了を待つが、close の例外で元の例外を置き換えない）
+		close_writers(writer, lexical_writer, raise_error=False)
+		raise
+	close_writers(writer, lexical_writer)
 
-			with open(resume_file, "w") as f:
-				f.write(str(processed_count))
+	removed_ids = [chunk_id for chunk_id in indexed if chunk_id not in seen]
+	for batch in iter_batches(removed_ids, 5000):
+		collection.delete(ids=batch)
+		lexical_index.delete(batch)
+		if vector_store is not None:
+			vector_store.delete(batch)
+	stats["removed"] = len(removed_ids)
 
-			pbar.update(len(batch))
+	if kept_ids:
+		kept_sum = sum_indexed_embeddings(collection, kept_ids)
+		if kept_sum is not None:
+			vector_sum = kept_sum if vector_sum is None else vector_sum + kept_sum
+	update_source_summary(source_id, vector_sum, processed_count, summary)
+	if processed_count:
+		get_source_catalog().upsert(source_id, collection.name, processed_count, rows=rows, content_hash=content_hash)
+	else:
+		get_source_catalog().delete(source_id)
+	if vector_store is not None:
+		if vector_store.is_ready:
+			vector_store.save()
+		else:
+			log.warning("⚠️ FAISS インデックスが未作成です（python vector_store.py build で作成）。それまでは ChromaDB で検索します")
 
-	print("✅ ChromaDBへの登録完了")
+	padding = embedding_engine.padding_stats()
+	log.info("✅ ChromaDBへの登録完了", extra={
+		"source": source_id,
+		"processed": processed_count,
+		**stats,
+		"seconds": round(time.perf_counter() - started, 2),
+		"embedding_cache": get_embedding_cache().stats(),
+		"padding_waste": round(padding["padding_waste"], 4),
+		"padding_batches": padding["batches"],
+		"truncated": padding["truncated"],
+	})
+	return stats
@@ -0,0 +1,80 @@
+# embedding_backends.py
+# 埋め込みモデルの推論バックエンド
+#   torch      : PyTorch fp32（従来どおり）
+#   torch-int8 : PyTorch の Linear 層を int8 に動的量子化（CPU のみ）
+#   onnx       : ONNX Runtime fp32
+#   onnx-int8  : ONNX Runtime + int8 動的量子化
+# どれも SentenceTransformer として返すので、EmbeddingEngine / EmbeddingFunction からは同じように使える
+import os
+import platform
+
+from instrumentation import get_logger
+
+log = get_logger("embedding_backends")
+
+BACKENDS = ["torch", "torch-int8", "onnx", "onnx-int8"]
+
+def default_quantization_config() -> str:
+    """export_dynamic_quantized_onnx_model に渡す CPU 向けの量子化設定名"""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+        if "avx512_vnni" in flags:
+            return "avx512_vnni"
+        if "avx512" in flags:
+            return "avx512"
+    except OSError:
+        pass
+    return "avx2"
+
+def export_dir(model_name: str, export_root: str) -> str:
+    return os.path.join(export_root, model_name.replace("/", "__"))
+
+def load_embedding_model(model_name: str, backend: str = "torch", device: str = "cpu", export_root: str = "./models"):
+    """
+    バックエンドに応じた SentenceTransformer を返す
+    ONNX 系は初回に export_root 以下へ書き出し、2回目以降はそれを読み込む
+    """
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in BACKENDS:
+        raise ValueError(f"未対応の埋め込みバックエンドです: {backend}（{', '.join(BACKENDS)} のいずれか）")
+
+    if backend == "torch":
+        return SentenceTransformer(model_name, device=device)
+
+    if backend == "torch-int8":
+        import torch
+        model = SentenceTransformer(model_name, device="cpu")
+        model[0].auto_model = torch.quantization.quantize_dynamic(model[0].auto_model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    path = export_dir(model_name, export_root)
+    if not os.path.exists(os.path.join(path, "onnx", "model.onnx")):
+        log.info("📤 ONNX へ書き出し中", extra={"model": model_name, "path": path})
+        SentenceTransformer(model_name, backend="onnx", device="cpu").save_pretrained(path)
+
+    if backend == "onnx":
+        return SentenceTransformer(path, backend="onnx", device=device)
+
+    # onnx-int8
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    quantization = default_quantization_config()
+    file_name = f"model_qint8_{quantization}.onnx"
+    if not os.path.exists(os.path.join(path, "onnx", file_name)):
+        log.info("📤 int8 量子化モデルを書き出し中", extra={"quantization": quantization})
+        onnx_model = SentenceTransformer(path, backend="onnx", device="cpu")
+        export_dynamic_quantized_onnx_model(onnx_model, quantization, path)
+    return SentenceTransformer(path, backend="onnx", device=device, model_kwargs={"file_name": f"onnx/{file_name}"})
+
+def cache_model_name(model_name: str, backend: str, max_tokens: int = 0) -> str:
+    """
+    埋め込みキャッシュのキーに使うモデル名
+    バックエンドごとにベクトルが僅かに異なるので、torch 以外は別キーにする
+    max_tokens（max_seq_length を変えた場合）も長いテキストのベクトルが変わるので別キーにする（0 はモデルの既定値）
+    """
+    name = model_name if backend == "torch" else f"{model_name}#{backend}"
+    return f"{name}#max{max_tokens}" if max_tokens else name
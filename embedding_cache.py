@@ -0,0 +1,122 @@
+# embedding_cache.py
+# (モデル名, 正規化テキストのハッシュ) をキーにした埋め込みキャッシュ
+# メモリ上の LRU と SQLite の2段構成。同じ行の再アップロードや同じ質問の再埋め込みを省く
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# SQLite の IN 句に一度に渡すキー数
+_SQL_BATCH = 500
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", text).strip()
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    def __init__(self, path: Optional[str] = None, memory_size: int = 20000):
+        """
+        :param path: SQLite ファイルのパス（None ならメモリ上の LRU のみ）
+        :param memory_size: メモリ上に保持する埋め込みの件数
+        """
+        self.path = path
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " model TEXT NOT NULL, key TEXT NOT NULL, vector BLOB NOT NULL,"
+                " PRIMARY KEY (model, key))"
+            )
+            self._conn.commit()
+
+    def _remember(self, mem_key, vector):
+        self._memory[mem_key] = vector
+        self._memory.move_to_end(mem_key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model_name: str, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        """見つかったキーだけを {key: vector} で返す"""
+        found = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                vector = self._memory.get((model_name, key))
+                if vector is not None:
+                    self._memory.move_to_end((model_name, key))
+                    found[key] = vector
+                else:
+                    missing.append(key)
+            self.memory_hits += len(found)
+
+            if self._conn is not None and missing:
+                for i in range(0, len(missing), _SQL_BATCH):
+                    part = missing[i:i + _SQL_BATCH]
+                    rows = self._conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(part))})",
+                        [model_name, *part],
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        found[key] = vector
+                        self._remember((model_name, key), vector)
+                        self.disk_hits += 1
+
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, model_name: str, keys: Sequence[str], vectors: Sequence[np.ndarray]):
+        vectors = [np.asarray(v, dtype=np.float32) for v in vectors]
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._remember((model_name, key), vector)
+            if self._conn is not None:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, key, vector) VALUES (?, ?, ?)",
+                    [(model_name, key, vector.tobytes()) for key, vector in zip(keys, vectors)],
+                )
+                self._conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+def embed_with_cache(cache: EmbeddingCache, model_name: str, texts: List[str], embed) -> List[List[float]]:
+    """
+    キャッシュに無いテキストだけを embed(texts) -> 2次元配列 で埋め込み、元の順序で返す
+    バッチ内の重複テキストも1回だけ埋め込む
+    """
+    keys = [text_key(t) for t in texts]
+    found = cache.get_many(model_name, list(dict.fromkeys(keys)))
+
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in pending:
+            pending[key] = text
+    if pending:
+        vectors = np.asarray(embed(list(pending.values())), dtype=np.float32)
+        cache.put_many(model_name, list(pending.keys()), vectors)
+        found.update(zip(pending.keys(), vectors))
+
+    return [found[key].tolist() for key in keys]
@@ -0,0 +1,220 @@
+# embedding_engine.py
+# SentenceTransformer による埋め込み計算（マルチプロセスプール・トークン長でのバケット分けとバッチサイズ調整）
+# と、埋め込みと並行して ChromaDB へ書き込むライター
+import os
+import queue
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+from instrumentation import get_logger, timed
+
+log = get_logger("embedding_engine")
+
+class EmbeddingEngine:
+    def __init__(self, model, processes: int = 1, devices: Optional[List[str]] = None, tokens_per_batch: int = 16384,
+                 min_batch_size: int = 8, max_batch_size: int = 512, pool_min_texts: int = 256):
+        """
+        :param model: SentenceTransformer
+        :param processes: エンコードに使うプロセス数（1 ならプールを使わない）
+        :param devices: プールの各プロセスに割り当てるデバイス（"cuda:0", "cuda:1" など。指定時は processes より優先）
+        :param tokens_per_batch: 1バッチあたりのパディング込みトークン数の上限（バッチ内最大長からバッチサイズを決める）
+        :param pool_min_texts: これより少ない入力（検索クエリなど）はプールに送らずその場で計算する
+        """
+        self.model = model
+        self.devices = list(devices) if devices else None
+        self.processes = len(self.devices) if self.devices else max(1, processes)
+        self.tokens_per_batch = tokens_per_batch
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.pool_min_texts = pool_min_texts
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"batches": 0, "texts": 0, "tokens": 0, "padded_tokens": 0, "truncated": 0}
+        self.last_batch_waste = []
+
+    @property
+    def window_size(self) -> int:
+        """
+        取り込み時に一度に読み込んでエンコードに回すチャンク数
+        長さ順の並べ替えが効くように、1バッチより十分大きく取る
+        """
+        return 1024 if self.processes == 1 else 1024 * self.processes
+
+    def token_lengths(self, texts: List[str]) -> np.ndarray:
+        """max_seq_length で切り詰めた後のトークン数（特殊トークン込み）"""
+        encoded = self.model.tokenizer(
+            list(texts),
+            add_special_tokens=True,
+            truncation=True,
+            max_length=self.model.max_seq_length,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        return np.fromiter((len(ids) for ids in encoded["input_ids"]), dtype=int, count=len(texts))
+
+    def tuned_batch_size(self, lengths: np.ndarray) -> int:
+        if len(lengths) == 0:
+            return self.min_batch_size
+        batch_size = int(self.tokens_per_batch / max(float(np.mean(lengths)), 1.0))
+        return int(np.clip(batch_size, self.min_batch_size, self.max_batch_size))
+
+    def plan_batches(self, lengths: np.ndarray) -> List[np.ndarray]:
+        """
+        トークン長の降順に並べてバッチに区切る
+        パディング込みのトークン数（バッチ内最大長 × 件数）が tokens_per_batch を超えないようにする
+        """
+        order = np.argsort(-lengths, kind="stable")
+        batches = []
+        start = 0
+        while start < len(order):
+            longest = max(int(lengths[order[start]]), 1)
+            size = int(np.clip(self.tokens_per_batch // longest, self.min_batch_size, self.max_batch_size))
+            batches.append(order[start:start + size])
+            start += size
+        return batches
+
+    def encode(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        """
+        トークン長の近いもの同士でバッチを組んでエンコードし、入力順に戻して返す
+        batch_size を指定した場合は長さ順に並べたうえで固定件数ずつ区切る
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        lengths = self.token_lengths(texts)
+
+        if self.processes > 1 and len(texts) >= self.pool_min_texts:
+            # プールは受け取った順に chunk_size ずつ各プロセスへ配るので、長さ順に並べてから渡す
+            batch_size = batch_size or self.tuned_batch_size(lengths)
+            order = np.argsort(-lengths, kind="stable")
+            chunk_size = max(batch_size, -(-len(texts) // self.processes))
+            encoded = self.model.encode_multi_process([texts[i] for i in order], self._get_pool(), batch_size=batch_size, chunk_size=chunk_size)
+            batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+            embeddings = np.empty_like(encoded)
+            embeddings[order] = encoded
+        else:
+            if batch_size:
+                order = np.argsort(-lengths, kind="stable")
+                batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+            else:
+                batches = self.plan_batches(lengths)
+            embeddings = None
+            for batch in batches:
+                encoded = self.model.encode([texts[i] for i in batch], batch_size=len(batch), convert_to_numpy=True, show_progress_bar=False)
+                if embeddings is None:
+                    embeddings = np.empty((len(texts), encoded.shape[1]), dtype=encoded.dtype)
+                embeddings[batch] = encoded
+
+        self._record_padding([lengths[batch] for batch in batches])
+        return embeddings
+
+    def _record_padding(self, batch_lengths: List[np.ndarray]):
+        waste = []
+        with self._stats_lock:
+            for lengths in batch_lengths:
+                tokens = int(lengths.sum())
+                padded = int(lengths.max()) * len(lengths)
+                waste.append(1 - tokens / padded if padded else 0.0)
+                self._stats["batches"] += 1
+                self._stats["texts"] += len(lengths)
+                self._stats["tokens"] += tokens
+                self._stats["padded_tokens"] += padded
+                self._stats["truncated"] += int((lengths >= self.model.max_seq_length).sum())
+            self.last_batch_waste = waste
+
+    def padding_stats(self) -> dict:
+        """
+        これまでのエンコードのパディング状況
+        padding_waste は (パディング込みトークン数 - 実トークン数) / パディング込みトークン数
+        last_batch_waste は直近の encode 呼び出しのバッチごとの同じ比率
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats["padding_waste"] = 1 - stats["tokens"] / stats["padded_tokens"] if stats["padded_tokens"] else 0.0
+            stats["last_batch_waste"] = [round(w, 4) for w in self.last_batch_waste]
+        return stats
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # 各プロセスの演算スレッド数をコア数 / プロセス数に抑えてスレッドの奪い合いを防ぐ
+                threads = str(max(1, (os.cpu_count() or 1) // self.processes))
+                previous = os.environ.get("OMP_NUM_THREADS")
+                os.environ["OMP_NUM_THREADS"] = threads
+                try:
+                    devices = self.devices or [str(self.model.device)] * self.processes
+                    self._pool = self.model.start_multi_process_pool(target_devices=devices)
+                finally:
+                    if previous is None:
+                        os.environ.pop("OMP_NUM_THREADS", None)
+                    else:
+                        os.environ["OMP_NUM_THREADS"] = previous
+                log.info("🧵 埋め込みプロセスプール起動", extra={"processes": self.processes, "threads": int(threads)})
+            return self._pool
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self.model.stop_multi_process_pool(self._pool)
+                self._pool = None
+
+class CollectionWriter:
+    """
+    collection への書き込みを別スレッドで順に実行し、次のバッチの埋め込みと重ねる
+    キューの長さを max_pending に制限して、書き込みが遅いときはエンコード側を待たせる
+    """
+    def __init__(self, collection, max_pending=4, name="chroma"):
+        """name は計測（instrumentation）の段階名の接頭辞（"chroma_upsert" など）"""
+        self.collection = collection
+        self.name = name
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="chroma-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, method: str, **kwargs):
+        self._raise_if_failed()
+        self._queue.put((method, kwargs))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_if_failed()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            method, kwargs = item
+            try:
+                with timed(f"{self.name}_{method}"):
+                    getattr(self.collection, method)(**kwargs)
+            except Exception as e:
+                self._error = e
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+def close_writers(*writers, raise_error=True):
+    """
+    すべての CollectionWriter を閉じる（1つの close が失敗しても残りの書き込みは待って反映する）
+    raise_error なら最初の例外を投げる。False（別の例外の処理中）ならログに出すだけにして、元の例外を隠さない
+    """
+    first_error = None
+    for writer in writers:
+        try:
+            writer.close()
+        except Exception as e:
+            if first_error is None and raise_error:
+                first_error = e
+            else:
+                log.warning("⚠️ 書き込みの終了処理に失敗しました", extra={"writer": writer.name, "error": repr(e)})
+    if first_error is not None:
+        raise first_error
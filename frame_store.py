@@ -0,0 +1,233 @@
+# frame_store.py
+# analyze 用の DataFrame ストア
+# アップロード時に整形済みCSVを型付きの Feather（Arrow IPC, 非圧縮）に変換しておき、
+# 質問のたびに CSV をパースしない。表は Arrow のテーブルのまま持ち（Frame）、実行計画で使う列だけ pandas にする
+# よく使うものはメモリに読み込んだテーブルを LRU（サイズ上限つき）に置き、上限を超える大きなものはメモリマップで開く
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import pandas as pd
+
+import config
+from instrumentation import get_logger, timed
+
+log = get_logger("frame_store")
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.ipc as ipc
+except ImportError:  # pyarrow が無ければ従来どおり CSV を読む
+    pa = None
+
+DATE_PATTERN = re.compile(r"\d{4}[/-]\d{1,2}[/-]\d{1,2}")
+NUMBER_PATTERN = re.compile(r"-?\d+(\.\d+)?")
+# 金額表記から取り除く文字
+AMOUNT_NOISE = re.compile(r"[,，¥￥円\s]")
+
+def frame_path(csv_path: str) -> str:
+    return os.path.join(config.FRAME_STORE_DIR, os.path.basename(csv_path) + ".feather")
+
+def _column_kind(values: pd.Series):
+    """
+    1列分の値が "date" / "int" / "float" / "string" のどれか（値が無ければ None）
+    日付・数値にするのは空でない値がすべて読める場合だけ（読めない値を欠損にして消さない）。先頭が 0 の数字（コード類）は文字列のまま
+    """
+    values = values.dropna().astype(str).str.strip()
+    values = values[values != ""]
+    if values.empty:
+        return None
+    if values.str.fullmatch(DATE_PATTERN).all() and _parse_dates(values).notna().all():
+        return "date"
+    amounts = values.str.replace(AMOUNT_NOISE, "", regex=True)
+    if not amounts.str.match(r"-?0\d").any() and amounts.str.fullmatch(NUMBER_PATTERN).all():
+        return "float" if amounts.str.contains(".", regex=False).any() else "int"
+    return "string"
+
+def merge_column_kind(a, b):
+    """チャンクごとの判定をまとめる（両方に合う型まで広げる: int → float → string）"""
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if {a, b} == {"int", "float"}:
+        return "float"
+    return "string"
+
+def infer_column_types(chunks) -> dict:
+    """文字列の DataFrame（のチャンク）すべてから、列ごとに "date" / "int" / "float" / "string" を判定する"""
+    kinds = {}
+    for chunk in chunks:
+        for col in chunk.columns:
+            kinds[col] = merge_column_kind(kinds.get(col), _column_kind(chunk[col]))
+    return {col: kind or "string" for col, kind in kinds.items()}
+
+def _parse_dates(values: pd.Series) -> pd.Series:
+    return pd.to_datetime(values.str.strip().str.replace("-", "/", regex=False), format="%Y/%m/%d", errors="coerce")
+
+def apply_column_types(df: pd.DataFrame, types: dict) -> pd.DataFrame:
+    """
+    infer_column_types の型に変換する
+    型に合わない値があれば（判定に使っていないデータなど）欠損にせず ValueError
+    """
+    df = df.copy()
+    for col, kind in types.items():
+        present = df[col].notna() & (df[col].astype(str).str.strip() != "")
+        if kind == "date":
+            converted = _parse_dates(df[col].astype(str))
+        elif kind in ("int", "float"):
+            converted = pd.to_numeric(df[col].astype(str).str.replace(AMOUNT_NOISE, "", regex=True), errors="coerce")
+        else:
+            df[col] = df[col].astype(object)
+            continue
+        lost = present & converted.isna()
+        if lost.any():
+            raise ValueError(f"列 {col} の値 {df[col][lost].iloc[0]!r} を {kind} に変換できません")
+        converted = converted.where(present)
+        df[col] = converted.astype("Int64") if kind == "int" else converted.astype("float64") if kind == "float" else converted
+    return df
+
+@timed("build_frame")
+def build_frame(csv_path: str, chunksize: int = 50000):
+    """
+    整形済みCSVを型付きの Feather に変換する
+    列の型は全チャンクを読んで決め（途中で小数や文字が出てくれば float・string に広げる）、2回目の読み込みで変換して書き出す
+    pyarrow が無い場合は何もしない
+    """
+    if pa is None:
+        return None
+    os.makedirs(config.FRAME_STORE_DIR, exist_ok=True)
+    path = frame_path(csv_path)
+    tmp_path = path + ".tmp"
+
+    types = infer_column_types(pd.read_csv(csv_path, dtype=str, chunksize=chunksize))
+    writer = None
+    schema = None
+    try:
+        for chunk in pd.read_csv(csv_path, dtype=str, chunksize=chunksize):
+            typed = apply_column_types(chunk, types)
+            if writer is None:
+                schema = pa.Schema.from_pandas(typed, preserve_index=False)
+                schema = pa.schema([f.with_type(pa.string()) if f.type == pa.null() else f for f in schema])
+                writer = ipc.new_file(tmp_path, schema)
+            writer.write_table(pa.Table.from_pandas(typed, schema=schema, preserve_index=False))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if schema is None:
+        return None
+    os.replace(tmp_path, path)
+    _cache.discard(path)
+    log.info("🧊 型付きフレームを保存", extra={"path": path, "types": types})
+    return path
+
+class Frame:
+    """
+    analyze 用の表
+    Feather は Arrow のテーブル（メモリマップで開いたものはページキャッシュに載るだけ）のまま持ち、
+    to_pandas で指定した列だけ DataFrame にする。Feather が無い場合は CSV を読んだ DataFrame を持つ
+    """
+    def __init__(self, table=None, df: Optional[pd.DataFrame] = None):
+        self.table = table
+        self.df = df
+
+    @property
+    def columns(self) -> list:
+        return list(self.table.column_names) if self.table is not None else list(self.df.columns)
+
+    def __len__(self):
+        return self.table.num_rows if self.table is not None else len(self.df)
+
+    def head(self, n: int) -> pd.DataFrame:
+        """先頭 n 行（実行計画のプロンプトの列の型・値の例に使う）"""
+        return self.table.slice(0, n).to_pandas() if self.table is not None else self.df.head(n).copy()
+
+    def to_pandas(self, columns=None) -> pd.DataFrame:
+        """
+        columns の列だけ（None なら全列）の DataFrame
+        分析エージェントが列を書き換えてもキャッシュに影響しないよう、常に新しい DataFrame を返す
+        """
+        if self.table is not None:
+            return (self.table if columns is None else self.table.select(list(columns))).to_pandas()
+        return (self.df if columns is None else self.df[list(columns)]).copy()
+
+class FrameCache:
+    """バイト数の上限つき LRU（メモリに読み込んだ Arrow のテーブルを置く）"""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()  # path -> (mtime, table, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, mtime):
+        with self._lock:
+            entry = self._frames.get(path)
+            if entry is not None and entry[0] == mtime:
+                self._frames.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, path, mtime, table):
+        nbytes = int(table.nbytes)
+        if nbytes > self.max_bytes:
+            return False
+        with self._lock:
+            self._discard(path)
+            self._frames[path] = (mtime, table, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted) = self._frames.popitem(last=False)
+                self._bytes -= evicted
+        return True
+
+    def discard(self, path):
+        with self._lock:
+            self._discard(path)
+
+    def _discard(self, path):
+        entry = self._frames.pop(path, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def stats(self) -> dict:
+        return {"frames": len(self._frames), "bytes": self._bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+_cache = FrameCache(config.FRAME_CACHE_MAX_BYTES)
+
+@timed("load_frame")
+def load_frame(csv_path: str) -> Frame:
+    """
+    analyze 用の Frame を返す
+    型付き Feather があれば、キャッシュの上限に収まるものはメモリに読み込んでキャッシュし、
+    収まらないものはメモリマップで開く（キャッシュはしない。使う列だけがメモリに載る）
+    Feather が無ければ従来どおり CSV を読む
+    """
+    path = frame_path(csv_path)
+    if pa is None or not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(csv_path):
+        return Frame(df=pd.read_csv(csv_path))
+
+    mtime = os.path.getmtime(path)
+    table = _cache.get(path, mtime)
+    if table is not None:
+        return Frame(table)
+    # 非圧縮の Feather なので、ファイルの大きさがほぼテーブルの大きさ
+    if os.path.getsize(path) > _cache.max_bytes:
+        return Frame(feather.read_table(path, memory_map=True))
+    table = feather.read_table(path, memory_map=False)
+    _cache.put(path, mtime, table)
+    return Frame(table)
+
+def stats() -> dict:
+    return _cache.stats()
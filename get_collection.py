@@ -1,16 +1,24 @@
-from chromadb import PersistentClient
+import sys
+from datetime import datetime
 
-client = PersistentClient(path="./chroma_db")
-collection = client.get_collection("rekipedia")
+from embedder import delete_source, get_source_catalog, migrate_to_shards, rebuild_source_index
 
-data = collection.get()
-
-sources = set(
-    m["source"]
-    for m in data["metadatas"]
-    if m is not None and "source" in m
-)
+# python get_collection.py                  # 登録済みファイルの一覧（ファイル一覧を読むだけ。チャンクは読まない）
+# python get_collection.py rebuild          # 登録済みの全チャンクからファイル一覧を作り直す（ファイル一覧を導入する前のデータ用）
+# python get_collection.py delete <ファイル名>
+# python get_collection.py migrate          # REKIPEDIA_COLLECTION_LAYOUT=sharded で実行し、ファイルごとのコレクションに移す
+command = sys.argv[1] if len(sys.argv) > 1 else "list"
+if command == "rebuild":
+    rebuild_source_index()
+elif command == "delete":
+    delete_source(sys.argv[2])
+elif command == "migrate":
+    migrate_to_shards()
 
+entries = get_source_catalog().entries()
 print("Sources in collection:")
-for s in sources:
-    print(s)
+for entry in entries:
+    indexed_at = datetime.fromtimestamp(entry["indexed_at"]).strftime("%Y-%m-%d %H:%M")
+    print(f"{entry['source']}  rows={entry['rows']} chunks={entry['chunks']} collection={entry['collection']} indexed_at={indexed_at}")
+if not entries:
+    print("（ファイル一覧が空です。以前に登録したファイルがある場合は python get_collection.py rebuild）")
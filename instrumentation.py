@@ -0,0 +1,239 @@
+# instrumentation.py
+# 計測まわり（外部ライブラリは使わない）
+#   - timed("stage") : 処理段階ごとの所要時間をヒストグラムに記録する（with 文・デコレータのどちらでも使える）
+#   - render_metrics : 記録した値を Prometheus のテキスト形式で返す（app.py の /metrics）
+#   - get_logger     : print の代わりの構造化ログ（extra={...} で渡した値を key=value / JSON で出す）
+#   - maybe_profile  : リクエスト単位で cProfile を取り、.prof に保存する
+import cProfile
+import contextlib
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+import config
+
+# 所要時間のヒストグラムのバケット（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # ラベルの値 -> [バケットごとの件数（累積ではない。最後は +Inf）, 合計, 件数]
+        self._series = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, n) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {n}")
+        return lines
+
+STAGE_SECONDS = Histogram("rekipedia_stage_duration_seconds", "処理段階ごとの所要時間（秒）", ["stage"])
+STAGE_ERRORS = Counter("rekipedia_stage_errors_total", "例外で終わった処理段階の回数", ["stage"])
+EVENTS = Counter("rekipedia_events_total", "キャッシュのヒット・分類の段などの発生回数", ["event", "value"])
+METRICS = [STAGE_SECONDS, STAGE_ERRORS, EVENTS]
+
+def observe(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+def count(event: str, value="", amount=1):
+    EVENTS.inc(amount, event=event, value=value)
+
+class timed:
+    """
+    with timed("embed"): ... / @timed("embed") のどちらでも、かかった時間を STAGE_SECONDS に記録する
+    例外で抜けた場合も時間を記録し、STAGE_ERRORS を数える
+    """
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.seconds = None
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._start
+        observe(self.stage, self.seconds)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(stage=self.stage)
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            # スレッドごとに別の計測にするため、呼び出しのたびに作る
+            with timed(self.stage):
+                return fn(*args, **kwargs)
+        return wrapper
+
+def timed_iter(stage: str, iterable):
+    """イテレータの要素を1つ取り出すたびにかかった時間を記録する（ジェネレータの処理時間を測る）"""
+    iterator = iter(iterable)
+    while True:
+        with timed(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# ---------------------------------------------------------------- ログ
+
+# LogRecord が元から持つ属性（これ以外を extra で渡された値として出力する）
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, json_format: bool = False):
+        super().__init__()
+        self.json_format = json_format
+
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}"
+        message = record.getMessage()
+        if record.exc_info:
+            fields["exc_info"] = self.formatException(record.exc_info)
+        if self.json_format:
+            return json.dumps(
+                {"ts": timestamp, "level": record.levelname, "logger": record.name, "msg": message, **fields},
+                ensure_ascii=False, default=str,
+            )
+        pairs = " ".join(f"{key}={json.dumps(value, ensure_ascii=False, default=str)}" for key, value in fields.items())
+        return f"{timestamp} {record.levelname:<7} {record.name} {message}" + (f" {pairs}" if pairs else "")
+
+_logging_lock = threading.Lock()
+_logging_configured = False
+
+def setup_logging(level=None, json_format=None):
+    """"rekipedia" 以下のロガーの出力先（標準エラー）と形式を設定する（2回目以降は何もしない）"""
+    global _logging_configured
+    with _logging_lock:
+        if _logging_configured:
+            return
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(StructuredFormatter(config.LOG_FORMAT == "json" if json_format is None else json_format))
+        root = logging.getLogger("rekipedia")
+        root.addHandler(handler)
+        root.setLevel(level or config.LOG_LEVEL)
+        root.propagate = False
+        _logging_configured = True
+
+class _SafeExtraAdapter(logging.LoggerAdapter):
+    """
+    extra のキーが LogRecord の属性（filename・module など）と同じだと logging が KeyError を出すので、
+    "extra_" を付けて別の名前にする（ログ1行のせいで処理が失敗しないように）
+    """
+    def process(self, msg, kwargs):
+        extra = kwargs.get("extra")
+        if extra:
+            kwargs["extra"] = {
+                (f"extra_{key}" if key in _RECORD_ATTRIBUTES else key): value for key, value in extra.items()
+            }
+        return msg, kwargs
+
+def get_logger(name: str) -> logging.LoggerAdapter:
+    setup_logging()
+    return _SafeExtraAdapter(logging.getLogger(f"rekipedia.{name}"), {})
+
+logger = get_logger("instrumentation")
+
+# ---------------------------------------------------------------- プロファイル
+
+# cProfile は同時に1つしか動かせないので、計測中に来たリクエストは計測しない
+_profile_lock = threading.Lock()
+
+@contextlib.contextmanager
+def maybe_profile(name: str, force: bool = False, top: int = 15):
+    """
+    force（リクエストで指定された場合）か確率 config.PROFILE_SAMPLE_RATE で、with の中を cProfile で計測する
+    結果は config.PROFILE_DIR に .prof で保存し、累積時間の上位 top 件をログに出す
+    計測されるのは with を実行したスレッドだけ（スレッドプールに投げた処理は含まれない）
+    """
+    sampled = config.PROFILE_SAMPLE_RATE > 0 and random.random() < config.PROFILE_SAMPLE_RATE
+    if not (force or sampled) or not _profile_lock.acquire(blocking=False):
+        yield None
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        path = os.path.join(config.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_{name}_{uuid.uuid4().hex[:8]}.prof")
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(top)
+        logger.info("🔬 プロファイルを保存しました\n" + summary.getvalue().rstrip(), extra={"profile": name, "path": path})
+    finally:
+        _profile_lock.release()
@@ -0,0 +1,154 @@
+# jobs.py
+# バックグラウンドで取り込み処理を実行するジョブキュー
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from instrumentation import count, get_logger, observe
+
+log = get_logger("jobs")
+
+class Job:
+    def __init__(self, job_id: str, name: str):
+        self.id = job_id
+        self.name = name
+        self.status = "queued"  # queued / running / done / failed
+        self.message = ""
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.processed = 0      # 処理済みチャンク数
+        self.progress = 0.0     # 0〜1（読み込み済みバイト割合など）
+        self.progress_started_at = None  # progress・processed を数え始めた時刻（前処理の時間を ETA に含めない）
+
+    def elapsed(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def progress_elapsed(self) -> float:
+        """progress を数え始めてからの経過秒数（start_progress が呼ばれていなければジョブの開始から）"""
+        started_at = self.progress_started_at or self.started_at
+        if started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - started_at
+
+    def throughput(self) -> float:
+        elapsed = self.progress_elapsed()
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def eta(self) -> Optional[float]:
+        if self.status != "running" or self.progress <= 0:
+            return None
+        elapsed = self.progress_elapsed()
+        return elapsed * (1 - self.progress) / self.progress
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "message": self.message,
+            "error": self.error,
+            "result": self.result,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress_started_at": self.progress_started_at,
+            "processed": self.processed,
+            "progress": self.progress,
+            "elapsed_sec": self.elapsed(),
+            "throughput_per_sec": self.throughput(),
+            "eta_sec": self.eta(),
+        }
+
+class JobQueue:
+    def __init__(self, max_workers: int = 1, max_history: int = 200, on_update: Optional[Callable[[Job], None]] = None):
+        """
+        :param max_workers: 同時に実行するジョブ数
+        :param max_history: 保持しておく終了済みジョブの件数
+        :param on_update: ジョブの状態・進捗が変わるたびに呼ばれるコールバック
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs = OrderedDict()
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.max_history = max_history
+        self.on_update = on_update
+
+    def submit(self, name: str, fn: Callable, *args, key: Optional[str] = None, job_id: Optional[str] = None, **kwargs) -> Job:
+        """
+        fn(job, *args, **kwargs) をワーカーで実行するジョブを登録する
+        key が同じジョブ（同じファイルなど）は同時に実行しない
+        """
+        job = Job(job_id or uuid.uuid4().hex, name)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+            key_lock = self._key_locks.setdefault(key, threading.Lock()) if key is not None else None
+        self._executor.submit(self._run, job, key_lock, fn, args, kwargs)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def update(self, job: Job, processed: Optional[int] = None, progress: Optional[float] = None, message: Optional[str] = None):
+        if processed is not None:
+            job.processed = processed
+        if progress is not None:
+            job.progress = progress
+        if message is not None:
+            job.message = message
+        self._notify(job)
+
+    def start_progress(self, job: Job, message: Optional[str] = None):
+        """ここから progress（0〜1）・processed を数える（ETA・処理速度はこの時刻から計算する）"""
+        job.progress_started_at = time.time()
+        job.progress = 0.0
+        job.processed = 0
+        self.update(job, message=message)
+
+    def _run(self, job, key_lock, fn, args, kwargs):
+        if key_lock is not None:
+            key_lock.acquire()
+        try:
+            job.status = "running"
+            job.started_at = time.time()
+            self._notify(job)
+            job.result = fn(job, *args, **kwargs)
+            job.progress = 1.0
+            job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            log.exception("❌ ジョブが失敗しました", extra={"job_id": job.id, "job": job.name})
+        finally:
+            job.finished_at = time.time()
+            count("job", job.status)
+            if job.started_at is not None:
+                observe("job", job.finished_at - job.started_at)
+            if key_lock is not None:
+                key_lock.release()
+            self._notify(job)
+
+    def _notify(self, job):
+        if self.on_update is not None:
+            try:
+                self.on_update(job)
+            except Exception as e:
+                log.warning("⚠️ ジョブ通知に失敗しました", extra={"job_id": job.id, "error": str(e)})
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ("done", "failed")]
+        for job_id in finished[:max(len(self._jobs) - self.max_history, 0)]:
+            del self._jobs[job_id]
@@ -0,0 +1,23 @@
+# lazy.py
+# 重いモデルやクライアントを初回利用時に1度だけ作るためのヘルパー
+import functools
+import threading
+
+def singleton(factory):
+    """
+    引数なしの factory を「初回呼び出し時に1度だけ実行し、以後は同じ値を返す」関数にする
+    複数スレッドから同時に呼ばれても factory は1回しか実行されない
+    """
+    lock = threading.Lock()
+    holder = []
+
+    @functools.wraps(factory)
+    def get():
+        if not holder:
+            with lock:
+                if not holder:
+                    holder.append(factory())
+        return holder[0]
+
+    get.is_initialized = lambda: bool(holder)
+    return get
@@ -0,0 +1,196 @@
+# lexical_index.py
+# チャンクの転置インデックス（SQLite）と BM25 検索
+# 会社名・局名・日付・コードなど「文字列がそのまま一致すること」が大事な質問を、埋め込み検索と併用して拾う
+# 日本語は分かち書きせず文字 bigram、英数字は記号（/ - . :）でつながった塊を1語として扱う
+import math
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+# 英数字の塊（2024/12/01, ab-123 など）か、それ以外の文字（かな・漢字など）の連続
+TOKEN_PATTERN = re.compile(r"[0-9a-z]+(?:[/\-.:][0-9a-z]+)*|[^\W0-9a-z_]+")
+DATE_SEPARATOR = re.compile(r"(?<=\d)[-.](?=\d)")
+
+# SQLite の IN 句に一度に渡すキー数
+_SQL_BATCH = 500
+
+def tokenize(text: str) -> List[str]:
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text):
+        token = match.group()
+        if token[0].isascii():
+            # 2024-12-01 と 2024/12/01 を同じ語にする
+            tokens.append(DATE_SEPARATOR.sub("/", token))
+        elif len(token) == 1:
+            tokens.append(token)
+        else:
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+    return tokens
+
+class LexicalIndex:
+    def __init__(self, path: str = ":memory:", k1: float = 1.2, b: float = 0.75):
+        """
+        :param path: SQLite ファイルのパス
+        :param k1, b: BM25 のパラメータ
+        """
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, source TEXT, length INTEGER NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term TEXT NOT NULL, doc_id TEXT NOT NULL, tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term, doc_id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS docs_source ON docs (source)")
+        # 質問から会社名などを見つけるための語彙（種類, 値, チャンク id）。チャンクを削除すると一緒に消える
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entity_docs ("
+            " kind TEXT NOT NULL, value TEXT NOT NULL, doc_id TEXT NOT NULL,"
+            " PRIMARY KEY (kind, value, doc_id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entity_docs_doc ON entity_docs (doc_id)")
+        # 以前の形式（種類, 値, source）。チャンク id が無いので、source のチャンクがすべて消えたときに消す
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entities ("
+            " kind TEXT NOT NULL, value TEXT NOT NULL, source TEXT NOT NULL,"
+            " PRIMARY KEY (kind, value, source)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        self._entities = {}
+        self.n_docs, self.total_length = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+
+    def add(self, records: Iterable[Tuple[str, str, Optional[str]]]):
+        """(id, text, source) を登録する。同じ id が登録済みなら置き換える"""
+        records = list(records)
+        with self._lock:
+            self._delete([record[0] for record in records])
+            for doc_id, text, source in records:
+                counts = Counter(tokenize(text))
+                length = sum(counts.values())
+                self._conn.execute("INSERT INTO docs (id, source, length) VALUES (?, ?, ?)", (doc_id, source, length))
+                self._conn.executemany(
+                    "INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                    [(term, doc_id, tf) for term, tf in counts.items()],
+                )
+                self._conn.executemany(
+                    "INSERT INTO terms (term, df) VALUES (?, 1) ON CONFLICT(term) DO UPDATE SET df = df + 1",
+                    [(term,) for term in counts],
+                )
+                self.n_docs += 1
+                self.total_length += length
+            self._conn.commit()
+
+    def delete(self, ids: Sequence[str]):
+        with self._lock:
+            self._delete(ids)
+            self._conn.commit()
+
+    def _delete(self, ids: Sequence[str]):
+        for i in range(0, len(ids), _SQL_BATCH):
+            part = list(ids[i:i + _SQL_BATCH])
+            placeholders = ",".join("?" * len(part))
+            rows = self._conn.execute(f"SELECT id, length, source FROM docs WHERE id IN ({placeholders})", part).fetchall()
+            if not rows:
+                continue
+            found = [doc_id for doc_id, _, _ in rows]
+            placeholders = ",".join("?" * len(found))
+            term_counts = self._conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE doc_id IN ({placeholders}) GROUP BY term", found
+            ).fetchall()
+            self._conn.executemany("UPDATE terms SET df = df - ? WHERE term = ?", [(n, term) for term, n in term_counts])
+            self._conn.execute(f"DELETE FROM postings WHERE doc_id IN ({placeholders})", found)
+            self._conn.execute(f"DELETE FROM docs WHERE id IN ({placeholders})", found)
+            self._conn.execute("DELETE FROM terms WHERE df <= 0")
+            deleted_entities = self._conn.execute(f"DELETE FROM entity_docs WHERE doc_id IN ({placeholders})", found).rowcount
+            sources = list({source for _, _, source in rows if source is not None})
+            deleted_entities += self._conn.execute(
+                f"DELETE FROM entities WHERE source IN ({','.join('?' * len(sources))})"
+                " AND NOT EXISTS (SELECT 1 FROM docs WHERE docs.source = entities.source)",
+                sources,
+            ).rowcount if sources else 0
+            if deleted_entities:
+                self._entities.clear()
+            self.n_docs -= len(rows)
+            self.total_length -= sum(length for _, length, _ in rows)
+
+    def search(self, query: str, top_k: int = 10, sources: Optional[Sequence[str]] = None, max_df_ratio: float = 0.3) -> List[Tuple[str, float]]:
+        """
+        BM25 で上位 top_k 件の (id, score) を返す
+        :param sources: 指定するとこれらの source のチャンクだけを対象にする
+        :param max_df_ratio: 全文書のこの割合を超えて出現する語（列名など）は使わない（すべて該当する場合は最も少ない語だけ使う）
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            if self.n_docs == 0:
+                return []
+            n_docs = self.n_docs
+            avg_length = self.total_length / n_docs or 1.0
+            dfs = {}
+            for i in range(0, len(terms), _SQL_BATCH):
+                part = terms[i:i + _SQL_BATCH]
+                dfs.update(self._conn.execute(f"SELECT term, df FROM terms WHERE term IN ({','.join('?' * len(part))})", part).fetchall())
+            if not dfs:
+                return []
+            selected = [term for term, df in dfs.items() if df <= max_df_ratio * n_docs] or [min(dfs, key=dfs.get)]
+
+            # BM25 の合計・並べ替えは SQLite の中で行う（ポスティングを Python に1行ずつ返さない）
+            query_terms = []
+            for term in selected:
+                df = dfs[term]
+                query_terms += [term, math.log(1 + (n_docs - df + 0.5) / (df + 0.5))]
+            source_filter = ""
+            if sources:
+                source_filter = f" WHERE d.source IN ({','.join('?' * len(sources))})"
+            rows = self._conn.execute(
+                f"WITH q(term, idf) AS (VALUES {','.join(['(?, ?)'] * len(selected))})"
+                " SELECT p.doc_id, SUM(q.idf * p.tf * (? + 1) / (p.tf + ? * (1 - ? + ? * d.length / ?))) AS score"
+                " FROM q JOIN postings p ON p.term = q.term JOIN docs d ON d.id = p.doc_id"
+                f"{source_filter} GROUP BY p.doc_id ORDER BY score DESC, p.doc_id LIMIT ?",
+                [*query_terms, self.k1, self.k1, self.b, self.b, avg_length, *(sources or []), top_k],
+            ).fetchall()
+        return [(doc_id, score) for doc_id, score in rows]
+
+    def add_entities(self, kind: str, items: Iterable[Tuple[str, str]]):
+        """(チャンク id, 値) を登録する（チャンクを delete すると一緒に消える）"""
+        rows = [(kind, value, doc_id) for doc_id, value in set(items) if value]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO entity_docs (kind, value, doc_id) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+            self._entities.pop(kind, None)
+
+    def entities(self, kind: str) -> List[str]:
+        """登録済みの kind の値（重複なし）"""
+        with self._lock:
+            if kind not in self._entities:
+                rows = self._conn.execute(
+                    "SELECT value FROM entity_docs WHERE kind = ? UNION SELECT value FROM entities WHERE kind = ?", (kind, kind)
+                ).fetchall()
+                self._entities[kind] = [value for value, in rows]
+            return self._entities[kind]
+
+    def stats(self) -> dict:
+        with self._lock:
+            n_terms = self._conn.execute("SELECT COUNT(*) FROM terms").fetchone()[0]
+        return {"docs": self.n_docs, "terms": n_terms, "avg_length": self.total_length / self.n_docs if self.n_docs else 0.0}
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """複数の順位リスト（id の列）を RRF で1つにまとめ、(id, score) を score の降順で返す"""
+    scores = Counter()
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1.0 / (k + rank + 1)
+    return scores.most_common()
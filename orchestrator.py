@@ -1,14 +1,17 @@
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
 import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
 
-# OpenAI APIキーを環境変数から取得（設定済み前提）
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-parser = StrOutputParser()
+import numpy as np
 
-# 質問を分類するプロンプトテンプレート
-prompt = ChatPromptTemplate.from_template("""
+from lazy import singleton
+from instrumentation import count, timed
+import config
+
+# 質問を分類するプロンプト
+CLASSIFY_PROMPT = """
 あなたはユーザーからの質問を次の2つのカテゴリのどちらかに分類するAIです：
 - search: 似ている文書を検索する必要がある質問
 - analyze: 表のデータをPandasを使って集計・分析する必要がある質問
@@ -16,20 +19,176 @@ prompt = ChatPromptTemplate.from_template("""
 質問: {question}
 
 分類:（search または analyze のいずれかだけを出力）
-""")
+"""
 
-# LangChainのチェーンを構築
-chain = prompt | llm | parser
+# LangChainのチェーンを構築（初回の分類時に LLM クライアントを作る）
+@singleton
+def get_chain():
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_openai import ChatOpenAI
 
-def classify_query(question: str) -> str:
-    """質問を search または analyze に分類"""
-    result = chain.invoke({"question": question})
+    # OpenAI APIキーを環境変数から取得（設定済み前提）
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    prompt = ChatPromptTemplate.from_template(CLASSIFY_PROMPT)
+    return prompt | llm | StrOutputParser()
+
+LABELS = ["search", "analyze"]
+
+# 集計・分析を求める質問に現れる語（含まれていれば LLM を呼ばずに analyze とする）
+ANALYZE_KEYWORDS = [
+    "合計", "平均", "件数", "何件", "総数", "総額", "合算", "最大", "最小", "最高", "最低",
+    "集計", "割合", "比率", "ランキング", "多い順", "少ない順", "上位", "下位",
+    "中央値", "前年比", "前月比", "増減", "内訳", "カウント", "何社", "何人",
+]
+# 英語は単語の一部（account・discount・subtotal・summary など）に当たらないよう単語単位で探す
+ANALYZE_KEYWORD_PATTERN = re.compile(
+    "|".join([re.escape(k) for k in ANALYZE_KEYWORDS] + [r"\bsum\b", r"\baverage\b", r"\bcount\b", r"\btotal\b"]),
+    re.IGNORECASE,
+)
+
+# 最近傍セントロイドの初期値に使う例文（LLM が分類した質問でセントロイドを更新していく）
+SEED_QUESTIONS = {
+    "search": [
+        "〇〇局の12月の入金状況を教えて",
+        "株式会社〇〇の契約内容は？",
+        "2024/12/01 の取引の詳細",
+        "〇〇さんの担当案件について",
+    ],
+    "analyze": [
+        "月ごとの入金額の合計を出して",
+        "取引先別の件数を多い順に並べて",
+        "今年の平均単価はいくら？",
+        "区分ごとの金額の割合を集計して",
+    ],
+}
+
+class QueryClassifier:
+    """
+    キャッシュ → キーワードルール → 質問埋め込みの最近傍セントロイド → LLM の順に分類する
+    手前の段で確信度が足りたところで止め、どの段が答えたかと各段の所要時間を返す
+    """
+    def __init__(self, cache_size=2000, centroid_margin=0.02):
+        self.cache_size = cache_size
+        self.centroid_margin = centroid_margin
+        self._cache = OrderedDict()
+        self._centroid_sums = None
+        self._centroid_counts = None
+        self._lock = threading.Lock()
+        self.tier_counts = Counter()
+
+    def classify(self, question: str, query_embedding=None) -> dict:
+        timings = {}
+        key = " ".join(question.split())
+
+        start = time.perf_counter()
+        with self._lock:
+            label = self._cache.get(key)
+            if label is not None:
+                self._cache.move_to_end(key)
+        timings["cache"] = time.perf_counter() - start
+        if label is not None:
+            return self._result(label, "cache", 1.0, timings)
+
+        start = time.perf_counter()
+        match = ANALYZE_KEYWORD_PATTERN.search(question)
+        keyword = match.group(0).lower() if match else None
+        timings["rules"] = time.perf_counter() - start
+        if keyword is not None:
+            return self._remember(key, self._result("analyze", "rules", 1.0, timings, keyword=keyword))
+
+        start = time.perf_counter()
+        embedding = self._as_vector(question, query_embedding)
+        label, margin = self._nearest_centroid(embedding)
+        timings["centroid"] = time.perf_counter() - start
+        if margin >= self.centroid_margin:
+            return self._remember(key, self._result(label, "centroid", margin, timings))
+
+        start = time.perf_counter()
+        label = classify_query_with_llm(question)
+        timings["llm"] = time.perf_counter() - start
+        self._learn(label, embedding)
+        return self._remember(key, self._result(label, "llm", 1.0, timings))
+
+    def _as_vector(self, question, query_embedding):
+        if query_embedding is None:
+            from embedder import get_embedding_function
+            query_embedding = get_embedding_function()([question])
+        vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _nearest_centroid(self, vector):
+        """(最も近いラベル, 1位と2位のコサイン類似度の差) を返す"""
+        with self._lock:
+            if self._centroid_sums is None:
+                from embedder import get_embedding_function
+                embed = get_embedding_function()
+                self._centroid_sums = {}
+                self._centroid_counts = {}
+                for label, questions in SEED_QUESTIONS.items():
+                    vectors = np.asarray(embed(questions), dtype=np.float32)
+                    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                    self._centroid_sums[label] = vectors.sum(axis=0)
+                    self._centroid_counts[label] = len(questions)
+            scores = {}
+            for label, total in self._centroid_sums.items():
+                centroid = total / self._centroid_counts[label]
+                scores[label] = float(vector @ centroid / (np.linalg.norm(centroid) or 1.0))
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[0][0], ranked[0][1] - ranked[1][1]
+
+    def _learn(self, label, vector):
+        with self._lock:
+            if self._centroid_sums is not None:
+                self._centroid_sums[label] = self._centroid_sums[label] + vector
+                self._centroid_counts[label] += 1
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._cache[key] = result["label"]
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def _result(self, label, tier, confidence, timings, **extra):
+        self.tier_counts[tier] += 1
+        count("classify_tier", tier)
+        result = {
+            "label": label,
+            "tier": tier,
+            "confidence": confidence,
+            "timings_ms": {name: sec * 1000 for name, sec in timings.items()},
+        }
+        result.update(extra)
+        return result
+
+classifier = QueryClassifier(
+    cache_size=config.CLASSIFIER_CACHE_SIZE,
+    centroid_margin=config.CLASSIFIER_CENTROID_MARGIN,
+)
+
+@timed("classify_llm")
+def classify_query_with_llm(question: str) -> str:
+    result = get_chain().invoke({"question": question})
     result = result.strip().lower()
-    if result not in ["search", "analyze"]:
+    if result not in LABELS:
         return "search"
     return result
 
+@timed("classify")
+def classify_query_with_info(question: str, query_embedding=None) -> dict:
+    """
+    質問を分類し、ラベル・答えた段（cache / rules / centroid / llm）・確信度・各段の所要時間を返す
+    query_embedding を渡すとセントロイド判定でそれを使い、再埋め込みしない
+    """
+    return classifier.classify(question, query_embedding=query_embedding)
+
+def classify_query(question: str, query_embedding=None) -> str:
+    """質問を search または analyze に分類"""
+    return classify_query_with_info(question, query_embedding=query_embedding)["label"]
+
 # CLIテスト用
 if __name__ == "__main__":
     q = input("質問を入力してください: ")
-    print("分類結果:", classify_query(q))
\ No newline at end of file
+    print("分類結果:", classify_query_with_info(q))
\ No newline at end of file
@@ -0,0 +1,140 @@
+# pipeline.py
+# /ask の処理パイプライン
+# 質問の埋め込みは1回だけ行い、検索（ChromaDB）と分類（orchestrator）を並行して走らせる
+# 検索結果は search（回答生成）と analyze（CSVファイル選択）のどちらでも使い回す
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from analyzer import analyze_dataframe
+from answer_cache import AnswerCache
+from embedder import get_source_catalog
+from frame_store import load_frame
+from instrumentation import count, get_logger, maybe_profile, observe
+from orchestrator import classify_query_with_info
+from query import embed_query, query_documents, generate_answer, generate_answer_stream
+from utils import rank_source_files
+
+# 回答生成に渡す件数と、ファイル選択用に取る件数
+SEARCH_TOP_K = 5
+ROUTING_TOP_K = 10
+
+log = get_logger("pipeline")
+
+executor = ThreadPoolExecutor(max_workers=config.ASK_WORKERS, thread_name_prefix="ask")
+
+answer_cache = AnswerCache(
+    threshold=config.ANSWER_CACHE_THRESHOLD,
+    ttl_sec=config.ANSWER_CACHE_TTL_SEC,
+    max_entries=config.ANSWER_CACHE_MAX_ENTRIES,
+    # 別のプロセス（get_collection.py delete など）で削除・登録し直したファイルの回答も使わない
+    external_versions=lambda: get_source_catalog().versions(),
+)
+
+class StageTimer:
+    """/ask の段階ごとの所要時間（timings_ms に入れ、instrumentation のヒストグラムにも "ask_段階名" で記録する）"""
+    def __init__(self):
+        self.timings_ms = {}
+
+    def run(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.timings_ms[name] = seconds * 1000
+        observe(f"ask_{name}", seconds)
+
+def _rounded(timings_ms):
+    return {name: round(ms, 1) for name, ms in timings_ms.items()}
+
+def answer_question(query: str, on_token=None, profile=False) -> dict:
+    """
+    質問に答え、{"answer", "classification", "hits", "routing", "timings_ms"} を返す
+    routing は analyze のときに選んだファイルの候補（utils.rank_source_files の結果）
+    timings_ms は段階ごとの所要時間（classify と retrieve は並行に走るので合計は total を超えうる）
+    on_token を渡すと search の回答をストリーミングで生成し、トークンが届くたびに呼ぶ
+    （timings_ms に最初のトークンまでの時間 first_token も入る）
+    profile なら（そうでなくても確率 config.PROFILE_SAMPLE_RATE で）cProfile を取る（instrumentation.maybe_profile）
+    """
+    with maybe_profile("ask", force=profile):
+        return _answer_question(query, on_token)
+
+def _answer_question(query: str, on_token=None) -> dict:
+    timer = StageTimer()
+    routing = []
+    start = time.perf_counter()
+
+    query_embedding = timer.run("embed", embed_query, query)
+
+    # ほぼ同じ質問に最近答えていて、元になったファイルが再インデックスされていなければそれを返す
+    cached = timer.run("answer_cache", answer_cache.lookup, query, query_embedding)
+    if cached is not None:
+        count("answer_cache", "hit")
+        if on_token is not None:
+            on_token(cached["answer"])
+            timer.record("first_token", time.perf_counter() - start)
+        timer.record("total", time.perf_counter() - start)
+        log.info("♻️ 回答キャッシュ使用", extra={"similarity": round(cached["similarity"], 3), "timings_ms": _rounded(timer.timings_ms)})
+        return {
+            "answer": cached["answer"],
+            "classification": {"label": cached["label"], "tier": "answer_cache"},
+            "hits": [],
+            "routing": [],
+            "timings_ms": timer.timings_ms,
+            "cached": True,
+        }
+
+    count("answer_cache", "miss")
+    # 検索より前のバージョンで回答を保存する（回答を作っている間に再インデックスされたら、その回答は使われない）
+    source_versions = answer_cache.versions()
+    classify_future = executor.submit(timer.run, "classify", classify_query_with_info, query, query_embedding=query_embedding)
+    hits_future = executor.submit(timer.run, "retrieve", query_documents, query, top_k=ROUTING_TOP_K, query_embedding=query_embedding)
+
+    classification = classify_future.result()
+    hits = hits_future.result()
+    label = classification["label"]
+    log.info("🏷️ 分類結果", extra={"label": label, "tier": classification["tier"], "timings_ms": _rounded(classification["timings_ms"])})
+
+    # 回答の元になったファイル（回答キャッシュの無効化に使う）
+    sources = {hit["metadata"].get("source") for hit in hits[:SEARCH_TOP_K]} - {None}
+
+    if label == "search" and on_token is not None:
+        answer_start = time.perf_counter()
+        streamed = timer.run("answer", generate_answer_stream, query, hits[:SEARCH_TOP_K], on_token)
+        answer = streamed["answer"]
+        if streamed["ttft_ms"] is not None:
+            # 質問を受けてから最初のトークンが届くまで
+            timer.record("first_token", answer_start - start + streamed["ttft_ms"] / 1000)
+    elif label == "search":
+        answer = timer.run("answer", generate_answer, query, hits[:SEARCH_TOP_K])
+    elif label == "analyze":
+        routing = timer.run("route", rank_source_files, hits, query_embedding)
+        if routing:
+            file_name = routing[0]["source"]
+            sources = {file_name}
+            csv_path = os.path.join(config.CSV_DIR, file_name)
+            log.info("📁 分析するファイル", extra={"csv_path": csv_path, "confidence": round(routing[0]["confidence"], 3)})
+            frame = timer.run("load", load_frame, csv_path)
+            answer = timer.run("answer", analyze_dataframe, frame, query)
+        else:
+            answer = "⚠️ 分析対象のファイルが見つかりませんでした"
+    else:
+        answer = "⚠️ 質問の分類に失敗しました"
+
+    if answer and not answer.startswith("⚠️"):
+        answer_cache.store(query, query_embedding, answer, label, sources, versions=source_versions)
+
+    timer.record("total", time.perf_counter() - start)
+    log.info("⏱️ /ask", extra={"label": label, "timings_ms": _rounded(timer.timings_ms)})
+    return {
+        "answer": answer,
+        "classification": classification,
+        "hits": hits,
+        "routing": routing,
+        "timings_ms": timer.timings_ms,
+        "cached": False,
+    }
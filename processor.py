@@ -1,9 +1,24 @@
 import pandas as pd
 import os
 import sys
+import codecs
+import csv
+import itertools
 import numpy as np
 from collections import Counter
 import re
+import datetime
+import unicodedata
+from functools import lru_cache
+
+from instrumentation import get_logger, timed
+
+log = get_logger("processor")
+
+# ストリーミング読み込み時に一度に読む行数
+CSV_READ_CHUNKSIZE = 5000
+# テーブル行をテキスト化する際のブロック行数
+ROW_TEXT_BLOCK_SIZE = 1024
 
 def detect_sheet_format(df):
 	scores = {
@@ -69,57 +84,93 @@ def row_to_text(row, header):
 
 def process_table_format(df, chunk_size=800, overlap=100):
 	header_row_index = detect_header_row(df)
-	print(f"✅ ヘッダー行 index={header_row_index} で処理")
+	log.info("✅ ヘッダー行を検出", extra={"header_row_index": header_row_index})
 	header = df.iloc[header_row_index]
 	data = df.iloc[header_row_index + 1:]
 
-	all_chunks = []
-	for idx, row in data.iterrows():
-		text = row_to_text(row, header)
-		if text.strip():
-			all_chunks.append(text)
+	return list(iter_table_rows_as_text(data, header))
 
-	return all_chunks
+def header_field_prefixes(header):
+	"""row_to_text と同じ列名（欠損なら col_i）から "列名: " の接頭辞を一度だけ作る"""
+	return [f"{name}: " if pd.notnull(name) else f"col_{i}: " for i, name in enumerate(header)]
 
-def detect_header_row(df, max_rows_to_check=20, return_score=False):
-	import numpy as np
-
-	def is_short_text(text):
-		return len(text) <= 15 and "\n" not in text
+def serialize_table_rows(data, header, block_size=ROW_TEXT_BLOCK_SIZE):
+	"""
+	row_to_text と同じ "列名: 値 / 列名: 値" 形式の文字列を block_size 行ずつリストで返す
+	欠損判定はブロック単位で DataFrame.notna() にまとめ、行ごとの処理は接頭辞の連結と join だけにする
+	"""
+	prefixes = header_field_prefixes(header)
+	for start in range(0, len(data), block_size):
+		block = data.iloc[start:start + block_size]
+		values = block.to_numpy(dtype=object)
+		mask = block.notna().to_numpy()
+		texts = []
+		for row, row_mask in zip(values, mask):
+			text = " / ".join([f"{prefix}{cell}" for prefix, cell, present in zip(prefixes, row, row_mask) if present])
+			if text.strip():
+				texts.append(text)
+		yield texts
+
+HEADER_KEYWORDS = ["名", "日", "番号", "氏名", "区分", "タイプ", "状況", "業種", "金額", "継続", "種別", "状態"]
+
+# classify_value の分類を判定順に並べたもの（classify_value_codes の戻り値はこの添字）
+VALUE_TYPES = ["empty", "date", "number", "company", "status", "japanese", "other"]
+
+@timed("detect_header_row")
+def detect_header_row(df, max_rows_to_check=20, return_score=False, compare_rows=10):
+	"""
+	先頭 max_rows_to_check 行からヘッダー行らしい行の index を返す
+	判定に使うのは先頭 max_rows_to_check + compare_rows 行だけなので、その内容をキーに結果をキャッシュする
+	（clean_frames_and_save と iter_csv_chunks で同じ先頭行を2回判定しても2回目は計算しない）
+	"""
+	n_check = min(max_rows_to_check, len(df) - 1)
+	top = df.iloc[:max(n_check, 0) + compare_rows]
+	mask = top.notna().to_numpy()
+	cells = np.where(mask, top.astype(str).to_numpy(dtype=object), None)
+	key = tuple(map(tuple, cells))
 
-	def is_likely_field_name(text):
-		keywords = ["名", "日", "番号", "氏名", "区分", "タイプ", "状況", "業種", "金額", "継続", "種別", "状態"]
-		return any(k in text for k in keywords)
+	best_index, best_score = _detect_header_row_cached(key, n_check, len(df.columns), compare_rows)
+	return (best_index, best_score) if return_score else best_index
 
+@lru_cache(maxsize=64)
+def _detect_header_row_cached(cells, n_check, n_columns, compare_rows):
 	best_score = -np.inf
 	best_index = 0
-
-	for idx in range(min(max_rows_to_check, len(df) - 1)):
-		row = df.iloc[idx].dropna().astype(str).tolist()
-		next_row = df.iloc[idx + 1].dropna().astype(str).tolist()
-
-		if not row or not next_row:
+	if n_check <= 0 or not cells:
+		return best_index, best_score
+
+	# 先頭行をまとめて文字列行列にし、セルごとの特徴量を一度だけ計算する
+	top = pd.DataFrame(list(cells), dtype=object)
+	mask = top.notna().to_numpy()
+	shape = mask.shape
+	values = pd.Series(top.where(top.notna(), "").to_numpy().ravel(), dtype=object)
+
+	lengths = np.where(mask, values.str.len().to_numpy().reshape(shape), 0)
+	digits = np.where(mask, values.map(lambda v: sum(c.isdigit() for c in v)).to_numpy(dtype=int).reshape(shape), 0)
+	short = mask & (lengths <= 15) & ~values.str.contains("\n", regex=False).to_numpy(dtype=bool).reshape(shape)
+	keyword = mask & values.str.contains("|".join(map(re.escape, HEADER_KEYWORDS))).to_numpy(dtype=bool).reshape(shape)
+	types = classify_value_codes(values).reshape(shape)
+
+	counts = mask.sum(axis=1)
+	total_lengths = lengths.sum(axis=1)
+	inconsistency = column_inconsistency_scores(mask, values.to_numpy().reshape(shape) != "", types, n_check, compare_rows)
+
+	for idx in range(n_check):
+		if counts[idx] == 0 or counts[idx + 1] == 0:
 			continue
 
-		avg_len = np.mean([len(cell) for cell in row])
-		short_ratio = np.mean([is_short_text(cell) for cell in row])
-		keyword_ratio = np.mean([is_likely_field_name(cell) for cell in row])
-		uniqueness = len(set(row)) / len(row)
-		digit_ratio = sum(c.isdigit() for cell in row for c in cell) / sum(len(cell) for cell in row if cell)
+		avg_len = total_lengths[idx] / counts[idx]
+		short_ratio = short[idx].sum() / counts[idx]
+		keyword_ratio = keyword[idx].sum() / counts[idx]
+		uniqueness = len(set(c for c in cells[idx] if c is not None)) / counts[idx]
+		digit_ratio = digits[idx].sum() / total_lengths[idx] if total_lengths[idx] else 0.0
 
 		# next row に数字が多く含まれていれば「データ行らしい」と判定
-		next_row_digit_ratio = sum(c.isdigit() for cell in next_row for c in cell) / max(
-			sum(len(cell) for cell in next_row if cell), 1
-		)
+		next_row_digit_ratio = digits[idx + 1].sum() / max(total_lengths[idx + 1], 1)
 		next_row_is_data_like = next_row_digit_ratio > 0.2
 
 		index_bonus = 1.0 if idx <= 5 else 0.0
 
-		if is_natural_text_line(row):
-			memo_penalty = -1.0
-		else:
-			memo_penalty = 0
-
 		this_row_is_data_like = (
 			short_ratio >= 0.9 and
 			digit_ratio >= 0.4 and
@@ -138,22 +189,64 @@ def detect_header_row(df, max_rows_to_check=20, return_score=False):
 			data_penalty
 		)
 
-		inconsistency_score = column_inconsistency_score(df, idx)
-		score += inconsistency_score * 1.2
+		score += inconsistency[idx] * 1.2
 
-		column_ratio = non_empty_cell_ratio(df.iloc[idx], total_expected_columns=len(df.columns))
+		column_ratio = counts[idx] / n_columns if n_columns else 0
 		if column_ratio < 0.5:
 			score -= 1.0
-		dominant_ratio = dominant_cell_ratio(df.iloc[idx])
+		dominant_ratio = lengths[idx].max() / total_lengths[idx] if total_lengths[idx] > 0 else 0
 		if dominant_ratio < 0.7:
 			score -= 1.0
 
 		if score > best_score:
-			print(f"score: {score}, idx: {idx}, short_ratio: {short_ratio}, keyword_ratio: {keyword_ratio}, uniqueness: {uniqueness}, digit_ratio: {digit_ratio}, next_row_digit_ratio: {next_row_digit_ratio}, next_row_is_data_like: {next_row_is_data_like}, index_bonus: {index_bonus}, data_penalty: {data_penalty}, memo_penalty: {memo_penalty}, inconsistency_score: {inconsistency_score}, column_ratio: {column_ratio}, dominant_ratio: {dominant_ratio}")
 			best_score = score
 			best_index = idx
 
-	return (best_index, best_score) if return_score else best_index
+	return best_index, best_score
+
+def classify_value_codes(values):
+	"""classify_value を文字列の Series にまとめて適用し、VALUE_TYPES の添字の配列を返す"""
+	stripped = values.str.strip()
+	conditions = [
+		stripped == "",
+		stripped.str.fullmatch(r"\d{4}/\d{1,2}/\d{1,2}"),
+		stripped.str.fullmatch(r"\d+"),
+		stripped.str.contains("株式会社", regex=False),
+		stripped.str.fullmatch(r"(単発|継続|新規)"),
+		stripped.str.contains("[\u4e00-\u9fff]"),
+	]
+	conditions = [np.asarray(c.fillna(False), dtype=bool) for c in conditions]
+	return np.select(conditions, list(range(len(conditions))), default=len(conditions))
+
+def column_inconsistency_scores(mask, comparable, types, n_check, compare_rows=10):
+	"""
+	column_inconsistency_score を先頭 n_check 行についてまとめて計算する
+	mask: 非欠損セル, comparable: 比較対象にするセル（空文字以外）, types: classify_value_codes の結果
+	"""
+	n_rows = types.shape[0]
+	n_types = len(VALUE_TYPES)
+	onehot = comparable[:, :, None] & (types[:, :, None] == np.arange(n_types))
+	cumulative = np.concatenate([np.zeros((1,) + onehot.shape[1:], dtype=int), np.cumsum(onehot, axis=0)])
+
+	rows = np.arange(n_check)
+	window_counts = cumulative[np.minimum(rows + 1 + compare_rows, n_rows)] - cumulative[rows + 1]
+
+	# Counter.most_common と同じく、同数なら窓内で先に現れたタイプを最頻とする
+	first_seen = np.full(window_counts.shape, np.inf)
+	for offset in range(1, compare_rows + 1):
+		target = rows + offset
+		valid = target < n_rows
+		present = np.zeros(window_counts.shape, dtype=bool)
+		present[valid] = onehot[target[valid]]
+		first_seen = np.where(present & np.isinf(first_seen), offset, first_seen)
+
+	max_counts = window_counts.max(axis=2)
+	tie_rank = np.where(window_counts == max_counts[:, :, None], first_seen, np.inf)
+	most_common_type = tie_rank.argmin(axis=2)
+
+	mismatch = mask[:n_check] & (max_counts > 0) & (types[:n_check] != most_common_type)
+	counts = mask[:n_check].sum(axis=1)
+	return np.divide(mismatch.sum(axis=1), counts, out=np.zeros(n_check), where=counts > 0)
 
 def non_empty_cell_ratio(row, total_expected_columns):
 	count = row.count()
@@ -245,33 +338,197 @@ def split_text_with_overlap(text, chunk_size=800, overlap=100):
 		start += chunk_size - overlap
 	return chunks
 
+def split_stream_with_overlap(pieces, chunk_size=800, overlap=100):
+	"""
+	文字列片のイテラブルを連結しながら split_text_with_overlap と同じチャンクを逐次生成する
+	（全文を連結せず、保持するのは chunk_size 程度のバッファのみ）
+	"""
+	step = chunk_size - overlap
+	buffer = ""
+	start = 0
+	for piece in pieces:
+		buffer += piece
+		while len(buffer) - start >= chunk_size:
+			yield buffer[start:start + chunk_size]
+			start += step
+		if start:
+			buffer = buffer[start:]
+			start = 0
+	while start < len(buffer):
+		yield buffer[start:start + chunk_size]
+		start += step
+
+def iter_text_pieces(frames):
+	"""load_csv_as_text と同じ順序・区切りでセルを1つずつ返す"""
+	first = True
+	for frame in frames:
+		for row in frame.values:
+			for cell in row:
+				if pd.notnull(cell):
+					yield str(cell) if first else "\n" + str(cell)
+					first = False
+
+def iter_table_rows_as_text(data, header):
+	for texts in serialize_table_rows(data, header):
+		yield from texts
+
+def iter_csv_chunks(frames, chunk_size=800, overlap=100):
+	"""
+	DataFrame のイテラブル（read_csv(chunksize=...) の結果など）からチャンクを逐次生成する
+	形式判定とヘッダー検出は先頭フレームだけで行う
+	"""
+	frames = iter(frames)
+	prefix = next(frames, None)
+	if prefix is None or prefix.empty:
+		return
+
+	if detect_sheet_format(prefix):
+		log.info("🟦 テーブル形式として処理")
+		header_row_index = detect_header_row(prefix)
+		log.info("✅ ヘッダー行を検出", extra={"header_row_index": header_row_index})
+		header = prefix.iloc[header_row_index]
+		yield from iter_table_rows_as_text(prefix.iloc[header_row_index + 1:], header)
+		for frame in frames:
+			yield from iter_table_rows_as_text(frame, header)
+	else:
+		log.info("🟨 自由記述形式として処理")
+		pieces = iter_text_pieces(itertools.chain([prefix], frames))
+		yield from split_stream_with_overlap(pieces, chunk_size=chunk_size, overlap=overlap)
+
+@timed("process_csv_file")
 def process_csv_file(df, chunk_size=800, overlap=100):
-    if detect_sheet_format(df):
-        print("🟦 テーブル形式として処理")
-        chunks = process_table_format(df, chunk_size=chunk_size, overlap=overlap)
-    else:
-        print("🟨 自由記述形式として処理")
-        text = load_csv_as_text(df)
-        chunks = split_text_with_overlap(text, chunk_size=chunk_size, overlap=overlap)
+    return list(iter_csv_chunks([df], chunk_size=chunk_size, overlap=overlap))
 
-    return chunks
+def detect_csv_encoding(csv_path, encodings=("utf-8", "shift_jis"), block_size=1 << 20):
+	"""
+	ファイルをブロック単位でデコードしてエンコーディングを判定する
+	どれでもデコードできなければ None
+	"""
+	for encoding in encodings:
+		decoder = codecs.getincrementaldecoder(encoding)()
+		try:
+			with open(csv_path, "rb") as f:
+				for block in iter(lambda: f.read(block_size), b""):
+					decoder.decode(block)
+			decoder.decode(b"", final=True)
+			return encoding
+		except UnicodeDecodeError:
+			continue
+	return None
+
+def iter_csv_frames(csv_path, chunksize=CSV_READ_CHUNKSIZE, encoding=None, progress=None):
+	"""
+	CSV を header=None で chunksize 行ずつ読み込む
+	チャンク間で型推論がぶれないよう全列を文字列として読む
+	progress: 読み込み済みバイト割合 (0〜1) を受け取るコールバック
+	"""
+	encoding = encoding or detect_csv_encoding(csv_path) or "utf-8"
+	total_size = os.path.getsize(csv_path) or 1
+	with open(csv_path, "rb") as f:
+		for frame in pd.read_csv(f, header=None, encoding=encoding, dtype=str, chunksize=chunksize):
+			yield frame
+			if progress:
+				progress(min(f.tell() / total_size, 1.0))
+
+def iter_csv_file_chunks(csv_path, chunk_size=800, overlap=100, chunksize=CSV_READ_CHUNKSIZE, encoding=None, progress=None):
+	frames = iter_csv_frames(csv_path, chunksize=chunksize, encoding=encoding, progress=progress)
+	return iter_csv_chunks(frames, chunk_size=chunk_size, overlap=overlap)
+
+# 行チャンク（"列名: 値 / 列名: 値"）から取り出す構造化フィールド
+# 日付は yyyymmdd の整数、金額は数値、会社名は normalize_company した文字列として ChromaDB のメタデータに入れる
+DATE_IN_TEXT = re.compile(r"(\d{4})\s*[/\-.年]\s*(\d{1,2})\s*[/\-.月]\s*(\d{1,2})日?")
+AMOUNT_COLUMN_KEYWORDS = ["金額", "額", "料金", "価格", "円"]
+COMPANY_MARKERS = re.compile(r"株式会社|有限会社|合同会社|\(株\)|\(有\)")
+
+def date_to_int(year, month, day):
+	"""yyyymmdd の整数（存在しない日付なら None）"""
+	year, month, day = int(year), int(month), int(day)
+	try:
+		datetime.date(year, month, day)
+	except ValueError:  # 2024/2/31 など
+		return None
+	return year * 10000 + month * 100 + day
+
+def find_dates(text):
+	"""テキスト中の日付（2024/12/01, 2024-12-1, 2024年12月1日）を yyyymmdd の整数で返す"""
+	dates = (date_to_int(*m.groups()) for m in DATE_IN_TEXT.finditer(unicodedata.normalize("NFKC", text)))
+	return [d for d in dates if d is not None]
+
+def normalize_company(name):
+	"""会社名の表記ゆれをそろえる（全角半角・空白・株式会社などの法人格を除く）"""
+	name = unicodedata.normalize("NFKC", name)
+	name = COMPANY_MARKERS.sub("", name)
+	return re.sub(r"\s+", "", name)
+
+def split_row_fields(text):
+	"""row_to_text / serialize_table_rows の文字列を (列名, 値) に戻す（"列名: " で始まらない部分は無視）"""
+	fields = []
+	for part in text.split(" / "):
+		name, sep, value = part.partition(": ")
+		if sep:
+			fields.append((name, value))
+	return fields
+
+def extract_row_fields(text):
+	"""
+	チャンクから日付・金額・会社名・状況を取り出し、ChromaDB のメタデータ用の dict を返す
+	date_min / date_max, amount_min / amount_max, company（最初の会社名）, status
+	値の種類の判定は classify_value と同じ基準
+	"""
+	fields = {}
+	dates = find_dates(text)
+	if dates:
+		fields["date_min"] = min(dates)
+		fields["date_max"] = max(dates)
+
+	amounts = []
+	for name, value in split_row_fields(text):
+		kind = classify_value(value)
+		if kind == "company" and "company" not in fields:
+			fields["company"] = normalize_company(value)
+		elif kind == "status" and "status" not in fields:
+			fields["status"] = value.strip()
+		elif any(keyword in name for keyword in AMOUNT_COLUMN_KEYWORDS):
+			amount = re.sub(r"[,，¥￥円\s]", "", unicodedata.normalize("NFKC", value))
+			if re.fullmatch(r"-?\d+(\.\d+)?", amount):
+				amounts.append(float(amount))
+	if amounts:
+		fields["amount_min"] = min(amounts)
+		fields["amount_max"] = max(amounts)
+	return fields
 
 def clean_dataframe_and_save(df, output_path):
+    return clean_frames_and_save([df], output_path)
+
+def clean_frames_and_save(frames, output_path):
+    """先頭フレームでヘッダー行を検出し、以降のフレームは追記しながら保存する"""
+    frames = iter(frames)
+    df = next(frames)
+
     # ヘッダー行を検出
     header_row_index = detect_header_row(df)
-    print(f"✅ ヘッダー行 index={header_row_index} で処理")
+    log.info("✅ ヘッダー行を検出", extra={"header_row_index": header_row_index})
 
     header = df.iloc[header_row_index]
+    columns = [col if pd.notnull(col) else f"col_{i}" for i, col in enumerate(header)]
     data = df.iloc[header_row_index + 1:]
 
     # ヘッダーをちゃんと列名にする
-    data.columns = [col if pd.notnull(col) else f"col_{i}" for i, col in enumerate(header)]
+    data.columns = columns
     data = data.reset_index(drop=True)
 
     # CSV形式で保存
     data.to_csv(output_path, index=False)
+    for frame in frames:
+        frame.columns = columns
+        frame.to_csv(output_path, mode="a", header=False, index=False)
     return output_path
 
+def count_csv_rows(csv_path):
+    """整形済みCSV（clean_frames_and_save の出力）のデータ行数（ヘッダー行を除く）"""
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        return max(sum(1 for _ in csv.reader(f)) - 1, 0)
+
 
 def process_csv_from_file(csv_path, chunk_size=800, overlap=100):
     df = pd.read_csv(csv_path, header=None, encoding="utf-8")
@@ -1,46 +1,284 @@
 # query.py
-from embedder import collection, embedding_function
-from openai import OpenAI
+from embedder import get_chunks, get_embedding_function, get_lexical_index, get_search_collections, get_vector_store
+from lexical_index import reciprocal_rank_fusion
+from query_filters import parse_query_filters, build_where, combine_where
+from context_builder import build_context
+from lazy import singleton
+from instrumentation import get_logger, observe, timed
+import config
 import os
+import heapq
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = get_logger("query")
 
 # 必要に応じて OPENAI_API_KEY を環境変数などでセット
-client = OpenAI()
+@singleton
+def get_openai_client():
+    from openai import OpenAI
+    return OpenAI()
 
-def query_documents(query_text, top_k=5):
-    query_embedding = embedding_function([query_text])
-    results = collection.query(query_embeddings=query_embedding, n_results=top_k)
+def embed_query(query_text):
+    return get_embedding_function()([query_text])
 
-    hits = []
-    for i in range(len(results["documents"][0])):
-        doc = results["documents"][0][i]
-        id_ = results["ids"][0][i]
-        dist = results["distances"][0][i]
-        hits.append({"document": doc, "id": id_, "distance": dist})
-    return hits
+def source_filter(sources):
+    """source（文字列またはそのリスト）を ChromaDB の where 条件にする"""
+    if not sources:
+        return None
+    if isinstance(sources, str):
+        return {"source": sources}
+    return {"source": {"$in": list(sources)}}
 
-def generate_answer(query_text, hits):
-    context = "\n---\n".join([hit["document"] for hit in hits])
+def field_filter(query_text):
+    """質問中の日付・登録済みの会社名から where 条件を作る（見つからなければ None）"""
+    filters = parse_query_filters(query_text, get_lexical_index().entities("company"))
+    return build_where(filters)
+
+def query_documents(query_text, top_k=5, query_embedding=None, sources=None, hybrid=None, use_filters=None):
+    """
+    query_embedding（embed_query の結果）を渡すと再埋め込みせずに検索する
+    sources（ファイル名またはそのリスト）を渡すとそのファイルのチャンクだけを検索する
+    hybrid（省略時は config.HYBRID_SEARCH）なら埋め込み検索と転置インデックス（BM25）の結果を RRF でまとめる
+    会社名・日付・コードがそのまま一致するチャンクを、埋め込みだけの場合より少ない件数で拾える
+    use_filters（省略時は config.QUERY_FILTERS）なら質問中の日付・会社名でチャンクのメタデータを先に絞り込む
+    （絞り込んで1件も無ければ絞り込まずに検索し直す）
+    """
+    if query_embedding is None:
+        query_embedding = embed_query(query_text)
+    return query_documents_batch([query_text], top_k, query_embeddings=query_embedding, sources=sources, hybrid=hybrid, use_filters=use_filters)[0]
+
+def query_documents_batch(query_texts, top_k=5, query_embeddings=None, sources=None, hybrid=None, use_filters=None):
+    """
+    複数の質問をまとめて検索し、質問ごとの hits のリストを返す（引数は query_documents と同じ）
+    埋め込みは1回のバッチで行い、where 条件が同じ質問は1回の collection.query にまとめる
+    """
+    query_texts = list(query_texts)
+    if not query_texts:
+        return []
+    if query_embeddings is None:
+        query_embeddings = get_embedding_function()(query_texts)
+    if hybrid is None:
+        hybrid = config.HYBRID_SEARCH
+    if use_filters is None:
+        use_filters = config.QUERY_FILTERS
+    if isinstance(sources, str):
+        sources = [sources]
+
+    base_where = source_filter(sources)
+    groups = {}
+    for i, query_text in enumerate(query_texts):
+        where = combine_where(base_where, field_filter(query_text) if use_filters else None)
+        groups.setdefault(json.dumps(where, sort_keys=True, ensure_ascii=False), (where, []))[1].append(i)
+
+    results = [None] * len(query_texts)
+    retry = []
+    for where, indices in groups.values():
+        group_hits = _search_group([query_texts[i] for i in indices], [query_embeddings[i] for i in indices], top_k, sources, hybrid, where)
+        for i, hits in zip(indices, group_hits):
+            if hits or where == base_where:
+                results[i] = hits
+            else:
+                retry.append(i)
+
+    if retry:
+        log.info("🔎 絞り込み条件に合うチャンクが無い質問は絞り込まずに検索します", extra={"queries": len(retry)})
+        group_hits = _search_group([query_texts[i] for i in retry], [query_embeddings[i] for i in retry], top_k, sources, hybrid, base_where)
+        for i, hits in zip(retry, group_hits):
+            results[i] = hits
+    return results
+
+@timed("vector_search")
+def vector_search(query_embeddings, n_results, where=None, sources=None):
+    """
+    ベクトル検索の結果を collection.query と同じ形（ids / documents / distances / metadatas）で返す
+    config.VECTOR_BACKEND が "faiss" で FAISS インデックスが作成済みなら FAISS で近傍を探し、本文・メタデータは ChromaDB から取る
+    （where の条件もそのとき ChromaDB で確かめる。合わないものを除くので多めに取る）
+    """
+    vector_store = get_vector_store() if config.VECTOR_BACKEND == "faiss" else None
+    if vector_store is None or not vector_store.is_ready:
+        return query_collections(get_search_collections(sources), query_embeddings, n_results, where)
+
+    n_fetch = n_results * config.HYBRID_CANDIDATE_FACTOR if where is not None and where != source_filter(sources) else n_results
+    with timed("faiss_search"):
+        neighbours = vector_store.search(query_embeddings, n_fetch, sources=sources)
+    with timed("chroma_get"):
+        found = get_chunks(list({chunk_id for row in neighbours for chunk_id, _ in row}), where=where)
+    records = {id_: (doc, metadata) for id_, doc, metadata in zip(found["ids"], found["documents"], found["metadatas"])}
+
+    results = {"ids": [], "documents": [], "distances": [], "metadatas": []}
+    for row in neighbours:
+        row = [(chunk_id, distance) for chunk_id, distance in row if chunk_id in records][:n_results]
+        results["ids"].append([chunk_id for chunk_id, _ in row])
+        results["documents"].append([records[chunk_id][0] for chunk_id, _ in row])
+        results["distances"].append([distance for _, distance in row])
+        results["metadatas"].append([records[chunk_id][1] for chunk_id, _ in row])
+    return results
+
+# ファイルごとのコレクションを並行して検索するスレッド（質問ごとに作らず使い回す）
+@singleton
+def get_shard_executor():
+    return ThreadPoolExecutor(max_workers=config.SHARD_SEARCH_WORKERS, thread_name_prefix="shard")
+
+def query_collections(collections, query_embeddings, n_results, where=None):
+    """
+    複数のコレクション（ファイルごとに分けたもの）をスレッドで並行して検索し、質問ごとに距離の近い順に n_results 件にまとめる
+    コレクションが1つならそのまま collection.query の結果を返す
+    """
+    n_queries = len(query_embeddings)
+
+    @timed("chroma_query")
+    def search(collection):
+        return collection.query(query_embeddings=query_embeddings, n_results=n_results, where=where)
+
+    if len(collections) == 1:
+        return search(collections[0])
+
+    shard_results = list(get_shard_executor().map(search, collections))
+
+    results = {"ids": [], "documents": [], "distances": [], "metadatas": []}
+    for q in range(n_queries):
+        rows = [
+            (r["distances"][q][i], r["ids"][q][i], r["documents"][q][i], r["metadatas"][q][i])
+            for r in shard_results
+            for i in range(len(r["ids"][q]))
+        ]
+        rows = heapq.nsmallest(n_results, rows, key=lambda row: row[0])
+        results["distances"].append([row[0] for row in rows])
+        results["ids"].append([row[1] for row in rows])
+        results["documents"].append([row[2] for row in rows])
+        results["metadatas"].append([row[3] for row in rows])
+    return results
+
+def _search_group(query_texts, query_embeddings, top_k, sources, hybrid, where):
+    """where 条件が同じ質問をまとめて検索する"""
+    n_candidates = top_k * config.HYBRID_CANDIDATE_FACTOR if hybrid else top_k
+    results = vector_search(query_embeddings, n_candidates, where, sources)
+
+    vector_hits = []
+    for q in range(len(query_texts)):
+        hits = {}
+        for i in range(len(results["documents"][q])):
+            doc = results["documents"][q][i]
+            id_ = results["ids"][q][i]
+            dist = results["distances"][q][i]
+            metadata = results["metadatas"][q][i] if results.get("metadatas") else None
+            hits[id_] = {"document": doc, "id": id_, "distance": dist, "metadata": metadata or {}}
+        vector_hits.append(hits)
+    if not hybrid:
+        return [list(hits.values())[:top_k] for hits in vector_hits]
+
+    lexical_index = get_lexical_index()
+    with timed("bm25_search"):
+        lexicals = [lexical_index.search(query_text, top_k=n_candidates, sources=sources) for query_text in query_texts]
+    fused = [
+        reciprocal_rank_fusion([list(hits), [id_ for id_, _ in lexical]], k=config.RRF_K)
+        for hits, lexical in zip(vector_hits, lexicals)
+    ]
+
+    # キーワード検索だけで見つかったチャンクは本文をまとめて取り直す（where に合わないものはここで落ちる）
+    missing = {id_ for hits, ranking in zip(vector_hits, fused) for id_, _ in ranking if id_ not in hits}
+    found = {}
+    if missing:
+        with timed("chroma_get"):
+            page = get_chunks(list(missing), where=where)
+        for id_, doc, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+            found[id_] = {"document": doc, "id": id_, "distance": None, "metadata": metadata or {}}
+
+    grouped = []
+    for hits, ranking, lexical in zip(vector_hits, fused, lexicals):
+        bm25 = dict(lexical)
+        grouped.append([
+            {**(hits.get(id_) or found[id_]), "score": score, "bm25": bm25.get(id_)}
+            for id_, score in ranking
+            if id_ in hits or id_ in found
+        ][:top_k])
+    return grouped
+
+def build_answer_messages(query_text, hits):
+    """回答生成に渡すメッセージと、コンテキストの組み立て結果（context_builder.build_context）を返す"""
+    context = build_context(hits, config.CONTEXT_TOKEN_BUDGET or None)
+    log.info("🧾 コンテキスト", extra={key: context[key] for key in ("tokens", "raw_tokens", "saved_tokens", "hits_used", "hits_dropped")})
     prompt = f"""
 あなたはCSVデータに詳しいアシスタントです。
 以下はCSVから得られた関連情報です：
 
-{context}
+{context["text"]}
 
 この情報を元に、次の質問にできるだけ正確に答えてください：
 
 「{query_text}」
 """
+    messages = [
+        {"role": "system", "content": "あなたはCSVに詳しいデータアシスタントです。"},
+        {"role": "user", "content": prompt},
+    ]
+    return messages, context
 
-    response = client.chat.completions.create(
+@timed("llm_answer")
+def generate_answer(query_text, hits):
+    messages, _ = build_answer_messages(query_text, hits)
+    response = get_openai_client().chat.completions.create(
         model="gpt-4o-mini",  # または gpt-4
-        messages=[
-            {"role": "system", "content": "あなたはCSVに詳しいデータアシスタントです。"},
-            {"role": "user", "content": prompt},
-        ],
+        messages=messages,
         temperature=0.2,
     )
     return response.choices[0].message.content
 
+@timed("llm_answer_stream")
+def generate_answer_stream(query_text, hits, on_token):
+    """
+    ストリーミングで回答を生成し、届いたトークンから順に on_token(text) を呼ぶ
+    :return: {"answer", "ttft_ms"（最初のトークンまで）, "total_ms", "context_tokens", "saved_tokens"（重複除去・トークン上限で減らした数）}
+    """
+    start = time.perf_counter()
+    ttft_ms = None
+    parts = []
+    messages, context = build_answer_messages(query_text, hits)
+    stream = get_openai_client().chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        temperature=0.2,
+        stream=True,
+    )
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        token = chunk.choices[0].delta.content
+        if not token:
+            continue
+        if ttft_ms is None:
+            ttft_ms = (time.perf_counter() - start) * 1000
+            observe("llm_first_token", ttft_ms / 1000)
+        parts.append(token)
+        on_token(token)
+    return {
+        "answer": "".join(parts),
+        "ttft_ms": ttft_ms,
+        "total_ms": (time.perf_counter() - start) * 1000,
+        "context_tokens": context["tokens"],
+        "saved_tokens": context["saved_tokens"],
+    }
+
+def generate_answers_batch(query_texts, hits_list, max_workers=None):
+    """
+    質問ごとに generate_answer を最大 max_workers 件ずつ並行して呼び、入力と同じ順に
+    {"answer", "answer_ms"}（失敗した場合は {"error", "answer_ms"}）を返すイテレータ
+    """
+    def answer(args):
+        query_text, hits = args
+        start = time.perf_counter()
+        try:
+            result = {"answer": generate_answer(query_text, hits)}
+        except Exception as e:
+            result = {"error": str(e)}
+        result["answer_ms"] = (time.perf_counter() - start) * 1000
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers or config.BATCH_ANSWER_CONCURRENCY, thread_name_prefix="answer") as executor:
+        yield from executor.map(answer, zip(query_texts, hits_list))
+
 # CLIテスト
 if __name__ == "__main__":
     query = input("🔍 質問を入力してください: ")
@@ -0,0 +1,58 @@
+# query_filters.py
+# 質問に含まれる日付・会社名を ChromaDB の where 条件にする
+# 取り込み時に processor.extract_row_fields でチャンクのメタデータに入れた date_min / date_max / company と対応する
+import calendar
+import re
+import unicodedata
+from typing import Iterable, List, Optional
+
+from processor import DATE_IN_TEXT, date_to_int, find_dates, normalize_company
+
+# 日を含まない年月（2024年12月, 2024/12）
+MONTH_IN_TEXT = re.compile(r"(\d{4})\s*(?:[/\-.]|年)\s*(\d{1,2})\s*月?")
+# 短すぎる会社名は質問中の別の語と誤一致しやすいので使わない
+MIN_COMPANY_LENGTH = 2
+
+def find_date_ranges(query: str) -> List[tuple]:
+    """質問中の日付・年月を (開始, 終了) の yyyymmdd の整数の組で返す"""
+    text = unicodedata.normalize("NFKC", query)
+    ranges = [(d, d) for d in find_dates(text)]
+    for m in MONTH_IN_TEXT.finditer(DATE_IN_TEXT.sub(" ", text)):
+        year, month = int(m.group(1)), int(m.group(2))
+        if 1 <= month <= 12:
+            last_day = calendar.monthrange(year, month)[1]
+            ranges.append((date_to_int(year, month, 1), date_to_int(year, month, last_day)))
+    return ranges
+
+def find_companies(query: str, companies: Iterable[str]) -> List[str]:
+    """登録済みの会社名（normalize_company 済み）のうち質問に含まれるもの（他の一致の一部にすぎないものは除く）"""
+    text = normalize_company(query)
+    found = [c for c in companies if len(c) >= MIN_COMPANY_LENGTH and c in text]
+    return [c for c in found if not any(c != other and c in other for other in found)]
+
+def parse_query_filters(query: str, companies: Iterable[str] = ()) -> dict:
+    return {"date_ranges": find_date_ranges(query), "companies": find_companies(query, companies)}
+
+def build_where(filters: dict) -> Optional[dict]:
+    """parse_query_filters の結果を where 条件にする（条件が無ければ None）"""
+    conditions = []
+    date_conditions = [
+        {"$and": [{"date_min": {"$lte": end}}, {"date_max": {"$gte": start}}]}
+        for start, end in filters.get("date_ranges", [])
+    ]
+    if date_conditions:
+        conditions.append(date_conditions[0] if len(date_conditions) == 1 else {"$or": date_conditions})
+
+    companies = filters.get("companies", [])
+    if len(companies) == 1:
+        conditions.append({"company": companies[0]})
+    elif companies:
+        conditions.append({"company": {"$in": companies}})
+    return combine_where(*conditions)
+
+def combine_where(*conditions) -> Optional[dict]:
+    """None を除いた条件を $and でまとめる"""
+    conditions = [c for c in conditions if c]
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
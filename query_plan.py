@@ -0,0 +1,237 @@
+# query_plan.py
+# 集計の質問を「実行計画（JSON）」にしてから pandas で直接実行する
+# LLM には列名・型・値の例を渡して計画を1回だけ作らせ、絞り込み・グループ化・集計・並べ替えはベクトル化された pandas で行う
+# 計画が作れない・列名が合わないなどの場合は PlanError を投げる（呼び出し側で従来のエージェントに回す）
+import json
+import re
+from typing import Optional
+
+import pandas as pd
+
+OPERATORS = ["==", "!=", ">", ">=", "<", "<=", "contains", "in", "between"]
+AGGREGATIONS = ["sum", "mean", "count", "min", "max", "median", "nunique"]
+TIME_GRAINS = {"day": "D", "month": "M", "year": "Y"}
+# 集計しない（行をそのまま返す）計画で返す行数の上限
+MAX_ROWS = 50
+# 計画の値・日付の列として読む形式（YYYY-MM-DD / YYYY/MM/DD）
+DATE_PATTERN = re.compile(r"\d{4}[/-]\d{1,2}[/-]\d{1,2}")
+
+PLAN_PROMPT = """
+あなたは表データの集計を pandas の実行計画に変換するアシスタントです。
+表の列（名前・型・値の例）:
+{columns}
+
+質問: {question}
+
+次の形式の JSON だけを出力してください。列名は上の一覧にあるものをそのまま使います。
+{{
+  "description": "何を計算するかの短い説明（日本語）",
+  "answerable": true,
+  "filters": [{{"column": "列名", "op": "== / != / > / >= / < / <= / contains / in / between", "value": 値（in は配列、between は [下限, 上限]）}}],
+  "group_by": ["列名"],
+  "time_grain": null,
+  "aggregations": [{{"column": "列名（count で行数を数える場合は null）", "func": "sum / mean / count / min / max / median / nunique"}}],
+  "sort": {{"by": "列名 または 集計結果の名前（func(列名)、行数は count(*)）", "ascending": false}},
+  "limit": null,
+  "columns": []
+}}
+- 日付は YYYY-MM-DD 形式で書いてください
+- time_grain は group_by の日付の列を day / month / year 単位にまとめるときだけ指定します
+- 集計しない質問（条件に合う行の一覧など）では aggregations を空にし、columns に表示する列を入れます
+- 表の列で答えられない質問なら answerable を false にしてください
+"""
+
+class PlanError(ValueError):
+    pass
+
+def describe_columns(df: pd.DataFrame, n_samples: int = 3) -> str:
+    lines = []
+    for col in df.columns:
+        samples = df[col].dropna().astype(str).drop_duplicates().head(n_samples).tolist()
+        lines.append(f"- {col} ({df[col].dtype}): {', '.join(samples)}")
+    return "\n".join(lines)
+
+def build_plan_prompt(df: pd.DataFrame, question: str) -> str:
+    return PLAN_PROMPT.format(columns=describe_columns(df), question=question)
+
+def parse_plan(text: str) -> dict:
+    """LLM の出力から JSON を取り出す（```json ... ``` で囲まれていても読む）"""
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        raise PlanError(f"実行計画が JSON ではありません: {text[:200]}")
+    try:
+        return json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise PlanError(f"実行計画を読めません: {e}") from e
+
+def aggregation_name(aggregation: dict) -> str:
+    return f"{aggregation['func']}({aggregation.get('column') or '*'})"
+
+def validate_plan(plan: dict, df: pd.DataFrame) -> dict:
+    """列名・演算子・集計関数を確かめ、省略されたキーを補った計画を返す"""
+    if not plan.get("answerable", True):
+        raise PlanError("表の列では答えられない質問です")
+    plan = {
+        "description": plan.get("description") or "",
+        "filters": plan.get("filters") or [],
+        "group_by": plan.get("group_by") or [],
+        "time_grain": plan.get("time_grain"),
+        "aggregations": plan.get("aggregations") or [],
+        "sort": plan.get("sort") or None,
+        "limit": plan.get("limit"),
+        "columns": plan.get("columns") or [],
+    }
+    columns = set(map(str, df.columns))
+
+    def check_column(name, where):
+        if name not in columns:
+            raise PlanError(f"{where} の列 {name!r} が表にありません")
+
+    for f in plan["filters"]:
+        check_column(f.get("column"), "filters")
+        if f.get("op") not in OPERATORS:
+            raise PlanError(f"未対応の演算子です: {f.get('op')}")
+    for name in plan["group_by"] + plan["columns"]:
+        check_column(name, "group_by / columns")
+    for aggregation in plan["aggregations"]:
+        if aggregation.get("func") not in AGGREGATIONS:
+            raise PlanError(f"未対応の集計です: {aggregation.get('func')}")
+        if aggregation.get("column") is not None:
+            check_column(aggregation["column"], "aggregations")
+        elif aggregation["func"] != "count":
+            raise PlanError(f"{aggregation['func']} には列が必要です")
+    if plan["time_grain"] is not None and plan["time_grain"] not in TIME_GRAINS:
+        raise PlanError(f"未対応の time_grain です: {plan['time_grain']}")
+    if plan["sort"] is not None:
+        names = columns | {aggregation_name(a) for a in plan["aggregations"]}
+        if plan["sort"].get("by") not in names:
+            raise PlanError(f"sort の列 {plan['sort'].get('by')!r} がありません")
+    if plan["limit"] is not None and (not isinstance(plan["limit"], int) or plan["limit"] <= 0):
+        raise PlanError(f"limit が正しくありません: {plan['limit']}")
+    return plan
+
+def plan_columns(plan: dict, all_columns) -> Optional[list]:
+    """validate_plan 済みの計画の実行に使う列（行の一覧を全列で返す計画なら None = 全列）"""
+    if not plan["aggregations"] and not plan["columns"]:
+        return None
+    names = [f["column"] for f in plan["filters"]] + plan["group_by"] + plan["columns"]
+    names += [a["column"] for a in plan["aggregations"] if a.get("column") is not None]
+    if plan["sort"] is not None:
+        names.append(plan["sort"]["by"])
+    return [name for name in map(str, all_columns) if name in set(names)]
+
+def _to_dates(values: pd.Series) -> pd.Series:
+    return pd.to_datetime(values.astype("string").str.strip().str.replace("-", "/", regex=False), format="%Y/%m/%d", errors="coerce")
+
+def _comparable(series: pd.Series, value):
+    """値の型に合わせて列を比較できる形にそろえる（文字列の数値・日付も比べられるように）"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series, pd.to_datetime(value)
+    if isinstance(value, str) and DATE_PATTERN.fullmatch(value.strip()) and not pd.api.types.is_numeric_dtype(series):
+        # 日付が文字列のままの列（CSV を直接読んだ場合など）。"2024/12/01" と "2024-12-01" を文字列として比べない
+        dates = _to_dates(series)
+        present = series.notna() & (series.astype("string").str.strip() != "")
+        if (present & dates.isna()).any():
+            raise PlanError(f"列 {series.name} は日付として読めない値を含むため、日付で比較できません")
+        return dates, _to_dates(pd.Series([value])).iloc[0]
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return pd.to_numeric(series, errors="coerce"), value
+    if isinstance(value, str) and not pd.api.types.is_numeric_dtype(series):
+        return series.astype("string"), value
+    if isinstance(value, str):
+        return series, pd.to_numeric(value, errors="coerce")
+    return series, value
+
+def _filter_mask(df: pd.DataFrame, f: dict) -> pd.Series:
+    series, op, value = df[f["column"]], f["op"], f.get("value")
+    if op == "contains":
+        return series.astype("string").str.contains(str(value), regex=False, na=False)
+    if op == "in":
+        values = value if isinstance(value, list) else [value]
+        return series.astype("string").isin([str(v) for v in values]) | series.isin(values)
+    if op == "between":
+        if not isinstance(value, list) or len(value) != 2:
+            raise PlanError(f"between の値は [下限, 上限] で指定してください: {value}")
+        low_series, low = _comparable(series, value[0])
+        high_series, high = _comparable(series, value[1])
+        return (low_series >= low) & (high_series <= high)
+
+    series, value = _comparable(series, value)
+    mask = {
+        "==": lambda: series == value,
+        "!=": lambda: series != value,
+        ">": lambda: series > value,
+        ">=": lambda: series >= value,
+        "<": lambda: series < value,
+        "<=": lambda: series <= value,
+    }[op]()
+    return mask.fillna(False).astype(bool)
+
+def _group_keys(df: pd.DataFrame, plan: dict) -> list:
+    """group_by の列（time_grain の指定があれば日付の列を期間にまとめる）"""
+    keys = []
+    for name in plan["group_by"]:
+        series = df[name]
+        if plan["time_grain"] is not None and not pd.api.types.is_numeric_dtype(series):
+            dates = series if pd.api.types.is_datetime64_any_dtype(series) else pd.to_datetime(series, errors="coerce")
+            if dates.notna().any():
+                series = dates.dt.to_period(TIME_GRAINS[plan["time_grain"]]).astype("string")
+        keys.append(series.rename(name))
+    return keys
+
+def _aggregate(df: pd.DataFrame, plan: dict, keys: list):
+    columns = {}
+    grouped = df.groupby(keys, dropna=False) if keys else None
+    for aggregation in plan["aggregations"]:
+        name = aggregation_name(aggregation)
+        column, func = aggregation.get("column"), aggregation["func"]
+        if column is None:
+            columns[name] = grouped.size() if keys else len(df)
+            continue
+        values = df[column]
+        if func in ("sum", "mean", "median") and not pd.api.types.is_numeric_dtype(values):
+            values = pd.to_numeric(values.astype("string").str.replace(r"[,，¥￥円\s]", "", regex=True), errors="coerce")
+        if keys:
+            columns[name] = getattr(values.groupby(keys, dropna=False), func)()
+        else:
+            columns[name] = getattr(values, func)()
+    if keys:
+        return pd.DataFrame(columns)
+    return pd.Series(columns, dtype=object)
+
+def execute_plan(plan: dict, df: pd.DataFrame):
+    """validate_plan 済みの計画を実行し、DataFrame（集計表・行の一覧）か Series（全体の集計値）を返す"""
+    mask = pd.Series(True, index=df.index)
+    for f in plan["filters"]:
+        mask &= _filter_mask(df, f)
+    data = df[mask]
+
+    if plan["aggregations"]:
+        result = _aggregate(data, plan, _group_keys(data, plan))
+        if isinstance(result, pd.Series):
+            return result
+        result = result.reset_index()
+    else:
+        result = data[plan["columns"]] if plan["columns"] else data
+
+    if plan["sort"] is not None:
+        result = result.sort_values(plan["sort"]["by"], ascending=bool(plan["sort"].get("ascending", False)))
+    if plan["limit"]:
+        result = result.head(plan["limit"])
+    return result
+
+def format_result(plan: dict, result) -> str:
+    """実行結果を回答の文字列にする（LLM は使わない）。表は MAX_ROWS 行まで"""
+    lines = []
+    if plan["description"]:
+        lines.append(f"📊 {plan['description']}")
+    if isinstance(result, pd.Series):
+        for name, value in result.items():
+            lines.append(f"{name}: {value:,.2f}" if isinstance(value, float) else f"{name}: {value}")
+    elif result.empty:
+        lines.append("条件に合うデータはありませんでした")
+    else:
+        lines.append(result.head(MAX_ROWS).to_string(index=False))
+        if len(result) > MAX_ROWS:
+            lines.append(f"（{len(result)} 件中 {MAX_ROWS} 件を表示）")
+    return "\n".join(lines)
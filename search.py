@@ -1,17 +1,15 @@
 # search.py
-from embedder import collection, embedding_function
+from query import query_documents
 
 query = "ジェイコム東京　八王子・日野局の2024/12/01の入金状況"  # 🔍 ここを変えて検索
-query_embedding = embedding_function([query])  # tolist()を削除
 
-results = collection.query(
-    query_embeddings=query_embedding,
-    n_results=5
-)
+# 埋め込み検索とキーワード検索（BM25）を RRF でまとめた結果（hybrid=False で埋め込み検索のみ）
+hits = query_documents(query, top_k=5)
 
 # 結果の表示
-for i, doc in enumerate(results["documents"][0]):
+for i, hit in enumerate(hits):
     print(f"\n🔹 Top {i+1}")
-    print("📝 Document:", doc)
-    print("📄 ID:", results["ids"][0][i])
-    print("🔢 Distance (approx.):", results.get("distances", [[None]*len(doc)])[0][i])
+    print("📝 Document:", hit["document"])
+    print("📄 ID:", hit["id"])
+    print("🔢 Distance (approx.):", hit["distance"])
+    print("🔤 BM25:", hit.get("bm25"))
@@ -0,0 +1,81 @@
+# source_catalog.py
+# 登録済みファイル（source）の一覧（SQLite）
+# ファイルごとに、チャンクを入れたコレクション名・行数・チャンク数・登録日時・内容のハッシュを持つ
+# ファイルの一覧や分割（シャード）したコレクションの検索先は、全チャンクのメタデータを読まずにここから取る
+# 登録・削除のたびにファイルごとのバージョンを上げる（別のプロセスで削除した場合も回答キャッシュが古い回答を使わないように）
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+class SourceCatalog:
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sources ("
+            " source TEXT PRIMARY KEY, collection TEXT NOT NULL, rows INTEGER, chunks INTEGER NOT NULL,"
+            " content_hash TEXT, indexed_at REAL NOT NULL)"
+        )
+        # 削除したファイルのバージョンも残す（同じ名前で登録し直したときに番号が戻らないように）
+        self._conn.execute("CREATE TABLE IF NOT EXISTS source_versions (source TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        self._conn.commit()
+
+    def upsert(self, source: str, collection: str, chunks: int, rows: Optional[int] = None, content_hash: Optional[str] = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sources (source, collection, rows, chunks, content_hash, indexed_at) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(source) DO UPDATE SET collection = excluded.collection, rows = excluded.rows,"
+                " chunks = excluded.chunks, content_hash = excluded.content_hash, indexed_at = excluded.indexed_at",
+                (source, collection, rows, chunks, content_hash, time.time()),
+            )
+            self._bump_version(source)
+            self._conn.commit()
+
+    def delete(self, source: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sources WHERE source = ?", (source,))
+            self._bump_version(source)
+            self._conn.commit()
+
+    def _bump_version(self, source: str):
+        self._conn.execute(
+            "INSERT INTO source_versions (source, version) VALUES (?, 1)"
+            " ON CONFLICT(source) DO UPDATE SET version = version + 1",
+            (source,),
+        )
+
+    def versions(self) -> dict:
+        """{source: バージョン}（登録・削除のたびに 1 ずつ増える）"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT source, version FROM source_versions"))
+
+    def get(self, source: str) -> Optional[dict]:
+        entries = self._select("WHERE source = ?", (source,))
+        return entries[0] if entries else None
+
+    def entries(self) -> List[dict]:
+        return self._select("ORDER BY source", ())
+
+    def sources(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT source FROM sources ORDER BY source")]
+
+    def _select(self, clause, params) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT source, collection, rows, chunks, content_hash, indexed_at FROM sources {clause}", params
+            ).fetchall()
+        keys = ("source", "collection", "rows", "chunks", "content_hash", "indexed_at")
+        return [dict(zip(keys, row)) for row in rows]
+
+def file_content_hash(path: str, block_size: int = 1 << 20) -> str:
+    """ファイルの内容の sha1（同じ内容のファイルを再アップロードしたかを調べる）"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -1,17 +1,78 @@
-from query import embedding_function
-from embedder import collection
-from collections import Counter
+import math
+from collections import defaultdict
 
-def select_best_csv_file_for_question(question: str) -> str:
-    query_embedding = embedding_function([question])
-    results = collection.query(query_embeddings=query_embedding, n_results=10)
+from embedder import get_source_collection
+from instrumentation import get_logger
 
-    file_ids = [doc_id for doc_id in results["ids"][0]]  # ファイル名全体を取得
-    most_common_file = Counter(file_ids).most_common(1)[0][0]
-    print("most_common_file:", most_common_file)
+log = get_logger("utils")
 
-    # 拡張子の.csv以降を削除
-    if ".csv" in most_common_file:
-        most_common_file = most_common_file.split(".csv")[0] + ".csv"
+# ファイル選択で代表ベクトルを比べるファイル数
+ROUTING_FILE_CANDIDATES = 5
 
-    return most_common_file
\ No newline at end of file
+def _softmax(scores: dict, temperature: float) -> dict:
+    if not scores:
+        return {}
+    top = max(scores.values())
+    weights = {key: math.exp((score - top) / temperature) for key, score in scores.items()}
+    total = sum(weights.values())
+    return {key: weight / total for key, weight in weights.items()}
+
+def rank_source_files(hits, query_embedding=None, n_files=ROUTING_FILE_CANDIDATES, vote_weight=0.5, temperature=0.05) -> list:
+    """
+    質問に答えるのに使うファイル（source）の候補を確からしい順に返す
+    - 検索結果 hits（query_documents の結果）の各チャンクが自分の source に順位の逆数で投票する
+    - query_embedding を渡すと、ファイルごとの代表ベクトルとの類似度も加える
+    :return: [{"source", "confidence", "votes", "similarity"}, ...]（confidence は合計 1）
+    """
+    votes = defaultdict(float)
+    for rank, hit in enumerate(hits):
+        source = (hit.get("metadata") or {}).get("source")
+        if source is not None:
+            votes[source] += 1.0 / (rank + 1)
+
+    similarities = {}
+    if query_embedding is not None:
+        collection = get_source_collection()
+        n_results = min(n_files, collection.count())
+        if n_results > 0:
+            results = collection.query(query_embeddings=query_embedding, n_results=n_results, include=["distances"])
+            for source, distance in zip(results["ids"][0], results["distances"][0]):
+                similarities[source] = 1.0 - distance  # cosine 距離 -> 類似度
+
+    total_votes = sum(votes.values())
+    vote_share = {source: v / total_votes for source, v in votes.items()} if total_votes else {}
+    similarity_share = _softmax(similarities, temperature)
+    if not vote_share or not similarity_share:
+        vote_weight = 1.0 if vote_share else 0.0
+
+    ranked = []
+    for source in set(vote_share) | set(similarity_share):
+        confidence = vote_weight * vote_share.get(source, 0.0) + (1 - vote_weight) * similarity_share.get(source, 0.0)
+        ranked.append({
+            "source": source,
+            "confidence": confidence,
+            "votes": votes.get(source, 0.0),
+            "similarity": similarities.get(source),
+        })
+    ranked.sort(key=lambda r: r["confidence"], reverse=True)
+    return ranked
+
+def select_best_csv_file_from_hits(hits, query_embedding=None):
+    """query_documents の検索結果からファイル名を選ぶ（候補が無ければ None）"""
+    ranked = rank_source_files(hits, query_embedding)
+    if not ranked:
+        return None
+    log.info("📁 ファイルを選択", extra={"source": ranked[0]["source"], "confidence": round(ranked[0]["confidence"], 3)})
+    return ranked[0]["source"]
+
+def rank_csv_files_for_question(question: str, hits=None, top_k=10) -> list:
+    """hits（query_documents の結果）を渡すと検索をやり直さずに順位づけする"""
+    from query import embed_query, query_documents
+    query_embedding = embed_query(question)
+    if hits is None:
+        hits = query_documents(question, top_k=top_k, query_embedding=query_embedding)
+    return rank_source_files(hits, query_embedding)
+
+def select_best_csv_file_for_question(question: str, hits=None):
+    ranked = rank_csv_files_for_question(question, hits)
+    return ranked[0]["source"] if ranked else None
@@ -0,0 +1,256 @@
+# vector_store.py
+# ChromaDB の代わりにベクトル検索だけを受け持つローカルの近似最近傍インデックス（FAISS）
+# 本文・メタデータは引き続き ChromaDB に置き、ここには「チャンク id・source・圧縮したベクトル」だけを持つ
+#   - factory: FAISS のインデックス指定（既定 "HNSW32,SQ8" = HNSW + int8 スカラー量子化。"IVF4096,PQ64" なども可）
+#   - mmap   : インデックスをメモリマップで開く（大きなインデックスを全部読み込まない）
+# 削除は id 対応表に印を付けるだけ（HNSW は削除できないため）。検索時に多めに取って除き、build で作り直す
+# id 対応表の変更は save でインデックスを書き出すときにまとめてコミットする（途中で落ちても両者がずれないように）
+#   python vector_store.py build   # ChromaDB に登録済みの全チャンクから作り直す
+#   python vector_store.py stats
+import os
+import sqlite3
+import threading
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from instrumentation import get_logger
+
+log = get_logger("vector_store")
+
+try:
+    import faiss
+except ImportError:  # faiss が無ければこのバックエンドは使えない（ChromaDB で検索する）
+    faiss = None
+
+# 学習（量子化・IVF のクラスタ）に使うベクトル数の上限
+MAX_TRAINING_VECTORS = 200_000
+# SQLite の IN 句に一度に渡すキー数
+_SQL_BATCH = 500
+
+class FaissVectorStore:
+    def __init__(self, path: str, factory: str = "HNSW32,SQ8", space: str = "l2", ef_search: int = 64, nprobe: int = 16, mmap: bool = False):
+        """
+        :param path: インデックスと id 対応表を置くディレクトリ
+        :param space: "l2" / "ip" / "cosine"（ChromaDB の hnsw:space と同じ。cosine は正規化して内積で検索する）
+        :param ef_search: HNSW の探索幅 / nprobe: IVF で調べるクラスタ数
+        """
+        if faiss is None:
+            raise RuntimeError("faiss がインストールされていません（pip install faiss-cpu）")
+        self.path = path
+        self.factory = factory
+        self.space = space
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        self.mmap = mmap
+        self._lock = threading.Lock()
+        self.index = None
+        self._loaded_mmap = False
+
+        os.makedirs(path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(path, "ids.sqlite3"), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            " vid INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL, source TEXT, deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS vectors_chunk ON vectors (chunk_id)")
+        self._conn.commit()
+        if os.path.exists(self.index_path):
+            self._load(mmap)
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.path, "index.faiss")
+
+    @property
+    def is_ready(self) -> bool:
+        """build 済みで、追加・検索できる状態か"""
+        return self.index is not None and self.index.is_trained
+
+    def _load(self, mmap):
+        self._read_index(mmap)
+        rows = self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        if self.index.ntotal != rows:
+            # 保存の途中で止まったなどで id 対応表と合わない（build し直すまで ChromaDB で検索する）
+            log.warning(
+                "⚠️ FAISS インデックスと id 対応表の件数が合わないため使いません（python vector_store.py build で作り直してください）",
+                extra={"vectors": self.index.ntotal, "rows": rows},
+            )
+            self.index = None
+
+    def _read_index(self, mmap):
+        if mmap:
+            try:
+                self.index = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError as e:
+                # メモリマップに対応していないインデックスの種類もある
+                log.warning("⚠️ メモリマップで開けないため読み込みます", extra={"error": str(e)})
+                mmap = False
+        if not mmap:
+            self.index = faiss.read_index(self.index_path)
+        self._loaded_mmap = mmap
+        self._set_search_params()
+
+    def _ensure_writable(self):
+        if self.index is not None and self._loaded_mmap:
+            self._read_index(False)
+
+    def _set_search_params(self):
+        inner = faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap) else self.index
+        if hasattr(inner, "hnsw"):
+            inner.hnsw.efSearch = self.ef_search
+        ivf = faiss.try_extract_index_ivf(inner)
+        if ivf is not None:
+            ivf.nprobe = self.nprobe
+
+    def _prepare(self, embeddings) -> np.ndarray:
+        vectors = np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32))
+        if self.space == "cosine":
+            faiss.normalize_L2(vectors)
+        return vectors
+
+    def build(self, ids: Sequence[str], embeddings, sources: Sequence[Optional[str]]):
+        """全ベクトルからインデックスを作り直す（学習が必要な factory はここで学習する）"""
+        vectors = self._prepare(embeddings)
+        metric = faiss.METRIC_L2 if self.space == "l2" else faiss.METRIC_INNER_PRODUCT
+        index = faiss.IndexIDMap2(faiss.index_factory(vectors.shape[1], self.factory, metric))
+        if not index.is_trained:
+            sample = vectors
+            if len(vectors) > MAX_TRAINING_VECTORS:
+                sample = vectors[np.random.default_rng(0).choice(len(vectors), MAX_TRAINING_VECTORS, replace=False)]
+            index.train(sample)
+        with self._lock:
+            self._conn.execute("DELETE FROM vectors")
+            self.index = index
+            self._loaded_mmap = False
+            self._set_search_params()
+            self._add(list(ids), vectors, list(sources))
+            self._save()
+
+    def add(self, ids: Sequence[str], embeddings, sources: Sequence[Optional[str]]) -> bool:
+        """ベクトルを追加する（同じチャンク id があれば古い方は削除扱い）。build 前は何もせず False"""
+        if not self.is_ready:
+            return False
+        vectors = self._prepare(embeddings)
+        with self._lock:
+            self._ensure_writable()
+            self._mark_deleted(ids)
+            self._add(list(ids), vectors, list(sources))
+        return True
+
+    def _add(self, ids, vectors, sources):
+        start = self._conn.execute("SELECT COALESCE(MAX(vid), -1) + 1 FROM vectors").fetchone()[0]
+        vids = np.arange(start, start + len(ids), dtype=np.int64)
+        self.index.add_with_ids(vectors, vids)
+        self._conn.executemany(
+            "INSERT INTO vectors (vid, chunk_id, source) VALUES (?, ?, ?)",
+            zip(vids.tolist(), ids, sources),
+        )
+
+    def delete(self, ids: Sequence[str]):
+        with self._lock:
+            self._mark_deleted(ids)
+
+    def _mark_deleted(self, ids):
+        ids = list(ids)
+        for i in range(0, len(ids), _SQL_BATCH):
+            part = ids[i:i + _SQL_BATCH]
+            self._conn.execute(f"UPDATE vectors SET deleted = 1 WHERE chunk_id IN ({','.join('?' * len(part))})", part)
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        """インデックスを書き出してから、それまでの id 対応表の変更（追加・削除の印）をコミットする"""
+        if self.index is not None and not self._loaded_mmap:
+            tmp_path = self.index_path + ".tmp"
+            faiss.write_index(self.index, tmp_path)
+            os.replace(tmp_path, self.index_path)
+        # メモリマップで開いている間は削除の印しか変わらない（インデックスのファイルはそのままでよい）
+        self._conn.commit()
+
+    def search(self, query_embeddings, k: int, sources: Optional[Sequence[str]] = None) -> List[List[tuple]]:
+        """
+        質問ごとに (チャンク id, 距離) を近い順に最大 k 件返す（距離は ChromaDB と同じく l2 は二乗距離、ip / cosine は 1 - 内積）
+        削除済み・sources 以外のものは除く（足りなければ取る件数を増やして探し直す）
+        """
+        queries = self._prepare(query_embeddings)
+        results = [None] * len(queries)
+        pending = list(range(len(queries)))
+        n_fetch = k * 2
+        with self._lock:
+            n_total = self.index.ntotal
+            if n_total == 0:
+                return [[] for _ in pending]
+            while pending:
+                distances, vids = self.index.search(queries[pending], min(n_fetch, n_total))
+                rows = self._lookup({int(v) for v in vids.ravel() if v >= 0})
+                still_pending = []
+                for q, row_distances, row_vids in zip(pending, distances, vids):
+                    hits = []
+                    for distance, vid in zip(row_distances, row_vids):
+                        row = rows.get(int(vid))
+                        if row is None or row[2] or (sources and row[1] not in sources):
+                            continue
+                        hits.append((row[0], float(distance) if self.space == "l2" else float(1 - distance)))
+                        if len(hits) == k:
+                            break
+                    if len(hits) < k and n_fetch < n_total:
+                        still_pending.append(q)
+                    else:
+                        results[q] = hits
+                pending = still_pending
+                n_fetch *= 4
+        return results
+
+    def _lookup(self, vids) -> dict:
+        """vid -> (chunk_id, source, deleted)"""
+        vids = list(vids)
+        rows = {}
+        for i in range(0, len(vids), _SQL_BATCH):
+            part = vids[i:i + _SQL_BATCH]
+            for vid, chunk_id, source, deleted in self._conn.execute(
+                f"SELECT vid, chunk_id, source, deleted FROM vectors WHERE vid IN ({','.join('?' * len(part))})", part
+            ):
+                rows[vid] = (chunk_id, source, deleted)
+        return rows
+
+    def stats(self) -> dict:
+        with self._lock:
+            total, deleted = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(deleted), 0) FROM vectors").fetchone()
+        return {
+            "factory": self.factory,
+            "vectors": total,
+            "deleted": deleted,
+            "index_bytes": os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0,
+            "ready": self.is_ready,
+        }
+
+def build_from_collections(store: FaissVectorStore, collections, page_size=5000):
+    """ChromaDB のコレクション（ファイルごとに分けている場合はそのすべて）に登録済みの全チャンクのベクトルからインデックスを作る"""
+    ids, embeddings, sources = [], [], []
+    for collection in collections:
+        offset = 0
+        while True:
+            page = collection.get(include=["embeddings", "metadatas"], limit=page_size, offset=offset)
+            ids.extend(page["ids"])
+            embeddings.extend(page["embeddings"])
+            sources.extend((metadata or {}).get("source") for metadata in page["metadatas"])
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+    if ids:
+        store.build(ids, embeddings, sources)
+    return len(ids)
+
+if __name__ == "__main__":
+    import sys
+    from embedder import get_search_collections, get_vector_store
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    store = get_vector_store()
+    if command == "build":
+        n = build_from_collections(store, get_search_collections())
+        print(f"✅ {n} 件のベクトルからインデックスを作成しました")
+    print(store.stats())